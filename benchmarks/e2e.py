@@ -0,0 +1,244 @@
+# This file benchmarks whole simulations against the fake LLM backend, at several population sizes and day counts
+# Usage (from the repository root): python benchmarks/e2e.py [--sizes 100 1000 10000] [--days 2] [--output results.json] [--baseline old.json]
+# Every (size, days) configuration runs BackboneEngine.run_policy in its own process and reports, per stage function,
+# wall time, CPU time of the driver and of the generation workers, generation time and requests, plus the peak RSS,
+# the bytes written to the run directory and the requests per second of the whole run.
+# With --baseline, the results are compared with those of an earlier commit, and the script fails when a metric
+# is worse by more than --threshold (relative), ignoring timings below --min_seconds.
+import argparse
+import json
+import multiprocessing as mp
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SRC = os.path.join(ROOT, "src")
+PROFILES = os.path.join(ROOT, "data", "profiles-num=100-incl=neutral.pkl")
+NETWORK = os.path.join(ROOT, "data", "social_network-num=100-incl=neutral.pkl")
+NEWS = os.path.join(ROOT, "data", "news", "COVID-news-pos_vac-k=2500.pkl")
+STAGES = ["init_agents", "feed_news_data", "feed_disease_broadcast", "broadcast_news_and_policies", "feed_tweets", "prompt_actions", "poll_attitude", "spread_disease", "finish_simulation"]
+# metrics where a larger value is a regression; req_per_s is the only one where a smaller value is
+LOWER_IS_BETTER = ["wall_s", "cpu_s", "worker_cpu_s", "generate_s", "peak_rss_mb", "bytes_written"]
+HIGHER_IS_BETTER = ["req_per_s"]
+
+def make_population(size, data_dir, seed=0):
+    """Profiles and a social network of size agents, resampled from the 100-agent data, cached in data_dir."""
+    import pickle
+    import numpy as np
+    from sandbox.social_network import SocialNetwork
+    profile_path = os.path.join(data_dir, f"profiles-num={size}.pkl")
+    network_path = os.path.join(data_dir, f"social_network-num={size}.npz")
+    if os.path.exists(profile_path) and os.path.exists(network_path):
+        return profile_path, network_path
+    rng = np.random.default_rng(seed)
+    with open(PROFILES, "rb") as f:
+        profiles = list(pickle.load(f))
+    with open(profile_path, "wb") as f:
+        pickle.dump([profiles[i] for i in rng.integers(0, len(profiles), size)], f)
+    # same out-degree and weight distributions as the original network, followees drawn uniformly
+    base = SocialNetwork.load(NETWORK)
+    degrees = np.minimum(rng.choice(base.out_degree(), size), size - 1)
+    src = np.repeat(np.arange(size), degrees)
+    dst = rng.integers(0, size - 1, len(src))
+    dst = dst + (dst >= src) # no self-follows
+    keys = np.unique(src.astype(np.int64) * size + dst)
+    SocialNetwork(size, keys // size, keys % size, rng.choice(base.weight, len(keys))).save(network_path)
+    return profile_path, network_path
+
+def dir_size(path):
+    return sum(os.path.getsize(os.path.join(d, name)) for d, _, names in os.walk(path) for name in names)
+
+class StageTimer:
+    """Wraps the stage functions, generate and _dispatch of an engine instance and accumulates their costs."""
+    def __init__(self, engine):
+        self.stats = {}
+        self.current = None
+        for name in STAGES:
+            setattr(engine, name, self.wrap_stage(name, getattr(engine, name)))
+        generate, dispatch = engine.generate, engine._dispatch
+        def timed_generate(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return generate(*args, **kwargs)
+            finally:
+                self.stage_stats()["generate_s"] += time.perf_counter() - start
+        def counted_dispatch(messages, *args, **kwargs):
+            self.stage_stats()["requests"] += len(messages)
+            return dispatch(messages, *args, **kwargs)
+        engine.generate, engine._dispatch = timed_generate, counted_dispatch
+
+    def stage_stats(self):
+        return self.stats.setdefault(self.current, {"calls": 0, "wall_s": 0.0, "cpu_s": 0.0, "worker_cpu_s": 0.0, "generate_s": 0.0, "requests": 0})
+
+    def wrap_stage(self, name, func):
+        def timed(*args, **kwargs):
+            self.current = name
+            stats = self.stage_stats()
+            # generation workers are spawned and joined within a stage, so their CPU time shows up in the children's times
+            wall, cpu, children = time.perf_counter(), time.process_time(), os.times()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                end_children = os.times()
+                stats["calls"] += 1
+                stats["wall_s"] += time.perf_counter() - wall
+                stats["cpu_s"] += time.process_time() - cpu
+                stats["worker_cpu_s"] += (end_children.children_user - children.children_user) + (end_children.children_system - children.children_system)
+        return timed
+
+def run_config(size, days, args, queue):
+    """Run one simulation in this (fresh) process and put its results on queue."""
+    sys.path.insert(0, SRC)
+    os.chdir(ROOT) # data paths of the engine are relative to the repository root
+    save_dir = os.path.join(args["work_dir"], f"sim-num={size}-days={days}")
+    # the engine's progress output goes to a log next to the run directory, not into the report
+    log = open(save_dir + ".log", "w")
+    os.dup2(log.fileno(), sys.stdout.fileno())
+    os.dup2(log.fileno(), sys.stderr.fileno())
+    from engines.configs import RunConfig
+    profile_path, network_path = make_population(size, args["data_dir"])
+    config = RunConfig(
+        model_type="fake",
+        profile_str=profile_path,
+        network_str=network_path,
+        news_path=NEWS,
+        save_dir=save_dir,
+        ports=list(range(args["processes"])),
+        run_days=days,
+        warmup_days=args["warmup_days"],
+        seed=args["seed"],
+        fake_latency_ms=args["fake_latency_ms"],
+        fake_latency_dist=args["fake_latency_dist"],
+        fake_error_rate=args["fake_error_rate"],
+        fake_rate_limit_rate=args["fake_rate_limit_rate"],
+    )
+    start = time.perf_counter()
+    if args["engine"] == "async":
+        from engines.async_engine import AsyncDataParallelEngine
+        engine = AsyncDataParallelEngine(**config.__dict__)
+    else:
+        from engines.multi_engine import DataParallelEngine
+        engine = DataParallelEngine(**config.__dict__)
+    setup_s = time.perf_counter() - start
+    timer = StageTimer(engine)
+    from sandbox.policy import POLICY_REPO
+    cpu, wall = time.process_time(), time.perf_counter()
+    engine.run_policy(POLICY_REPO[0], 0)
+    wall = time.perf_counter() - wall
+    requests = sum(s["requests"] for s in timer.stats.values())
+    generate_s = sum(s["generate_s"] for s in timer.stats.values())
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    queue.put({
+        "size": size,
+        "days": days,
+        "setup_s": setup_s,
+        "wall_s": wall,
+        "cpu_s": time.process_time() - cpu,
+        "worker_cpu_s": sum(s["worker_cpu_s"] for s in timer.stats.values()),
+        "generate_s": generate_s,
+        "requests": requests,
+        "req_per_s": requests / generate_s if generate_s > 0 else 0.0,
+        "agent_days_per_s": size * (days + args["warmup_days"]) / wall,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, # KiB on Linux
+        "worker_peak_rss_mb": children.ru_maxrss / 1024,
+        "bytes_written": dir_size(save_dir),
+        "stages": timer.stats,
+    })
+
+def run_isolated(size, days, args):
+    """One configuration per spawned process, so its peak RSS and imports are its own."""
+    ctx = mp.get_context("spawn")
+    queue = ctx.Queue()
+    process = ctx.Process(target=run_config, args=(size, days, args, queue))
+    process.start()
+    result = queue.get() # before join, a full queue would block the child
+    process.join()
+    return result
+
+def compare(results, baseline, threshold, min_seconds):
+    """Relative changes of every metric against the baseline, and the ones that regressed by more than threshold."""
+    regressions = []
+    old_by_key = {(r["size"], r["days"]): r for r in baseline["results"]}
+    for new in results:
+        old = old_by_key.get((new["size"], new["days"]))
+        if old is None:
+            continue
+        pairs = [(k, old.get(k), new.get(k)) for k in LOWER_IS_BETTER + HIGHER_IS_BETTER]
+        for stage, stats in new["stages"].items():
+            old_stats = old["stages"].get(stage, {})
+            pairs.extend((f"{stage}.{k}", old_stats.get(k), stats.get(k)) for k in ["wall_s", "cpu_s"])
+        for metric, before, after in pairs:
+            if before is None or after is None or before <= 0:
+                continue
+            if metric.endswith("_s") and max(before, after) < min_seconds:
+                continue # too short to time reliably
+            change = (after - before) / before
+            worse = -change if metric in HIGHER_IS_BETTER else change
+            if worse > threshold:
+                regressions.append({"size": new["size"], "days": new["days"], "metric": metric, "baseline": before, "current": after, "change": change})
+    return regressions
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, default=[100, 1000, 10000], nargs="+", help="Numbers of agents")
+    parser.add_argument("--days", type=int, default=[2], nargs="+", help="Run days of every configuration")
+    parser.add_argument("--warmup_days", type=int, default=1)
+    parser.add_argument("--engine", type=str, default="data_parallel", choices=["data_parallel", "async"])
+    parser.add_argument("--processes", type=int, default=4, help="Simulated servers (worker processes) of DataParallelEngine")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--fake_latency_ms", type=float, default=0.0)
+    parser.add_argument("--fake_latency_dist", type=str, default="constant", choices=["constant", "uniform", "exponential", "lognormal"])
+    parser.add_argument("--fake_error_rate", type=float, default=0.0)
+    parser.add_argument("--fake_rate_limit_rate", type=float, default=0.0)
+    parser.add_argument("--work_dir", type=str, default=None, help="Run directories, a temporary directory by default")
+    parser.add_argument("--data_dir", type=str, default=None, help="Cache of the generated populations, work_dir by default")
+    parser.add_argument("--output", type=str, default=None, help="Write the results as JSON")
+    parser.add_argument("--baseline", type=str, default=None, help="JSON results of an earlier run to compare with")
+    parser.add_argument("--threshold", type=float, default=0.2, help="Relative regression that fails the comparison")
+    parser.add_argument("--min_seconds", type=float, default=0.5, help="Timings below this in both runs are not compared")
+    args = parser.parse_args()
+    args.work_dir = args.work_dir or tempfile.mkdtemp(prefix="vacsim-bench-")
+    args.data_dir = args.data_dir or args.work_dir
+    os.makedirs(args.data_dir, exist_ok=True)
+
+    results = []
+    for size in args.sizes:
+        for days in args.days:
+            print(f"Running {size} agents for {args.warmup_days}+{days} days")
+            result = run_isolated(size, days, vars(args))
+            results.append(result)
+            print(f"  wall {result['wall_s']:.2f}s, cpu {result['cpu_s']:.2f}s (+{result['worker_cpu_s']:.2f}s in workers), "
+                  f"peak RSS {result['peak_rss_mb']:.0f}MB, {result['bytes_written'] / 2**20:.1f}MB written, {result['req_per_s']:.0f} req/s")
+            for stage, stats in result["stages"].items():
+                print(f"    {stage:<30} wall {stats['wall_s']:8.2f}s  cpu {stats['cpu_s']:8.2f}s  generate {stats['generate_s']:8.2f}s  {stats['requests']} requests")
+    output = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "args": {k: v for k, v in vars(args).items() if k not in ["output", "baseline", "work_dir", "data_dir"]},
+        "results": results,
+    }
+    if args.baseline is not None:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+        output["baseline_commit"] = baseline.get("commit")
+        output["regressions"] = compare(results, baseline, args.threshold, args.min_seconds)
+        for r in output["regressions"]:
+            print(f"Regression at {r['size']} agents, {r['days']} days: {r['metric']} {r['baseline']:.3f} -> {r['current']:.3f} ({r['change']:+.0%})")
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(output, f, indent=4)
+    if output.get("regressions"):
+        sys.exit(1)
@@ -0,0 +1,88 @@
+# This file benchmarks the daily epidemic step of the simulation on its own, without any LLM
+# Usage (from the repository root): python benchmarks/epidemic.py [--sizes 1000 100000 1000000] [--degree 10] [--days 30] [--max_ms 1000]
+# For every population size and mixing, it builds a random follow network and an A_SIRV model, then times what
+# Engine.spread_disease does each day: vaccination decisions from attitudes, one day of transmission, and mirroring
+# the disease state and the infected share among followees into the Population the prompts read.
+import argparse
+import json
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "src"))
+
+import numpy as np
+from sandbox.disease_model import FDModel
+from sandbox.population import Population
+from sandbox.social_network import SocialNetwork
+from sandbox.transmission_model import A_SIRV, COMPARTMENTS, MIXINGS
+
+VACCINATION_RATES = (0.0, 0.0, 0.0, 0.02, 0.1) # by attitude, 0 means not polled yet
+
+def random_network(size, degree, rng):
+    """Every agent follows about degree others, drawn uniformly, without self-follows."""
+    degrees = rng.poisson(degree, size).clip(0, size - 1)
+    src = np.repeat(np.arange(size), degrees)
+    dst = rng.integers(0, size - 1, len(src))
+    dst = dst + (dst >= src)
+    return SocialNetwork(size, src, dst)
+
+def run_config(size, degree, mixing, days, seed):
+    rng = np.random.default_rng(seed)
+    start = time.perf_counter()
+    network = random_network(size, degree, rng)
+    network_s = time.perf_counter() - start
+    population = Population(size, network=network)
+    population.record_poll(rng.integers(1, 5, size), np.full((size, 4), 0.25), [""] * size)
+    attitudes = population.latest_attitudes()
+    start = time.perf_counter()
+    model = A_SIRV(size, FDModel(risk_data_path=None), network=network, mixing=mixing, seed=seed, num_days=days)
+    build_s = time.perf_counter() - start
+    day_times = []
+    for _ in range(days):
+        start = time.perf_counter()
+        vaccinate = model.decide_vaccination(np.array(VACCINATION_RATES)[attitudes])
+        model.run_a_day(vaccinate=vaccinate)
+        population.set_disease(model.state, model.vaccinated, model.infected_share())
+        day_times.append(time.perf_counter() - start)
+    day_ms = 1000 * np.array(day_times)
+    return {
+        "size": size,
+        "edges": network.num_edges,
+        "mixing": mixing,
+        "network_s": network_s,
+        "build_s": build_s,
+        "day_ms_mean": float(day_ms.mean()),
+        "day_ms_p50": float(np.median(day_ms)),
+        "day_ms_max": float(day_ms.max()),
+        "peak_infected": int(model.history[:, COMPARTMENTS.index("Infected")].max()),
+        "final_counts": dict(zip(COMPARTMENTS, model.history[-1].tolist())),
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, default=[1000, 100000, 1000000], nargs="+", help="Numbers of agents")
+    parser.add_argument("--degree", type=float, default=10, help="Mean number of followees per agent")
+    parser.add_argument("--mixings", type=str, default=MIXINGS, nargs="+", choices=MIXINGS)
+    parser.add_argument("--days", type=int, default=30)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", type=str, default=None, help="Write the results as JSON")
+    parser.add_argument("--max_ms", type=float, default=None, help="Fail when the mean day of a configuration exceeds this")
+    args = parser.parse_args()
+
+    results = []
+    for size in args.sizes:
+        for mixing in args.mixings:
+            result = run_config(size, args.degree, mixing, args.days, args.seed)
+            results.append(result)
+            print(f"size={size} edges={result['edges']} mixing={mixing}: build {result['build_s']:.2f}s, "
+                  f"day mean {result['day_ms_mean']:.1f}ms p50 {result['day_ms_p50']:.1f}ms max {result['day_ms_max']:.1f}ms, "
+                  f"peak infected {result['peak_infected']}, final {result['final_counts']}")
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
+    slow = [f"size={r['size']} mixing={r['mixing']}" for r in results if args.max_ms is not None and r["day_ms_mean"] > args.max_ms]
+    if slow:
+        print(f"Slower than {args.max_ms}ms per day: {slow}")
+        sys.exit(1)
@@ -0,0 +1,62 @@
+# This file benchmarks the startup cost of the driver and of the generation workers
+# Usage (from the repository root): python benchmarks/startup.py [--repeats 5] [--processes 4] [--max_seconds 1.0]
+# It reports the wall time of `python src/driver.py --help`, of importing the engines in a fresh interpreter,
+# and of spawning a DataParallelEngine worker pool until every worker has answered, plus the heavy modules each of them loaded
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SRC = os.path.join(ROOT, "src")
+HEAVY_MODULES = ["torch", "transformers", "sentence_transformers", "sklearn", "openai", "anthropic", "backoff", "matplotlib", "pandas"]
+
+def loaded_heavy_modules(_=None):
+    return [m for m in HEAVY_MODULES if m in sys.modules]
+
+def time_command(cmd, repeats):
+    env = dict(os.environ, PYTHONPATH=SRC)
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        subprocess.run(cmd, cwd=ROOT, env=env, check=True, stdout=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return min(times), sorted(times)[len(times) // 2]
+
+def time_worker_spawn(processes, repeats):
+    import multiprocessing as mp
+    sys.path.insert(0, SRC)
+    from engines import worker
+    client = worker.GenerationClient("meta-llama/Meta-Llama-3.1-8B-Instruct")
+    times, modules = [], []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        with mp.get_context("spawn").Pool(processes=processes, initializer=worker.init_worker, initargs=(client,)) as pool:
+            modules = pool.map(loaded_heavy_modules, range(processes), chunksize=1)
+            times.append(time.perf_counter() - start)
+    return min(times), sorted(times)[len(times) // 2], sorted(set(m for ms in modules for m in ms))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--processes", type=int, default=4, help="Workers in the spawned pool")
+    parser.add_argument("--max_seconds", type=float, default=1.0, help="Fail when a median exceeds this")
+    parser.add_argument("--output", type=str, default=None, help="Write the results as JSON")
+    args = parser.parse_args()
+
+    results = {}
+    results["driver_help_min"], results["driver_help_median"] = time_command([sys.executable, "src/driver.py", "--help"], args.repeats)
+    import_cmd = [sys.executable, "-c", "import engines.multi_engine, engines.async_engine, utils.eval_suite"]
+    results["engine_import_min"], results["engine_import_median"] = time_command(import_cmd, args.repeats)
+    results["worker_spawn_min"], results["worker_spawn_median"], results["worker_heavy_modules"] = time_worker_spawn(args.processes, args.repeats)
+    for key, value in results.items():
+        print(f"{key}: {value:.3f}s" if isinstance(value, float) else f"{key}: {value}")
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
+    slow = [key for key in ["driver_help_median", "worker_spawn_median"] if results[key] > args.max_seconds]
+    if slow:
+        print(f"Slower than {args.max_seconds}s: {slow}")
+        sys.exit(1)
@@ -2,13 +2,29 @@ import argparse
 from datetime import datetime
 import os
 # from utils.evals import *
-from utils.eval_suite import EvalSuite
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("exp", type=int, help="Experiment mode")
     parser.add_argument("--model_type", type=str, default="meta-llama/Meta-Llama-3.1-8B-Instruct")
     parser.add_argument("--ports", type=int, default=7000, nargs="+")
+    parser.add_argument("--endpoints", type=str, default=None, nargs="+", help="vLLM servers as host:port[:weight], possibly on several nodes; replaces --ports")
+    parser.add_argument("--endpoints_file", type=str, default=None, help="File with one host:port[:weight] per line; replaces --ports and --endpoints")
+    parser.add_argument("--transmission_mixing", type=str, default="network", choices=["network", "well_mixed"], help="Spread the disease over the follow edges of the social network, or between all agents")
+    parser.add_argument("--initial_infected_rate", type=float, default=0.02, help="Fraction of agents infected at the start of the warm-up")
+    parser.add_argument("--vaccination_rates", type=float, nargs=4, default=[0.0, 0.0, 0.02, 0.1], help="Daily probability that an unvaccinated agent with attitude 1, 2, 3 or 4 gets vaccinated")
+    parser.add_argument("--profile", type=str, default=None, choices=["sampling", "cprofile", "both"], help="Profile the hot phases of every day: sampled stacks (collapsed, for flamegraphs), per-phase cProfile dumps, or both")
+    parser.add_argument("--profile_phases", type=str, default=None, nargs="+", choices=["recommendation", "prompt", "dispatch", "save"], help="Phases to profile, all by default")
+    parser.add_argument("--profile_memory", action="store_true", help="With --profile, write the tracemalloc growth of every day")
+    parser.add_argument("--metrics_port", type=int, default=None, help="Serve the run metrics in the Prometheus text format on this port")
+    parser.add_argument("--engine", type=str, default="auto", choices=["auto", "data_parallel", "async"], help="auto uses AsyncDataParallelEngine for hosted APIs and DataParallelEngine otherwise")
+    # --model_type fake answers in-process, fake/http talks to `python -m engines.fake_backend` servers at --ports/--endpoints
+    parser.add_argument("--fake_latency_ms", type=float, default=0.0, help="Mean latency of a fake request")
+    parser.add_argument("--fake_latency_dist", type=str, default="constant", choices=["constant", "uniform", "exponential", "lognormal"])
+    parser.add_argument("--fake_token_latency_ms", type=float, default=0.0, help="Fake decode time per completion token")
+    parser.add_argument("--fake_error_rate", type=float, default=0.0, help="Fraction of fake requests that fail with a server error")
+    parser.add_argument("--fake_rate_limit_rate", type=float, default=0.0, help="Fraction of fake requests rejected with a rate limit")
+    parser.add_argument("--fake_completion_tokens", type=int, default=None, help="Pad every fake completion to about this many tokens")
 
     parser.add_argument("--warmup_days", type=int, default=0)
     parser.add_argument("--run_days", type=int, default=3)
@@ -16,6 +32,20 @@ if __name__ == "__main__":
     parser.add_argument('--alphas', type=float, default=None, nargs="+", help="List of alphas to use in the experiment")
 
     parser.add_argument("--disease", type=str, default="FD-24")
+    parser.add_argument("--prompt_layout", type=str, default="default", choices=["default", "prefix_cache"], help="prefix_cache puts the population-invariant system prompt first so vLLM prefix caching can reuse it")
+    parser.add_argument("--prefix_stats", action="store_true", help="Write the shared prompt prefix of every stage to prompt_prefix.tsv, always on with --prompt_layout prefix_cache")
+    parser.add_argument("--conversation_mode", type=str, default="independent", choices=["independent", "session"], help="session sends the stages of an agent's day as one growing chat so servers can reuse earlier turns")
+    parser.add_argument("--no_guided_decoding", action="store_true", help="Do not send JSON schemas (guided_json) for the attitude and lesson stages")
+    parser.add_argument("--unguided_summary", type=str, default=None, help="simulation_summary.json of a --no_guided_decoding run, to report the parse retries guided decoding avoided")
+    parser.add_argument("--no_adaptive_max_tokens", action="store_true", help="Always use the static max_tokens of every stage")
+    parser.add_argument("--dedup_requests", action="store_true", help="Send agents with identical messages in a stage as one request with n completions")
+    parser.add_argument("--attitude_samples", type=int, default=1, help="Number of completions per agent and attitude poll, requested in one call")
+    parser.add_argument("--attitude_aggregation", type=str, default="mean", choices=["mean", "ensemble"], help="How the sampled attitude distributions are combined: mean or ensemble (logarithmic pooling)")
+    parser.add_argument("--news_token_budget", type=int, default=None, help="Truncate every news article in a prompt to this many tokens")
+    parser.add_argument("--tweet_token_budget", type=int, default=None, help="Truncate every recommended tweet in a prompt to this many tokens")
+    parser.add_argument("--reflection_token_budget", type=int, default=None, help="Token budget of the lesson section of the system prompt")
+    parser.add_argument("--count_prompt_tokens", action="store_true", help="Count the prompt tokens in token_usage with the model's tokenizer instead of taking the ones the servers report, always on with a token budget")
+    parser.add_argument("--lesson_capacity", type=int, default=50, help="Lessons kept per agent, 0 keeps all of them")
     
     parser.add_argument("--seed_list", type=int, default=[2621, 2749, 2909, 3083, 3259], nargs="+")
 
@@ -25,6 +55,8 @@ if __name__ == "__main__":
     parser.add_argument("--news_path", type=str, default="data/news/COVID-news-total-k=10000.pkl")
 
     parser.add_argument("--batch_size", type=int, default=25)
+    parser.add_argument("--no_share_warmup", action="store_true", help="Run the warm-up of every run instead of once per seed for all policies")
+    parser.add_argument("--concurrent_runs", type=int, default=1, help="Number of (variable, seed) runs of a sweep that run at the same time against the same servers")
     parser.add_argument("--save_dir", type=str, default="save_dir")
     
     parser.add_argument("--temperature_list", type=float, default=[1.0, 0.1, 0.5, 0.7, 1.5, 2.0], nargs="+")
@@ -35,6 +67,11 @@ if __name__ == "__main__":
 
 
     args = parser.parse_args()
+    # imported after parsing, so --help and spawned workers (which re-import this module) skip the engines
+    from utils.eval_suite import EvalSuite
+    if args.metrics_port is not None:
+        from utils.metrics import start_http_server
+        start_http_server(args.metrics_port)
 
     model_str = args.model_type.split("/")[-1]
 
@@ -0,0 +1,72 @@
+# This file contains the read-only data of a simulation: profiles, social network, news, risk data and the sentence encoder
+# They are loaded once, on first use, and shared by every run of a sweep (and by the engines of concurrent runs);
+# everything a run changes (population, lessons, recommenders' indices, RNGs) is rebuilt from them by BackboneEngine.reset
+import pickle
+import threading
+from sandbox.disease_model import NAME_TO_MODEL
+from sandbox.social_network import SocialNetwork
+from engines.fake_backend import FAKE_ENCODER_NAME, HashingEncoder
+
+ENCODER_NAME = "paraphrase-MiniLM-L6-v2"
+
+class SimulationAssets:
+    def __init__(self, profile_str, network_str, disease="FD-24", risk_data_path=None, warmup_days=0, encoder_name=ENCODER_NAME):
+        '''
+        :param profile_str: path to the pickled agent profiles
+        :param network_str: path to the social network, see SocialNetwork.load
+        :param disease: name of the disease, substituted into the news and used to pick the disease model
+        :param encoder_name: SentenceTransformer of the recommenders, or FAKE_ENCODER_NAME for a hashing encoder
+        '''
+        self.profile_str = profile_str
+        self.network_str = network_str
+        self.disease = disease
+        self.risk_data_path = risk_data_path
+        self.warmup_days = warmup_days
+        self.encoder_name = encoder_name
+        self.cache = {}
+        self.lock = threading.Lock() # concurrent runs may ask for an asset that is not loaded yet
+
+    def get(self, key, load):
+        with self.lock:
+            if key not in self.cache:
+                self.cache[key] = load()
+            return self.cache[key]
+
+    def matches(self, profile_str, network_str, disease, risk_data_path, warmup_days, encoder_name=ENCODER_NAME):
+        return (self.profile_str, self.network_str, self.disease, self.risk_data_path, self.warmup_days, self.encoder_name) == (profile_str, network_str, disease, risk_data_path, warmup_days, encoder_name)
+
+    @property
+    def profiles(self):
+        """A list of profile dictionaries, one per agent."""
+        def load():
+            with open(self.profile_str, "rb") as f:
+                return list(pickle.load(f))
+        return self.get("profiles", load)
+
+    @property
+    def social_network(self):
+        return self.get("social_network", lambda: SocialNetwork.load(self.network_str))
+
+    @property
+    def disease_model(self):
+        return self.get("disease_model", lambda: NAME_TO_MODEL[self.disease](risk_data_path=self.risk_data_path, warmup_days=self.warmup_days))
+
+    @property
+    def encoder(self):
+        """The sentence encoder of the tweet and news recommenders."""
+        def load():
+            if self.encoder_name == FAKE_ENCODER_NAME:
+                return HashingEncoder()
+            from sentence_transformers import SentenceTransformer # imported here, it pulls in torch
+            return SentenceTransformer(self.encoder_name, device="cpu")
+        return self.get("encoder", load)
+
+    def news(self, news_path):
+        """The articles of news_path with COVID replaced by the disease name."""
+        def load():
+            with open(news_path, "rb") as f:
+                news = pickle.load(f)
+            for item in news:
+                item.text = item.text.replace("COVID-19", self.disease).replace("covid-19", self.disease).replace("Covid-19", self.disease).replace("COVID", self.disease).replace("covid", self.disease).replace("Covid", self.disease)
+            return news
+        return self.get(("news", news_path), load)
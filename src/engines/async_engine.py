@@ -3,24 +3,33 @@ import aiohttp
 from engines.engine import Engine
 import os
 import time
-from openai import AzureOpenAI, OpenAI
-from anthropic import Anthropic
-from utils.utils import clean_response, parse_lessons
+from engines.generation import GenerationOutput, completion_share
+from engines.endpoints import EndpointRegistry
+from engines.fake_backend import FakeBackend, fake_mode, RETRY_AFTER
 
 class AsyncDataParallelEngine(Engine):
-    def __init__(self, ports=None, batch_size=25, max_iter=5, delay=5, *args, **kwargs):
+    def __init__(self, ports=None, batch_size=25, max_iter=5, delay=5, endpoints=None, endpoints_file=None, *args, **kwargs):
+        """
+        :param ports, endpoints, endpoints_file: OpenAI-compatible servers (vLLM or the fake stub) of models that are not hosted APIs,
+            agents are spread over them as in DataParallelEngine, but without health checks
+        """
         super().__init__(*args, **kwargs)
         self.batch_size = batch_size
         self.delay = delay  # Add delay to control the rate of requests
         self.max_iter = max_iter  # Max retries for parsing responses
         self.max_retries = 7  # Max retries for a single request
-        self.init_client()
+        self.fake = None # in-process FakeBackend of --model_type fake
+        self.endpoints = None # servers of OpenAI-compatible models
+        self.guided_rejected = False # a server rejected a guided JSON schema, stop sending them
+        self.init_client(ports, endpoints, endpoints_file)
 
-    def init_client(self):
+    def init_client(self, ports=None, endpoints=None, endpoints_file=None):
         if "claude" in self.model_type:
+            from anthropic import Anthropic
             self.client = Anthropic(api_key=os.getenv("ANTHROPIC_API_KEY"))
             self.azure_deployment = False
         elif "gpt" in self.model_type:
+            from openai import AzureOpenAI, OpenAI
             if os.getenv("AZURE_OPENAI_API_KEY") and os.getenv("AZURE_OPENAI_ENDPOINT"):
                 api_version = "2023-05-15"
                 self.client = AzureOpenAI(
@@ -40,19 +49,42 @@ class AsyncDataParallelEngine(Engine):
             self.model = AutoModelForCausalLM.from_pretrained(self.model_type)
             device = "cuda" if torch.cuda.is_available() else "cpu"
             self.model.to(device)
+            torch.manual_seed(self.seed) # set_seed ran before torch was imported
+            self.client = None
+            self.azure_deployment = False
+        elif fake_mode(self.model_type) == "local":
+            self.fake = FakeBackend(**self.fake_config)
             self.client = None
             self.azure_deployment = False
         else:
-            raise ValueError("Unsupported model type")
+            # any other model is served by OpenAI-compatible servers, e.g. vLLM or `python -m engines.fake_backend` for fake/http
+            self.endpoints = EndpointRegistry.from_config(ports=ports, endpoints=endpoints, endpoints_file=endpoints_file)
+            self.client = None
+            self.azure_deployment = False
 
-    async def async_request_generate(self, session, prompt, max_tokens=80, gen_seed=None):
+    async def async_request_generate(self, session, prompt, max_tokens=80, gen_seed=None, stop=None, n=1, endpoint=None, guided_json=None):
         """
-        Asynchronously generate text from remote APIs or local Hugging Face models.
+        Asynchronously generate text from remote APIs, OpenAI-compatible servers, local Hugging Face models or the fake backend.
+        :param endpoint: base URL of the server of this request, for models that are not hosted APIs
+        :return: list of GenerationOutput, n choices for OpenAI-compatible models and one otherwise
         """
         retry_attempts = 0
+        guided_fallback = False
 
         while retry_attempts < self.max_retries:
             try:
+                if self.fake is not None:
+                    response = self.fake.respond(prompt, max_tokens, gen_seed, n, guided_json, stop)
+                    await asyncio.sleep(response.latency)
+                    if response.status == 429:
+                        retry_attempts += 1
+                        await asyncio.sleep(RETRY_AFTER)
+                        continue
+                    elif response.status >= 400:
+                        raise Exception(f"Fake backend error {response.status}")
+                    return self.fake.outputs(response, n, guided=guided_json is not None)
+
+
                 if "gemma" in self.model_type:
                     from torch import no_grad
 
@@ -70,9 +102,10 @@ class AsyncDataParallelEngine(Engine):
                                 temperature=0.7,
                             )
                         generated = output[0][inputs.shape[-1]:]
-                        return self.tokenizer.decode(generated, skip_special_tokens=True)
+                        finish_reason = "length" if len(generated) >= max_tokens else "stop"
+                        return GenerationOutput(self.tokenizer.decode(generated, skip_special_tokens=True), int(inputs.shape[-1]), len(generated), finish_reason)
 
-                    return await asyncio.to_thread(_sync_generate)
+                    return [await asyncio.to_thread(_sync_generate)]
 
                 if "claude" in self.model_type:
                     base_url = "https://api.anthropic.com/v1/messages"
@@ -84,12 +117,18 @@ class AsyncDataParallelEngine(Engine):
                     json_data = {
                         "model": self.model_type,
                         "system": prompt[0]['content'],
-                        "messages": [prompt[1]],
+                        "messages": prompt[1:],
                         "max_tokens": max_tokens,
                         "temperature": 0.7
                     }
+                    stop_sequences = [s for s in stop if s.strip()] if stop else None # whitespace-only stop sequences are rejected
+                    if stop_sequences:
+                        json_data["stop_sequences"] = stop_sequences
                 else:
-                    if getattr(self, "azure_deployment", False):
+                    if endpoint is not None:
+                        base_url = f"{endpoint}/v1/chat/completions"
+                        headers = {"Content-Type": "application/json"}
+                    elif getattr(self, "azure_deployment", False):
                         base_url = f"{os.getenv('AZURE_OPENAI_ENDPOINT')}/openai/deployments/{self.model_type}/chat/completions?api-version={self.client._api_version}"
                         headers = {
                             "api-key": self.client.api_key,
@@ -108,6 +147,12 @@ class AsyncDataParallelEngine(Engine):
                         "seed": gen_seed,
                         "temperature": 0.7
                     }
+                    if n > 1:
+                        json_data["n"] = n
+                    if stop:
+                        json_data["stop"] = stop
+                    if guided_json is not None and endpoint is not None and not self.guided_rejected:
+                        json_data["guided_json"] = guided_json
 
                 async with session.post(base_url, headers=headers, json=json_data) as response:
                     if response.status == 429:  # Rate limit error
@@ -115,107 +160,70 @@ class AsyncDataParallelEngine(Engine):
                         retry_after = int(response.headers.get("Retry-After", 35))
                         await asyncio.sleep(retry_after)
                         continue
+                    elif response.status == 400 and "guided_json" in json_data:
+                        # the server does not support guided decoding, resend once without the schema
+                        print(f"Guided decoding rejected by the server: {await response.text()}")
+                        guided_fallback = True
+                        self.guided_rejected = True
+                        continue
+                    elif response.status == 400:
+                        # the same payload would be rejected again
+                        print(f"Request rejected by the server: {await response.text()}")
+                        return [GenerationOutput() for _ in range(n)]
                     elif response.status >= 400:
                         raise Exception(f"HTTP error {response.status}: {await response.text()}")
 
                     completion = await response.json()
-                    return completion['choices'][0]['message']['content'] if "claude" not in self.model_type else completion['content'][0]['text']
+                    usage = completion.get('usage', {})
+                    if "claude" in self.model_type:
+                        return [GenerationOutput(completion['content'][0]['text'], usage.get('input_tokens', 0), usage.get('output_tokens', 0), completion.get('stop_reason'))]
+                    choices = completion['choices']
+                    # the prompt of a request is billed once, on its first choice
+                    return [GenerationOutput(
+                        choice['message']['content'],
+                        usage.get('prompt_tokens', 0) if i == 0 else 0,
+                        completion_share(usage.get('completion_tokens', 0), len(choices), i),
+                        choice.get('finish_reason'),
+                        guided="guided_json" in json_data,
+                        guided_fallback=guided_fallback,
+                        shared=i > 0
+                    ) for i, choice in enumerate(choices)]
             except Exception as e:
                 retry_attempts += 1
                 if retry_attempts >= self.max_retries:
                     print(f"Request failed after {self.max_retries} retries: {e}")
-                    return None
-
-    async def async_request_generate_lesson(self, session, prompt,  max_tokens=80, day=None, gen_seed=None):
-        """
-        Generate lessons from prompts with retry logic for parsing.
-        """
-        num_iter = 0
-        while num_iter < self.max_iter:
-            response = await self.async_request_generate(session, prompt,  max_tokens, gen_seed)
-            try:
-                new_lessons = parse_lessons(response, day=day)
-                return new_lessons
-            except Exception as e:
-                num_iter += 1
-                print(f"Error in parsing lessons: {e}, retrying...")
-                print(f"Response: {response}")
-
-        print(f"Failed to parse lessons after {self.max_iter} attempts.")
-        return []
-
-    async def async_request_generate_attitude(self, session, prompt, max_tokens=80, day=None, gen_seed=None):
-        """
-        Generate attitudes from prompts with retry logic for parsing.
-        """
-        num_iter = 0
-        success = False
-        while num_iter < self.max_iter and not success:
-            response = await self.async_request_generate(session, prompt, max_tokens, gen_seed)
-            attitude_json, success = self.parse_attitude(response)
-            num_iter += 1
-            if not success:
-                print(f"Error in parsing attitudes: {attitude_json}, retrying...")
-        if not success:
-            print(f"Failed to parse attitudes after {self.max_iter} attempts.")
-
-        return attitude_json
-
-    async def async_request_generate_actions(self, session, prompt, max_tokens=80, day=None, gen_seed=None):
-        """
-        Generate actions from prompts with retry logic for parsing.
-        """
-        num_iter = 0
-        while num_iter < self.max_iter:
-            response = await self.async_request_generate(session, prompt, max_tokens, gen_seed)
-            try:
-                action = clean_response(response)
-                if len(action) > 2:
-                    return action
-            except Exception as e:
-                num_iter += 1
-                print(f"Error in parsing actions: {e}, retrying...")
-                print(f"Response: {response}")
-
-        print(f"Failed to parse actions after {self.max_iter} attempts.")
-        return ""
-    
-    def chunkify(self, lst, n):
-        """Split list into chunks of size n."""
-        for i in range(0, len(lst), n):
-            yield lst[i:i + n]
-    
-    async def async_generate(self, max_tokens, day, f):
-        """
-        Asynchronous generate function to handle batches with retry logic.
-        """
-        print(f"Stage: {self.stage}, async generation started")
-        start = time.time()
-        func_call_dic = {
-            "generate": self.async_request_generate,
-            "generate_attitude": self.async_request_generate_attitude,
-            "generate_actions": self.async_request_generate_actions,
-            "generate_lessons": self.async_request_generate_lesson
-        }
-
-        results = []
-        batch_inputs = list(self.chunkify(self.context, self.batch_size))
+                    return [GenerationOutput() for _ in range(n)]
+        return [GenerationOutput() for _ in range(n)]
+
+    async def timed_request_generate(self, *args, **kwargs):
+        """async_request_generate, with its latency on the outputs and counted in the in-flight gauge."""
+        self.metrics.add("inflight_requests", 1, help="Requests sent and not answered yet")
+        start = time.perf_counter()
+        try:
+            outputs = await self.async_request_generate(*args, **kwargs)
+        finally:
+            self.metrics.add("inflight_requests", -1)
+        latency = time.perf_counter() - start
+        for output in outputs:
+            output.latency = latency
+        return outputs
+
+    async def async_dispatch(self, messages, ids, seeds, max_tokens, guided_json=None, stop=None, n=None):
+        n = [1] * len(messages) if n is None else n
         async with aiohttp.ClientSession() as session:
             tasks = []
-            for i, batch in enumerate(batch_inputs):
-                generation_seeds = [int(s) for s in self.rng.integers(0, 10000, size=len(batch))]
-                for prompt, seed in zip(batch, generation_seeds):
-                    tasks.append(func_call_dic[f](session, prompt, max_tokens, day=day, gen_seed=seed))
-
-            responses = await asyncio.gather(*tasks)
-            results.extend(responses)
-
-        end = time.time()
-        print(f"Stage: {self.stage}, generation finished in {end - start:.2f} seconds")
-        return results
+            for prompt, k, seed, num in zip(messages, ids, seeds, n):
+                if "claude" in self.model_type or "gemma" in self.model_type:
+                    # no n parameter, one request per completion
+                    tasks.extend(self.timed_request_generate(session, prompt, max_tokens, gen_seed=seed, stop=stop) for _ in range(num))
+                else:
+                    endpoint = self.endpoints.endpoint_for(k).url if self.endpoints is not None else None
+                    tasks.append(self.timed_request_generate(session, prompt, max_tokens, gen_seed=seed, stop=stop, n=num, endpoint=endpoint, guided_json=guided_json))
+            outputs = await asyncio.gather(*tasks)
+        return [output for choices in outputs for output in choices]
 
-    def generate(self, max_tokens, day, f):
+    def _dispatch(self, messages, ids, seeds, max_tokens, guided_json=None, stop=None, n=None):
         """
-        Wrapper for async_generate to be called synchronously.
+        Send all requests of a wave concurrently.
         """
-        return asyncio.run(self.async_generate(max_tokens, day, f))
+        return asyncio.run(self.async_dispatch(messages, ids, seeds, max_tokens, guided_json=guided_json, stop=stop, n=n))
@@ -1,24 +1,81 @@
 # This file contains the abstract backbone engine of the simulation
 # It is useful for providing a concise overview of the simulation, i.e. see the run method
 # It contains general methods such as message updates, saving, loading, etc.
-import transformers
-import torch
 import numpy as np
+import random
+import sys
 import re
+import copy
 from functools import partial
 import json
 from datetime import datetime
 from tqdm import trange
-from sandbox.prompts import system_prompt
-from sandbox.disease_model import NAME_TO_MODEL
-# from sandbox.transmission_model import A_SIRV
+from sandbox.prompts import SystemPromptBuilder, ATTITUDE_SCHEMA, LESSON_SCHEMA
+from engines.generation import TRUNCATED_FINISH_REASONS
+from utils.token_utils import count_tokens, count_tokens_batch, shared_prefix, flatten_messages, TokenAccountant
+from utils.utils import ATTITUDE_AGGREGATIONS
+from engines.assets import SimulationAssets, ENCODER_NAME
+from engines.fake_backend import FAKE_ENCODER_NAME, fake_mode
+from utils import metrics
+from utils.profiling import RunProfiler
+from contextlib import nullcontext
+import itertools
+from sandbox.transmission_model import A_SIRV
 import os
-import pickle
 from recommenders.tweet_recommender import TweetRecommender
 from recommenders.news_recommender import NewsRecommender
 from sandbox.agent import Agent
+from sandbox.population import Population
+from utils.network_utils import HomophilyTracker
 import logging
 
+GUIDED_SCHEMAS = {
+    "generate_attitude": ATTITUDE_SCHEMA,
+    "generate_lessons": LESSON_SCHEMA
+}
+
+# stop generating once the output is complete: the closing bracket of the JSON, or the end of the first tweet
+# stages sent with a guided schema get no stop, the schema already ends the JSON and a bracket inside a string would cut it
+STAGE_STOPS = {
+    "generate_attitude": ["}"],
+    "generate_lessons": ["]]"],
+    "generate_actions": ["\n\n", "\n* "]
+}
+# stages whose stop sequence closes a JSON value, which is closed again after the server dropped the matched stop string
+JSON_STAGES = ["generate_attitude", "generate_lessons"]
+CLOSING_BRACKETS = {"{": "}", "[": "]"}
+
+def close_brackets(text):
+    """Append the closing brackets of every bracket left open outside a JSON string, innermost first."""
+    stack = []
+    in_string = escaped = False
+    for c in text:
+        if in_string:
+            if escaped:
+                escaped = False
+            elif c == "\\":
+                escaped = True
+            elif c == '"':
+                in_string = False
+        elif c == '"':
+            in_string = True
+        elif c in CLOSING_BRACKETS:
+            stack.append(CLOSING_BRACKETS[c])
+        elif stack and c == stack[-1]:
+            stack.pop()
+    if in_string or not stack:
+        return text # a stop inside a string cannot be repaired, the output fails to parse and is retried
+    return text.rstrip() + "".join(reversed(stack))
+
+# attributes of the engine itself or of the current run rather than of the simulated state, a restored warm-up keeps them as they are
+SNAPSHOT_EXCLUDE = ["assets", "logger", "run_id", "run_save_dir", "curr_policy_head", "pool", "client", "model", "tokenizer", "warmup_snapshot", "metrics", "engine_id", "profiler"]
+ENGINE_IDS = itertools.count() # label of the metrics of every engine in this process
+# run files that belong to the current run, not to the warm-up
+SNAPSHOT_SKIP_FILES = ["run_config.json", "engine.log"]
+
+def is_number(v):
+    return isinstance(v, (int, float)) and not isinstance(v, bool)
+
 class BackboneEngine:
     def __init__(
         self, 
@@ -36,6 +93,34 @@ class BackboneEngine:
         seed = 42,
         temperature=1.0,
         alpha=0.3, # following bias
+        incremental_homophily=True,
+        lesson_capacity=50,
+        prompt_layout="default",
+        prefix_stats=False,
+        news_token_budget=None,
+        tweet_token_budget=None,
+        reflection_token_budget=None,
+        count_prompt_tokens=False,
+        conversation_mode="independent",
+        guided_decoding=True,
+        unguided_summary=None,
+        adaptive_max_tokens=True,
+        dedup_requests=False,
+        attitude_samples=1,
+        attitude_aggregation="mean",
+        fake_latency_ms=0.0,
+        fake_latency_dist="constant",
+        fake_token_latency_ms=0.0,
+        fake_error_rate=0.0,
+        fake_rate_limit_rate=0.0,
+        fake_completion_tokens=None,
+        profile=None,
+        profile_phases=None,
+        profile_memory=False,
+        transmission_mixing="network",
+        initial_infected_rate=0.02,
+        vaccination_rates=(0.0, 0.0, 0.02, 0.1),
+        assets=None,
     ):
         # engine configurations
         self.temperature = temperature # attitude sampling temperature
@@ -51,17 +136,63 @@ class BackboneEngine:
         else:
             self.model_type = model_type
         
-        self.device = 'cuda' if torch.cuda.is_available() else 'cpu'
         self.max_iter = max_iter
         self.disease = disease
         # breakpoint()
         self.risk_data_path = risk_data_path
+        self.incremental_homophily = incremental_homophily # recount only edges of agents whose attitude changed
+        self.lesson_capacity = lesson_capacity # lessons kept per agent, None keeps all of them
+        self.prompt_layout = prompt_layout # "prefix_cache" puts the population-invariant system prompt first
+        self.prefix_stats = prefix_stats or prompt_layout == "prefix_cache" # write prompt_prefix.tsv, which tokenizes every prompt
+        # per-section prompt budgets in tokens, None means no budget
+        self.news_token_budget = news_token_budget # per news article
+        self.tweet_token_budget = tweet_token_budget # per recommended tweet
+        self.reflection_token_budget = reflection_token_budget # for the whole lesson section of the system prompt
+        # tokenize the final prompts for token_usage, otherwise the prompt tokens the servers report are used
+        self.count_prompt_tokens = count_prompt_tokens or any(b is not None for b in [news_token_budget, tweet_token_budget, reflection_token_budget])
+        assert conversation_mode in ["independent", "session"], f"Unknown conversation mode {conversation_mode}"
+        self.conversation_mode = conversation_mode # "session" sends the stages of an agent's day as one growing chat
+        self.guided_decoding = guided_decoding # constrain attitude and lesson outputs with a JSON schema on vLLM servers
+        self.unguided_summary = unguided_summary # simulation_summary.json of a --no_guided_decoding run, to count the retries avoided
+        self.adaptive_max_tokens = adaptive_max_tokens # lower max_tokens of a stage to a high percentile of its observed output lengths
+        self.dedup_requests = dedup_requests # send agents with identical messages as one request with n completions
+        assert attitude_samples >= 1, f"attitude_samples must be at least 1, but got {attitude_samples}"
+        assert attitude_aggregation in ATTITUDE_AGGREGATIONS, f"attitude_aggregation must be one of {ATTITUDE_AGGREGATIONS}, but got {attitude_aggregation}"
+        self.attitude_samples = attitude_samples # completions per agent for attitude polls, drawn in one request
+        self.attitude_aggregation = attitude_aggregation
+        self.completion_lengths = {} # stage function -> completion tokens of recent complete outputs
+        self.transmission_mixing = transmission_mixing # "network" spreads the disease over follow edges, "well_mixed" between all agents
+        self.initial_infected_rate = initial_infected_rate
+        assert len(vaccination_rates) == 4, f"vaccination_rates needs one rate per attitude 1-4, but got {vaccination_rates}"
+        self.vaccination_rates = tuple(vaccination_rates) # daily probability that an unvaccinated agent with attitude 1-4 gets vaccinated
+        self.transmission_model = None # an A_SIRV, rebuilt from the run seed at the start of every warm-up
+        self.profile = profile # None, or the mode of a RunProfiler attached to every run, see utils/profiling.py
+        self.profile_phases = profile_phases
+        self.profile_memory = profile_memory
+        self.profiler = None
+        # keyword arguments of the FakeBackend of --model_type fake (see engines/fake_backend.py)
+        self.fake_config = {
+            "latency_ms": fake_latency_ms,
+            "latency_dist": fake_latency_dist,
+            "token_latency_ms": fake_token_latency_ms,
+            "error_rate": fake_error_rate,
+            "rate_limit_rate": fake_rate_limit_rate,
+            "completion_tokens": fake_completion_tokens,
+            "seed": seed,
+        }
 
         # run config
         self.context = None
         self.run_id = 0
         self.day = 1
         self.attitude_dist = []
+        self.network_metrics = []
+        self.session_day = None # day of the running conversations in session mode
+        self.last_responses = None # the response of every agent at the last generation
+        self.session_savings = []
+        self.warmup_snapshot = None # set by run(keep_warmup=True)
+        self.engine_id = next(ENGINE_IDS)
+        self.metrics = self.new_metrics() # replaced at the start of every run
         self.seed = seed
         self.set_seed()
 
@@ -71,6 +202,13 @@ class BackboneEngine:
         self.news_path = news_path
         self.network_str = network_str
         self.policies_path = policies_path
+        # read-only data, loaded once and shared across runs (and with other engines when passed in)
+        # fake models encode tweets and news with a hashing encoder, load tests need neither torch nor model downloads
+        encoder_name = FAKE_ENCODER_NAME if fake_mode(self.model_type) else ENCODER_NAME
+        if assets is None:
+            assets = SimulationAssets(profile_str, network_str, disease=self.disease, risk_data_path=risk_data_path, warmup_days=warmup_days, encoder_name=encoder_name)
+        assert assets.matches(profile_str, network_str, self.disease, risk_data_path, warmup_days, encoder_name), "The shared assets were loaded for another data configuration"
+        self.assets = assets
         
         # load data
         self.load_news()
@@ -78,15 +216,15 @@ class BackboneEngine:
         self.load_agents()
         self.tweet_recommender_alpha= alpha
         # initializing models
-        self.tweet_recommender = TweetRecommender(alpha=alpha) 
-        self.disease_model = NAME_TO_MODEL[self.disease](risk_data_path=self.risk_data_path, warmup_days=self.warmup_days)
-        # self.transmission_model = A_SIRV(agents=self.agents, disease_model=name_to_model[self.disease], risk_data_path=risk_data_path, warmup_days=warmup_days)
+        self.tweet_recommender = TweetRecommender(alpha=alpha, model=self.assets.encoder) 
+        self.disease_model = self.assets.disease_model
     
     def _init_logger(self):
         """
         Initialize a logger for the engine.
         """
-        logger = logging.getLogger(self.__class__.__name__)
+        # one logger per run, so concurrent runs write to their own engine.log
+        logger = logging.getLogger(f"{self.__class__.__name__}.{self.run_id}")
         logger.setLevel(logging.INFO)
 
         # Avoid adding duplicate handlers
@@ -118,7 +256,19 @@ class BackboneEngine:
         print(f"Setting seed: {self.seed}")
         self.rng = np.random.default_rng(self.seed)
         self.sampling_rng = np.random.default_rng(self.seed)
-        transformers.set_seed(self.seed)
+        # same as transformers.set_seed, without importing torch for the API backends that never use it
+        random.seed(self.seed)
+        np.random.seed(self.seed)
+        if "torch" in sys.modules:
+            torch = sys.modules["torch"]
+            torch.manual_seed(self.seed)
+            if torch.cuda.is_available():
+                torch.cuda.manual_seed_all(self.seed)
+
+    @property
+    def device(self):
+        import torch
+        return 'cuda' if torch.cuda.is_available() else 'cpu'
     
     def set_temperature(self, temperature):
         print(f"Setting temperature from {self.temperature} to {temperature}")
@@ -145,18 +295,47 @@ class BackboneEngine:
         new_dist = [round(v, 2) for v in new_dist]
         return attitude, new_dist
 
+    def batch_temperature_sampling(self, dists, min_p=0.0):
+        """
+        Vectorized temperature_sampling for the whole population.
+        :param dists: (N, 4) matrix of orig_attitude_dist, one row per agent
+        :return: (N,) sampled attitudes (1-4) and the N tempered distributions rounded to 2 decimals
+        """
+        dists = np.asarray(dists, dtype=np.float64)
+        res_dist = np.where(dists < 1e-6, 1e-6, dists)
+        res_dist = np.exp(np.log(res_dist) / abs(self.temperature-1e-6))
+        res_dist = res_dist / res_dist.sum(axis=1, keepdims=True)
+        return self.batch_sample(res_dist, min_p=min_p)
+
+    def batch_sample(self, dists, min_p=0.0):
+        """
+        Vectorized sample: one inverse-CDF draw per row.
+        RNG draw order: exactly one uniform is drawn from sampling_rng per row, in row (agent id) order,
+        which consumes the stream the same way as N sequential `sample` calls and returns the same attitudes.
+        """
+        new_dist = np.where(dists >= min_p, dists, 0)
+        new_dist = new_dist / new_dist.sum(axis=1, keepdims=True)
+        cdf = np.cumsum(new_dist, axis=1)
+        cdf /= cdf[:, -1:]
+        uniforms = self.sampling_rng.random(len(new_dist))
+        # same as searchsorted(cdf, u, side='right') on every row
+        attitudes = (cdf <= uniforms[:, None]).sum(axis=1) + 1
+        # round new_dist to 2 decimal places for better readability to LLMs
+        new_dist = [[round(v, 2) for v in row] for row in new_dist.tolist()]
+        return attitudes, new_dist
+
     def parse_distributions(self, response):
         try: 
             json_data = json.loads(response)
-            if type(json_data) == list and type(json_data[0]) == float:
-                return json_data, "No reasoning provided"
+            if type(json_data) == list and is_number(json_data[0]):
+                return [float(v) for v in json_data], "No reasoning provided", True
             if type(json_data) == list and type(json_data[0]) == dict:
                 json_data = json_data[0]
             assert "attitude_dist" in json_data and "reasoning" in json_data, "Attitude distribution or reasoning not found"
             attitude_dist = json_data["attitude_dist"]
-            assert type(attitude_dist) == list and len(attitude_dist) > 0 and type(attitude_dist[0]) == float, f"Attitude distribution is not a list of floats, element type: {type(attitude_dist[0])}, list type: {type(attitude_dist)}"
+            assert type(attitude_dist) == list and len(attitude_dist) > 0 and all(is_number(v) for v in attitude_dist), f"Attitude distribution is not a list of numbers: {attitude_dist}"
             reasoning = json_data["reasoning"]
-            return attitude_dist, reasoning, True
+            return [float(v) for v in attitude_dist], reasoning, True
         except ValueError as e:
             match = re.search(r'\[(.*?)\]', response) # edge case of only []
             if match:
@@ -174,6 +353,9 @@ class BackboneEngine:
     def parse_attitude(self, response, temperature=1.0):
         try:
             orig_attitude_dist, reasoning, success = self.parse_distributions(response)
+            if len(orig_attitude_dist) != 4:
+                print(f"Expected 4 attitude probabilities, got: {orig_attitude_dist}")
+                return {"reasoning": "I am not sure", "orig_attitude_dist": [0.25, 0.25, 0.25, 0.25]}, False
             # print("Attitude dist: ", attitude_dist)
             return {"reasoning": reasoning, "orig_attitude_dist": orig_attitude_dist}, success
             # return {"attitude": attitude, "reasoning": reasoning, "orig_attitude_dist": orig_attitude_dist, "attitude_dist": attitude_dist}, True
@@ -185,20 +367,19 @@ class BackboneEngine:
         
     def load_network(self):
         assert self.agents != None, "Agents must be loaded before loading the network"
-        with open(self.network_str, "rb") as f:
-            self.social_network = pickle.load(f)
-            f.close()
+        self.social_network = self.assets.social_network
 
         assert len(self.agents) == len(self.social_network), f"Number of agents must match the number of agents in the social network, but got: {len(self.agents)} and {len(self.social_network)}"
-        adj_list = dict({k: list(dict(v).keys()) for k,v in dict(self.social_network.adj).items()})
-        for i in range(len(self.agents)):
-            self.agents[i].following = {v: 3 for v in adj_list[i]} # a dictionary of id to weight
+        self.population.network = self.social_network # agents read their following weights from the network
+        self.homophily_tracker = HomophilyTracker(self.social_network, incremental=self.incremental_homophily)
 
     def load_agents(self):
-        with open(self.profile_str, "rb") as f:
-            # a list of dictionaries
-            profiles = list(pickle.load(f))
-        self.agents = [Agent(p) for p in profiles]
+        profiles = self.assets.profiles # a list of dictionaries
+        # one poll per day plus the initial poll
+        self.population = Population(len(profiles), num_polls=self.total_num_days + 1)
+        self.agents = [Agent(p, population=self.population, row=i, lesson_capacity=self.lesson_capacity) for i, p in enumerate(profiles)]
+        self.prompt_builder = SystemPromptBuilder(self.disease, self.population, layout=self.prompt_layout, reflection_token_budget=self.reflection_token_budget, model_type=self.model_type)
+        self.token_accountant = TokenAccountant(self.model_type, len(profiles), count_prompts=self.count_prompt_tokens)
         self.num_agents = len(self.agents)
         ids = list(range(len(self.agents)))
         # load it for init_attitude
@@ -208,35 +389,74 @@ class BackboneEngine:
         self.load_network()
 
     def load_news(self):
-        with open(self.news_path, "rb") as f:
-            self.news = pickle.load(f)
-            f.close()
-        for i in range(len(self.news)):
-            self.news[i].text = self.news[i].text.replace("COVID-19", self.disease).replace("covid-19", self.disease).replace("Covid-19", self.disease).replace("COVID", self.disease).replace("covid", self.disease).replace("Covid", self.disease)
-        self.news_recommender = NewsRecommender() 
+        self.news = self.assets.news(self.news_path)
+        self.news_recommender = NewsRecommender(model=self.assets.encoder) 
         self.disease_broadcast_message = None
         self.recommended_news = None
 
+    def load_transmission_model(self):
+        self.transmission_model = A_SIRV(self.num_agents, self.disease_model, network=self.social_network, mixing=self.transmission_mixing,
+                                         initial_infected_rate=self.initial_infected_rate, seed=self.seed, num_days=self.total_num_days)
+        self.update_disease_status()
+
+    def update_disease_status(self):
+        """Mirror the transmission model into the population, where the prompts read it."""
+        model = self.transmission_model
+        self.population.set_disease(model.state, model.vaccinated, model.infected_share())
+
     def reset(self):
+        """
+        Re-initialize the run state, so one engine can run a whole sweep.
+        Only mutable state is rebuilt; profiles, network, news, risk data and the encoder come from the shared assets.
+        """
         # reset run configs
         self.context = []
         self.day = 1
         self.attitude_dist = []
+        self.network_metrics = []
+        self.session_day = None
+        self.last_responses = None
+        self.session_savings = []
+        self.completion_lengths = {} # adaptive max_tokens starts over, as in a new engine
 
-        # reload data
+        # rebuild the population, agents and news state
         self.load_agents()
         self.load_news()
         self.set_seed()
         
-        # reload models
-        self.tweet_recommender = TweetRecommender(alpha=self.tweet_recommender_alpha) 
-        self.news_recommender = NewsRecommender()
-        self.disease_model = NAME_TO_MODEL[self.disease](risk_data_path=self.risk_data_path, warmup_days=self.warmup_days)
+        # fresh recommenders over the shared encoder
+        self.tweet_recommender = TweetRecommender(alpha=self.tweet_recommender_alpha, model=self.assets.encoder) 
+        self.news_recommender = NewsRecommender(model=self.assets.encoder)
+        self.disease_model = self.assets.disease_model
         
+    def new_metrics(self):
+        registry = metrics.MetricsRegistry(labels={"engine": str(self.engine_id)})
+        metrics.register(registry) # served by --metrics_port
+        return registry
+
+    @property
+    def metrics_path(self):
+        return os.path.join(self.run_save_dir, "metrics.jsonl")
+
+    def profile_phase(self, name):
+        """Profile the block as phase name when --profile is on."""
+        return self.profiler.phase(name) if self.profiler is not None else nullcontext()
+
+    def end_day(self):
+        self.metrics.write_snapshot(self.metrics_path, day=self.day)
+        if self.profiler is not None:
+            self.profiler.end_day(self.day)
+
     def reset_context(self):
-        self.context = [system_prompt(self.disease, self.agents[i], self.day) for i in range(self.num_agents)]
+        with self.profile_phase("prompt"), self.metrics.time("prompt_build_seconds", help="Wall time of building the system prompts of all agents"):
+            self.context = self.prompt_builder.build(self.agents, self.day)
         
     def add_prompt(self, new_prompts):
+        if self.conversation_mode == "session" and self.session_day == self.day:
+            self.continue_sessions(new_prompts)
+            self.log_prompt_prefix()
+            return
+        self.session_day = self.day
         self.reset_context()
         # different prompt for each agent
         if "gemma" in self.model_type:
@@ -271,6 +491,105 @@ class BackboneEngine:
                         "role": "user", 
                         "content": new_prompts}
                     )
+        if self.conversation_mode == "session":
+            self.log_session_savings([0] * self.num_agents, [flatten_messages(context) for context in self.context])
+        self.log_prompt_prefix()
+
+    def continue_sessions(self, new_prompts):
+        """Append the last responses and the new prompts to the conversation of every agent, keeping the day's system prompt."""
+        new_prompts = new_prompts if type(new_prompts) == list else [new_prompts] * self.num_agents
+        cached = []
+        for k in range(self.num_agents):
+            response = self.last_responses[k] if self.last_responses is not None and self.last_responses[k] is not None else ""
+            self.context[k] = self.context[k] + [{"role": "assistant", "content": response}]
+            cached.append(flatten_messages(self.context[k]))
+            self.context[k].append({"role": "user", "content": new_prompts[k]})
+        # what the same stage would send without a session: today's system prompt and the new prompt
+        independent = [flatten_messages(system + [{"role": "user", "content": prompt}]) for system, prompt in zip(self.prompt_builder.build(self.agents, self.day), new_prompts)]
+        self.log_session_savings(count_tokens_batch(cached, self.model_type), independent)
+
+    def log_session_savings(self, cached_tokens, independent_prompts):
+        """Compare the prefill of session prompts (minus the turns a prefix or KV cache already holds) with independent prompts."""
+        session_tokens = count_tokens_batch([flatten_messages(context) for context in self.context], self.model_type)
+        record = {
+            "day": self.day,
+            "stage": self.stage,
+            "session_prompt_tokens": int(sum(session_tokens)),
+            "cached_tokens": int(sum(cached_tokens)),
+            "independent_prompt_tokens": int(sum(count_tokens_batch(independent_prompts, self.model_type))),
+        }
+        record["prefill_tokens_saved"] = record["independent_prompt_tokens"] - (record["session_prompt_tokens"] - record["cached_tokens"])
+        self.session_savings.append(record)
+        path = os.path.join(self.run_save_dir, "session_savings.tsv")
+        if not os.path.exists(path):
+            with open(path, "w") as f:
+                f.write("\t".join(record.keys()) + "\n")
+                f.close()
+        with open(path, "a") as f:
+            f.write("\t".join(str(v) for v in record.values()) + "\n")
+            f.close()
+        print(f"Session at {self.stage}: {record['prefill_tokens_saved']} prefill tokens saved, {record['cached_tokens']} reusable from earlier turns")
+
+    def session_savings_summary(self):
+        totals = {key: sum(r[key] for r in self.session_savings) for key in ["session_prompt_tokens", "cached_tokens", "independent_prompt_tokens", "prefill_tokens_saved"]}
+        totals["saved_fraction"] = totals["prefill_tokens_saved"] / totals["independent_prompt_tokens"] if totals["independent_prompt_tokens"] > 0 else 0.0
+        return {"total": totals, "stages": self.session_savings}
+
+    def guided_schema(self, f):
+        """The JSON schema that constrains the outputs of stage f, None when guided decoding is off or the backend is not a vLLM server."""
+        if not self.guided_decoding or any(name in self.model_type for name in ["gpt", "claude", "gemma"]):
+            return None
+        return GUIDED_SCHEMAS.get(f)
+
+    def stage_max_tokens(self, f, max_tokens, percentile=99, margin=1.25, min_samples=20):
+        """max_tokens for the first wave of stage f: the static limit, or a margin over the percentile of earlier complete outputs."""
+        lengths = self.completion_lengths.get(f, [])
+        if not self.adaptive_max_tokens or len(lengths) < min_samples:
+            return max_tokens
+        return min(max_tokens, int(np.ceil(np.percentile(lengths, percentile) * margin)))
+
+    def observe_completion(self, f, output, max_history=5000):
+        if output.completion_tokens > 0 and output.finish_reason not in TRUNCATED_FINISH_REASONS:
+            lengths = self.completion_lengths.setdefault(f, [])
+            lengths.append(output.completion_tokens)
+            del lengths[:-max_history]
+
+    def stage_stop(self, f):
+        return None if self.guided_schema(f) is not None else STAGE_STOPS.get(f)
+
+    def restore_stop(self, f, text):
+        """Close the brackets a stop sequence left open, e.g. [{...} becomes [{...}]."""
+        if text is None or f not in JSON_STAGES:
+            return text
+        return close_brackets(text)
+
+    def record_token_usage(self, usages):
+        """Account the prompt of every agent in the current context and the usage of the requests that answered it."""
+        self.last_responses = [usage.last_response for usage in usages]
+        if sum(usage.guided_fallbacks for usage in usages) > 0:
+            print(f"The server rejected guided JSON decoding at {self.stage}, sending the remaining stages without a schema")
+            self.guided_decoding = False
+        prompts = [flatten_messages(context) for context in self.context] if self.count_prompt_tokens else None
+        counts = self.token_accountant.record(self.stage, prompts, usages)
+        print(f"Tokens at {self.stage}: {counts['prompt_tokens'].mean():.0f} prompt / {counts['completion_tokens'].mean():.0f} completion per agent, {counts['requests'].sum()} requests, {counts['truncated'].sum() / max(counts['requests'].sum(), 1):.1%} truncated")
+
+    def log_prompt_prefix(self):
+        """Record how many leading tokens all prompts of the current stage share, i.e. what a server-side prefix cache can reuse."""
+        if not self.prefix_stats:
+            return
+        prompts = [flatten_messages(context) for context in self.context]
+        prefix = shared_prefix(prompts)
+        prefix_tokens = count_tokens(prefix, self.model_type)
+        mean_chars = sum(len(p) for p in prompts) / len(prompts)
+        path = os.path.join(self.run_save_dir, "prompt_prefix.tsv")
+        if not os.path.exists(path):
+            with open(path, "w") as f:
+                f.write("day\tstage\tlayout\tshared_prefix_tokens\tshared_prefix_chars\tmean_prompt_chars\n")
+                f.close()
+        with open(path, "a") as f:
+            f.write(f"{self.day}\t{self.stage}\t{self.prompt_layout}\t{prefix_tokens}\t{len(prefix)}\t{mean_chars:.0f}\n")
+            f.close()
+        print(f"Shared prompt prefix at {self.stage}: {prefix_tokens} tokens ({len(prefix) / mean_chars:.0%} of the average prompt)")
     
     def add_all_lessons(self, new_lessons):
         for k in range(self.num_agents):
@@ -284,7 +603,7 @@ class BackboneEngine:
                 f.write(f"Day\tStage\tResponse\tSys_Prompt\tUser_Prompt\tAll_Attitudes\tLessons\tReflections\tTweets\n")
         with open(agent_file_path, "a") as f:
             content1 = self.context[k][0]['content'].strip().replace("\n", " ").replace("\t", " ")
-            content2 = self.context[k][1]['content'].strip().replace("\n", " ").replace("\t", " ") if len(self.context[k]) > 1 else ""
+            content2 = self.context[k][-1]['content'].strip().replace("\n", " ").replace("\t", " ") if len(self.context[k]) > 1 else ""
             response = cleaned_responses[k].strip().replace("\n", " ") if type(cleaned_responses[k]) == str else str(cleaned_responses[k]).strip().replace("\n", " ")
             tweets = [t.text.strip().replace("\n", " ") for t in agent.tweets]
             lessons = [str(l.text).strip().replace("\n", " ") for l in agent.lessons ]
@@ -298,45 +617,84 @@ class BackboneEngine:
                 f.write(f"Stage\tDay\tAttitude_Dist\tInput\tOutput\n")
         print("-" * 50)
         print(f"Saving to {file_path}")
-        with open(file_path, "a") as f:
-            f.write(f"{self.stage}\t{self.day}\t{self.attitude_dist}\t{self.context}\t{cleaned_responses}\n")
-            f.close()
-        print("-" * 50)
-        print(f"Saving records for individual agents")
-        agent_save_dir = os.path.join(self.run_save_dir, "agents")
-        if not os.path.exists(agent_save_dir):
-            os.makedirs(agent_save_dir)
-        for k in range(len(self.agents)):
-            agent = self.agents[k]
-            self.save_agent(agent, k, cleaned_responses, agent_save_dir)
+        with self.profile_phase("save"), self.metrics.time("io_seconds", help="Wall time of writing run outputs", op="save"):
+            with open(file_path, "a") as f:
+                f.write(f"{self.stage}\t{self.day}\t{self.attitude_dist}\t{self.context}\t{cleaned_responses}\n")
+                f.close()
+            print("-" * 50)
+            print(f"Saving records for individual agents")
+            agent_save_dir = os.path.join(self.run_save_dir, "agents")
+            if not os.path.exists(agent_save_dir):
+                os.makedirs(agent_save_dir)
+            for k in range(len(self.agents)):
+                agent = self.agents[k]
+                self.save_agent(agent, k, cleaned_responses, agent_save_dir)
     
-    def run(self, idx, policy, ablate_key=None):
+    def snapshot(self):
+        """
+        A copy of the simulation state (agents, population, recommenders, RNGs, disease model, token accounting)
+        and of the files written so far, to fork several runs from one warm-up with `restore`.
+        The shared assets are referenced, not copied.
+        """
+        memo = {id(v): v for v in self.assets.cache.values()}
+        state = {k: v for k, v in self.__dict__.items() if k not in SNAPSHOT_EXCLUDE}
+        files = {}
+        for root, _, names in os.walk(self.run_save_dir):
+            for name in names:
+                if name in SNAPSHOT_SKIP_FILES:
+                    continue
+                path = os.path.join(root, name)
+                with open(path, "rb") as f:
+                    files[os.path.relpath(path, self.run_save_dir)] = f.read()
+        return {"state": copy.deepcopy(state, memo), "files": files}
+
+    def restore(self, snapshot):
+        """Continue from a snapshot; the snapshot itself is left untouched, so it can be restored again."""
+        memo = {id(v): v for v in self.assets.cache.values()}
+        self.__dict__.update(copy.deepcopy(snapshot["state"], memo))
+        for rel_path, content in snapshot["files"].items():
+            path = os.path.join(self.run_save_dir, rel_path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as f:
+                f.write(content)
+
+    def run(self, idx, policy, ablate_key=None, warmup=None, keep_warmup=False):
+        """
+        :param warmup: a snapshot taken after the warm-up of a run with the same seed, temperature and news, restored instead of running the warm-up
+        :param keep_warmup: snapshot the state after the warm-up into self.warmup_snapshot
+        """
         with open(os.path.join(self.run_save_dir, "run_config.json"), "w") as f:
             for k, v in self.__dict__.items():
-                if k not in ["run_save_dir", "logger", "agents", "news", "disease_model", "tweet_recommender", "news_recommender", "recommended_news"]:
+                if k not in ["run_save_dir", "logger", "agents", "news", "disease_model", "tweet_recommender", "news_recommender", "recommended_news", "homophily_tracker", "network_metrics", "population", "prompt_builder", "token_accountant", "last_responses", "session_savings", "completion_lengths", "assets", "social_network", "warmup_snapshot", "metrics", "profiler", "transmission_model"]:
                     f.write(f"{k}: {v}\n")
         print("-"*50)
         policy_content = policy.content if policy != None else "None"
         print(f"**Running simulations of policy={policy_content}**")
         print(f"**Run ID: {self.run_id}**")
-        functions_queue = [self.feed_news_data, self.feed_disease_broadcast, self.broadcast_news_and_policies, self.feed_tweets, self.prompt_actions, self.poll_attitude]
+        functions_queue = [self.feed_news_data, self.feed_disease_broadcast, self.broadcast_news_and_policies, self.feed_tweets, self.prompt_actions, self.poll_attitude, self.spread_disease]
         functions_queue_no_tweet = functions_queue.copy()
         functions_queue_no_tweet.remove(self.feed_tweets)
         print("-"*50)
-        print("**WARM-UP STARTED**")
-        self.init_agents()
-        for t in trange(self.warmup_days, desc="Warmup"):
-            print(f"**WARM-UP DAY {t}**")
-            execute_queue = functions_queue if t > 0 else functions_queue_no_tweet
-            for func in execute_queue:
-                func()
-            self.day += 1
-        print("**WARM-UP FINISHED**")
+        if warmup is not None:
+            # the warm-up does not depend on the policy
+            self.restore(warmup)
+            print("**WARM-UP RESTORED FROM SNAPSHOT**")
+        else:
+            print("**WARM-UP STARTED**")
+            self.init_agents()
+            for t in trange(self.warmup_days, desc="Warmup"):
+                print(f"**WARM-UP DAY {t}**")
+                execute_queue = functions_queue if t > 0 else functions_queue_no_tweet
+                for func in execute_queue:
+                    func()
+                self.end_day()
+                self.day += 1
+            print("**WARM-UP FINISHED**")
+            if keep_warmup:
+                self.warmup_snapshot = self.snapshot()
 
-        # add policy
-        self.broadcast_news_and_policies = partial(self.broadcast_news_and_policies, policy=policy)
-        # replace the policy function in the queue
-        functions_queue[2] = self.broadcast_news_and_policies
+        # add policy, bound for this run only so a reused engine starts its next warm-up without it
+        functions_queue[2] = partial(self.broadcast_news_and_policies, policy=policy)
 
         # ablate_map = {
         #         7: [self.feed_news_data],
@@ -354,24 +712,45 @@ class BackboneEngine:
             print(f"**DAY {t}**")
             for func in functions_queue:
                 func()
+            self.end_day()
             self.day += 1
         self.finish_simulation(self.run_id, policy_content)
         print(f"**Simulation of policy={policy_content} finished**")
         print("-"*50)
     
 
-    def run_policy(self, policy, i, news_path=None, ablate_key=None):
+    def close_logger(self):
+        for handler in list(self.logger.handlers):
+            handler.close()
+            self.logger.removeHandler(handler)
+
+    def run_policy(self, policy, i, news_path=None, ablate_key=None, run_tag=None, warmup=None, keep_warmup=False):
+        """
+        :param run_tag: appended to the run id, keeps the directories of runs started in the same second apart
+        :param warmup, keep_warmup: see run
+        """
         if news_path != None:
             self.news_path = news_path
             self.load_news()
         news_handle = self.news_path.split("/")[-1].replace(".pkl", "")
         self.curr_policy_head = policy.cat if policy != None else "None"
         self.run_id = f"{datetime.now().strftime('%y-%m-%d')}_{datetime.now().strftime('%H:%M:%S')}-news={news_handle}-policy={self.curr_policy_head}_num={i}_profiles={self.profile_str.split('/')[-1].replace('.pkl', '')}"
+        if run_tag is not None:
+            self.run_id += f"_{run_tag}"
         self.run_save_dir = os.path.join(self.save_dir, f"{self.run_id}-model={self.model_type}-temp={self.temperature}-disease={self.disease}")
         if not os.path.exists(self.run_save_dir):
             os.makedirs(self.run_save_dir)
         self.logger = self._init_logger()
-        self.run(i, policy, ablate_key=ablate_key)
+        self.metrics = self.new_metrics()
+        if self.profile is not None:
+            self.profiler = RunProfiler(os.path.join(self.run_save_dir, "profile"), mode=self.profile, phases=self.profile_phases, memory=self.profile_memory)
+        try:
+            self.run(i, policy, ablate_key=ablate_key, warmup=warmup, keep_warmup=keep_warmup)
+        finally:
+            self.close_logger()
+            if self.profiler is not None:
+                self.profiler.close()
+                self.profiler = None
         return self.attitude_dist
 
 
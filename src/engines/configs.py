@@ -1,5 +1,5 @@
 from dataclasses import dataclass, field
-from typing import List
+from typing import List, Optional, Tuple
 
 @dataclass
 class DataConfig:
@@ -13,11 +13,41 @@ class EngineConfig:
     model_type: str = "meta-llama/Meta-Llama-3.1-8B-Instruct"
     disease: str = "FD-24"
     ports: List[int] = field(default_factory=list)
+    endpoints: Optional[List[str]] = None # host:port[:weight] of vLLM servers on any host, used instead of ports
+    endpoints_file: Optional[str] = None # one host:port[:weight] per line
     run_days: int = 10
     warmup_days: int = 5
     max_iter: int = 10
     alpha: float = 0.3  # Following bias for the model
     temperature: float = 1.0
+    incremental_homophily: bool = True # recount homophily only over edges of agents whose attitude changed
+    lesson_capacity: Optional[int] = 50 # lessons kept per agent, the lowest-scoring ones are evicted
+    prompt_layout: str = "default" # "prefix_cache" puts shared instructions before per-agent content
+    prefix_stats: bool = False # write prompt_prefix.tsv with the default layout too
+    news_token_budget: Optional[int] = None # truncate every news article to this many tokens
+    tweet_token_budget: Optional[int] = None # truncate every recommended tweet to this many tokens
+    reflection_token_budget: Optional[int] = None # drop the least important lessons until the lesson section fits
+    count_prompt_tokens: bool = False # tokenize the final prompts for token_usage, on with any token budget
+    conversation_mode: str = "independent" # "session" sends the stages of an agent's day as one growing chat
+    guided_decoding: bool = True # send JSON schemas for the attitude and lesson stages to vLLM servers
+    unguided_summary: Optional[str] = None # simulation_summary.json of a --no_guided_decoding run, to count the retries avoided
+    adaptive_max_tokens: bool = True # cap max_tokens of a stage at a margin over the 99th percentile of its observed output lengths
+    dedup_requests: bool = False # one request with n completions for agents whose messages are identical
+    attitude_samples: int = 1 # completions per agent and attitude poll, requested with n in one call
+    attitude_aggregation: str = "mean" # mean or ensemble (logarithmic pooling) of the sampled distributions
+    # fake backend of --model_type fake, see engines/fake_backend.py
+    fake_latency_ms: float = 0.0
+    fake_latency_dist: str = "constant"
+    fake_token_latency_ms: float = 0.0
+    fake_error_rate: float = 0.0
+    fake_rate_limit_rate: float = 0.0
+    fake_completion_tokens: Optional[int] = None
+    profile: Optional[str] = None # sampling, cprofile or both; profiles the hot phases of every day, see utils/profiling.py
+    profile_phases: Optional[List[str]] = None
+    profile_memory: bool = False
+    transmission_mixing: str = "network" # network or well_mixed, see sandbox/transmission_model.py
+    initial_infected_rate: float = 0.02
+    vaccination_rates: Tuple[float, float, float, float] = (0.0, 0.0, 0.02, 0.1) # daily vaccination probability of agents with attitude 1-4
     risk_data_path: str = "data/data_table_for_weekly_deaths_and_weekly_%_of_ed_visits__the_united_states.csv"
 
 @dataclass
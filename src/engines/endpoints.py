@@ -0,0 +1,131 @@
+# This file contains the registry of the vLLM (OpenAI-compatible) servers a simulation sends its requests to
+# Endpoints can live on several hosts, carry an integer weight (their share of the agents), are health-checked before every stage,
+# and are taken out of the rotation when they stop answering; DataParallelEngine re-dispatches the requests they dropped
+import urllib.error
+import urllib.request
+from dataclasses import dataclass
+
+DEFAULT_HOST = "0.0.0.0"
+HEALTH_PATHS = ["/health", "/v1/models"] # vLLM serves both, other OpenAI-compatible servers at least the second
+
+@dataclass
+class Endpoint:
+    host: str
+    port: int
+    weight: int = 1 # number of slots in the agent assignment table
+    alive: bool = True
+    failures: int = 0 # consecutive failed requests or health checks
+
+    @property
+    def key(self):
+        return f"{self.host}:{self.port}"
+
+    @property
+    def url(self):
+        return f"http://{self.key}"
+
+def parse_endpoint(spec):
+    """
+    Parse one endpoint: "port", "host:port" or "host:port:weight".
+    """
+    parts = str(spec).strip().split(":")
+    if len(parts) == 1:
+        return Endpoint(DEFAULT_HOST, int(parts[0]))
+    if len(parts) == 2:
+        return Endpoint(parts[0], int(parts[1]))
+    if len(parts) == 3:
+        weight = int(parts[2])
+        assert weight > 0, f"Endpoint weight must be positive, but got {spec}"
+        return Endpoint(parts[0], int(parts[1]), weight)
+    raise ValueError(f"Cannot parse endpoint {spec}, expected port, host:port or host:port:weight")
+
+def read_endpoints_file(path):
+    """One endpoint per line, in the format of parse_endpoint; blank lines and # comments are skipped."""
+    with open(path, "r") as f:
+        lines = [line.split("#")[0].strip() for line in f]
+    return [parse_endpoint(line) for line in lines if line]
+
+class EndpointRegistry:
+    def __init__(self, endpoints, timeout=2.0, max_failures=2):
+        '''
+        :param endpoints: list of Endpoint
+        :param timeout: seconds to wait for a health check
+        :param max_failures: consecutive failures after which an endpoint is taken out of the rotation
+        '''
+        assert len(endpoints) > 0, "At least one endpoint is required"
+        self.endpoints = endpoints
+        self.timeout = timeout
+        self.max_failures = max_failures
+        self.table = None # agent slot -> endpoint, rebuilt whenever the set of live endpoints changes
+        self.rebuild()
+
+    @classmethod
+    def from_config(cls, ports=None, endpoints=None, endpoints_file=None, **kwargs):
+        """Endpoints from a file, else from host:port[:weight] specs, else from ports on this host."""
+        if endpoints_file is not None:
+            return cls(read_endpoints_file(endpoints_file), **kwargs)
+        if endpoints:
+            return cls([parse_endpoint(spec) for spec in endpoints], **kwargs)
+        ports = ports if ports and type(ports) == list else [80000]
+        return cls([Endpoint(DEFAULT_HOST, int(port)) for port in ports], **kwargs)
+
+    def __len__(self):
+        return len(self.endpoints)
+
+    @property
+    def alive(self):
+        return [e for e in self.endpoints if e.alive]
+
+    def get(self, key):
+        for endpoint in self.endpoints:
+            if endpoint.key == key:
+                return endpoint
+        raise KeyError(key)
+
+    def rebuild(self):
+        self.table = [e for e in self.alive for _ in range(e.weight)]
+
+    def endpoint_for(self, k):
+        """The endpoint of agent k; an agent stays on one endpoint while the live endpoints do not change."""
+        if len(self.table) == 0:
+            raise RuntimeError(f"No live endpoints left out of {[e.key for e in self.endpoints]}")
+        return self.table[k % len(self.table)]
+
+    def check(self, endpoint):
+        for path in HEALTH_PATHS:
+            try:
+                with urllib.request.urlopen(endpoint.url + path, timeout=self.timeout) as response:
+                    if response.status == 200:
+                        return True
+            except (urllib.error.URLError, OSError, ValueError):
+                continue
+        return False
+
+    def check_all(self):
+        """Health-check every endpoint, dead ones included so they rejoin once they answer again."""
+        changed = False
+        for endpoint in self.endpoints:
+            healthy = self.check(endpoint)
+            if healthy:
+                endpoint.failures = 0
+            if healthy != endpoint.alive:
+                print(f"Endpoint {endpoint.key} is {'back up' if healthy else 'down'}")
+                endpoint.alive = healthy
+                changed = True
+        if changed:
+            self.rebuild()
+        return self.alive
+
+    def mark_failed(self, key):
+        """Count a dropped request; the endpoint leaves the rotation after max_failures, or at once when its health check fails."""
+        endpoint = self.get(key)
+        if not endpoint.alive:
+            return
+        endpoint.failures += 1
+        if endpoint.failures >= self.max_failures or not self.check(endpoint):
+            print(f"Endpoint {endpoint.key} removed after {endpoint.failures} failures")
+            endpoint.alive = False
+            self.rebuild()
+
+    def mark_ok(self, key):
+        self.get(key).failures = 0
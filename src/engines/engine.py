@@ -1,18 +1,21 @@
 # This file contains an abstract engine class that orchestrates the simulation
 # It contains the concrete instantiation of some prompting methods and simulation flows
-# However, it does not implement generate or generate_attitude methods, which are done by DataParallelEngine in multi_engine.py
+# It parses generations and retries failed agents in waves, but the requests themselves are sent by _dispatch of DataParallelEngine (multi_engine.py) or AsyncDataParallelEngine (async_engine.py)
 # It is less on the high-level overview and more on the concrete prompt details (except generation)
 
+from abc import ABC, abstractmethod
 from engines.backbone_engine import BackboneEngine
 import json
-from utils.utils import compile_enumerate
-from utils.network_utils import homophily_corr
+from utils.utils import compile_enumerate, clean_response, parse_lessons, aggregate_distributions
+from engines.generation import TokenUsage
+import numpy as np
+import time
+from utils.token_utils import truncate_tokens
 from collections import Counter
-from utils.plot_utils import plot_attitudes
 import os
 import pickle
-import networkx as nx
 from sandbox.tweet import Tweet
+from sandbox.transmission_model import COMPARTMENTS
 from sandbox.prompts import *
 from tqdm import trange
 
@@ -23,13 +26,179 @@ LONG_TOKEN_LIMIT = 250
 FULL_TOKEN_LIMIT = 1000
 
 
-class Engine(BackboneEngine):
+class Engine(BackboneEngine, ABC):
+    """The simulation stages on top of a generation backend; concrete engines only implement _dispatch."""
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)      
 
+    @abstractmethod
+    def _dispatch(self, messages, ids, seeds, max_tokens, guided_json=None, stop=None, n=None):
+        """
+        Send one request per message and return their GenerationOutputs, in order.
+        DataParallelEngine (multi_engine.py) spreads them over a pool of worker processes, AsyncDataParallelEngine (async_engine.py) over asyncio tasks.
+        :param messages: chat messages of every request
+        :param ids: agent index of every message, e.g. to pin an agent to a server
+        :param seeds: generation seed of every message
+        :param guided_json: JSON schema the outputs must follow, None for free text
+        :param stop: stop sequences of the stage
+        :param n: number of completions of every message (default one each), the outputs of a message are consecutive
+        :return: a flat list of GenerationOutput, sum(n) long; a failed request gives empty outputs rather than raising
+        """
+
+    def draw_generation_seeds(self, n):
+        return [int(s) for s in self.rng.integers(0, 10000, size=n)]
+
+    def parse_output(self, f, response, day):
+        """Parse one response of stage f, returns (value, success)."""
+        if f == "generate_attitude":
+            return self.parse_attitude(response)
+        if f == "generate_lessons":
+            try:
+                return parse_lessons(response, day=day), True
+            except Exception as e:
+                print(f"Error in parsing lessons: {e}")
+                print(f"Response: {response}")
+                return [], False
+        text = clean_response(response) if response is not None else ""
+        if f == "generate_actions":
+            return text, len(text) >= 2
+        return text, response is not None
+
+    def dispatch_deduplicated(self, pending, seeds, max_tokens, f, samples=1):
+        """
+        Send one request with n completions for each group of pending agents with identical messages,
+        and hand the completions back to the agents of the group in order, samples completions per agent.
+        A group is sent with the seed and server of its first agent.
+        """
+        groups = {}
+        for k, seed in zip(pending, seeds):
+            key = tuple((m["role"], m["content"]) for m in self.context[k])
+            groups.setdefault(key, []).append((k, seed))
+        groups = list(groups.values())
+        if len(groups) < len(pending):
+            print(f"Stage: {self.stage}, {len(groups)} requests for {len(pending)} agents")
+        outputs = self._dispatch(
+            [self.context[group[0][0]] for group in groups],
+            [group[0][0] for group in groups],
+            [group[0][1] for group in groups],
+            max_tokens,
+            guided_json=self.guided_schema(f),
+            stop=self.stage_stop(f),
+            n=[len(group) * samples for group in groups]
+        )
+        # outputs come back grouped, reorder them as pending
+        order = [k for group in groups for k, _ in group]
+        by_agent = {k: outputs[i * samples:(i + 1) * samples] for i, k in enumerate(order)}
+        return [by_agent[k] for k in pending]
+
+    def parse_samples(self, f, responses, day):
+        """
+        Parse the attitude_samples completions of one agent and aggregate their distributions.
+        The agent succeeds when at least one completion parses; its reasoning is that of the first one that does.
+        """
+        parsed = [self.parse_output(f, response, day) for response in responses]
+        valid = [value for value, success in parsed if success]
+        if len(valid) == 0:
+            return parsed[0]
+        dists = np.asarray([value["orig_attitude_dist"] for value in valid], dtype=np.float64)
+        return {
+            "reasoning": valid[0]["reasoning"],
+            "orig_attitude_dist": aggregate_distributions(dists, self.attitude_aggregation),
+            "sample_attitude_dists": dists.tolist(),
+        }, True
+
+    def generate(self, max_tokens, day, f):
+        """
+        Generate the output of stage f for every agent in the context.
+        Each wave sends one request per pending agent through _dispatch and parses the responses here,
+        agents whose response fails to parse are resubmitted together in the next wave with fresh seeds, for at most max_iter waves.
+        """
+        print(f"Stage: {self.stage}, generation started")
+        start = time.time()
+        num_agents = len(self.context)
+        results = [None] * num_agents
+        usages = [TokenUsage() for _ in range(num_agents)]
+        pending = list(range(num_agents))
+        seeds = self.draw_generation_seeds(num_agents)
+        samples = self.attitude_samples if f == "generate_attitude" else 1
+        served = False # any request of the stage answered
+        for wave in range(self.max_iter):
+            if wave > 0:
+                seeds = [int(s) for s in self.rng.integers(0, 10000, size=len(pending))]
+                self.metrics.inc("retries_total", len(pending), help="Agents resubmitted after a failed parse", stage=f)
+            # retries get the full limit, in case the adaptive limit cut them off
+            wave_max_tokens = self.stage_max_tokens(f, max_tokens) if wave == 0 else max_tokens
+            self.logger.info(f"Stage: {self.stage}, wave {wave}: {len(pending)} requests, max_tokens {wave_max_tokens}, seeds {seeds}")
+            with self.profile_phase("dispatch"):
+                if self.dedup_requests:
+                    outputs = self.dispatch_deduplicated(pending, seeds, wave_max_tokens, f, samples)
+                else:
+                    outputs = self._dispatch([self.context[k] for k in pending], pending, seeds, wave_max_tokens, guided_json=self.guided_schema(f), stop=self.stage_stop(f), n=[samples] * len(pending))
+                    outputs = [outputs[i * samples:(i + 1) * samples] for i in range(len(pending))]
+            served = served or any(output.text is not None for choices in outputs for output in choices)
+            if not served:
+                raise Exception(f"Stage: {self.stage}, every request failed, check the endpoints and credentials")
+            failed = []
+            # one latency per request, the other choices of a request with n > 1 share it
+            self.metrics.observe_many("request_seconds", [o.latency for choices in outputs for o in choices if not o.shared], help="Latency of one generation request", stage=f)
+            for k, choices in zip(pending, outputs):
+                usages[k].num_waves += 1
+                for j, output in enumerate(choices):
+                    output.text = self.restore_stop(f, output.text)
+                    self.observe_completion(f, output)
+                    # backends without n send every sample as a request of its own, so only shared choices are extra samples
+                    usages[k].add(output, extra_sample=j > 0 and output.shared)
+                if samples > 1:
+                    results[k], success = self.parse_samples(f, [output.text for output in choices], day)
+                else:
+                    results[k], success = self.parse_output(f, choices[0].text, day)
+                if not success:
+                    failed.append(k)
+            self.metrics.inc("parse_failures_total", len(failed), help="Responses that failed to parse", stage=f)
+            pending = failed
+            if len(pending) == 0:
+                break
+            print(f"Stage: {self.stage}, {len(pending)} responses failed, resubmitting them in wave {wave + 1}")
+        if len(pending) > 0:
+            print(f"Stage: {self.stage}, {len(pending)} responses still failed after {self.max_iter} waves")
+        self.record_token_usage(usages)
+        end = time.time()
+        self.record_stage_metrics(f, day, end - start, usages, wave + 1, len(pending))
+        self.logger.info(f"Stage: {self.stage}, generation finished in {end - start:.2f} seconds")
+        print(f"Stage: {self.stage}, generation finished in {end - start:.2f} seconds")
+        return results
+
+    def record_stage_metrics(self, f, day, seconds, usages, waves, failed):
+        """Update the stage metrics of one generate call and append it as an event to metrics.jsonl."""
+        requests = sum(u.num_requests - u.shared_requests for u in usages)
+        prompt_tokens = sum(u.prompt_tokens for u in usages)
+        completion_tokens = sum(u.completion_tokens for u in usages)
+        tokens_per_second = completion_tokens / seconds if seconds > 0 else 0.0
+        self.metrics.observe("stage_seconds", seconds, help="Wall time of the generation of a stage, all waves included", stage=f)
+        self.metrics.inc("requests_total", requests, help="Generation requests sent", stage=f)
+        self.metrics.inc("prompt_tokens_total", prompt_tokens, help="Prompt tokens reported by the servers", stage=f)
+        self.metrics.inc("completion_tokens_total", completion_tokens, help="Completion tokens reported by the servers", stage=f)
+        self.metrics.inc("truncated_total", sum(u.truncated for u in usages), help="Completions cut off by max_tokens", stage=f)
+        self.metrics.set("tokens_per_second", tokens_per_second, help="Completion tokens per second of the last generation of a stage", stage=f)
+        self.metrics.write_jsonl(self.metrics_path, {
+            "type": "stage",
+            "stage": self.stage,
+            "function": f,
+            "day": day,
+            "seconds": seconds,
+            "agents": len(usages),
+            "requests": requests,
+            "waves": waves,
+            "failed": failed,
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "tokens_per_second": tokens_per_second,
+        })
+
     def init_agents(self):
         if self.day > 0:
             self.reset() # handle cases when the engine is reused
+        self.load_transmission_model() # agents know their health and the infections around them from the first poll
         
         self.stage = f"init_agents_day={self.day}"
         # breakpoint()
@@ -37,49 +206,41 @@ class Engine(BackboneEngine):
         self.add_prompt(profile_prompts)
         # breakpoint()
         json_data_list = self.generate(max_tokens=LONG_TOKEN_LIMIT, day=self.day, f="generate_attitude")
-        attitudes = []
+        # put sampling out of parallel processes, one vectorized draw for the whole population
+        attitudes, new_dists = self.batch_temperature_sampling([json_data["orig_attitude_dist"] for json_data in json_data_list])
         for i in range(len(json_data_list)):
-            json_data = json_data_list[i]
-            # put sampling out of parallel processes
-            attitude, new_dist = self.temperature_sampling(json_data["orig_attitude_dist"])
-            attitudes.append(attitude)
-            json_data_list[i]["attitude_dist"] = new_dist
-            json_data_list[i]["attitude"] = attitude
-        # update the message lists
-        for j in range(self.num_agents):
-            self.agents[j].attitudes.append(attitudes[j])
-            self.agents[j].reasoning.append(json_data_list[j]["reasoning"])
-            self.agents[j].attitude_dist.append(json_data_list[j]["attitude_dist"])
+            json_data_list[i]["attitude_dist"] = new_dists[i]
+            json_data_list[i]["attitude"] = int(attitudes[i])
+        # update the population histories
+        self.population.record_poll(attitudes, [d["attitude_dist"] for d in json_data_list], [d["reasoning"] for d in json_data_list])
         self.update_attitude_dist(attitudes)  
         self.save(json_data_list)
         
     def update_attitude_dist(self, attitudes):
-        num_against = len([att for att in attitudes if att < 3])
-        num_swing = len([att for att in attitudes if att == 3])
-        num_support = len([att for att in attitudes if att == 4])
-        against_percentage = num_against / self.num_agents
-        swing_percentage = num_swing / self.num_agents
-        support_percentage = num_support / self.num_agents
+        against_percentage, swing_percentage, support_percentage = self.population.attitude_shares(attitudes)
         self.attitude_dist.append((against_percentage, swing_percentage, support_percentage))
         if not os.path.exists(os.path.join(self.run_save_dir,f"attitude_dist.tsv")):
             with open(os.path.join(self.run_save_dir,f"attitude_dist.tsv"), "w") as f:
-                f.write("day\tagainst\tswing\tsupport\thomophily\thp1\thp2\thp3\thp4\n")
+                f.write("day\tagainst\tswing\tsupport\thomophily\thp1\thp2\thp3\thp4\tassortativity\n")
                 f.close()
-        for idx, att in enumerate(attitudes):
-            self.social_network.nodes[idx]['attitude'] = att
-            
-        # plot_network(self.social_network, self.run_save_dir, self.day)
-        homophily, same_one, same_two, same_three, same_four = homophily_corr(self.social_network)
+        # plot_network(self.social_network.to_networkx(), self.run_save_dir, self.day)
+        network_metrics = self.homophily_tracker.update(attitudes)
+        self.network_metrics.append(network_metrics)
+        homophily = network_metrics["homophily"]
+        same_one, same_two, same_three, same_four = network_metrics["same_class"]
         with open(os.path.join(self.run_save_dir,f"attitude_dist.tsv"), "a") as f:
-            f.write(f"{self.day}\t{against_percentage:.2f}\t{swing_percentage:.2f}\t{support_percentage:.2f}\t{homophily:.2f}\t{same_one:.2f}\t{same_two:.2f}\t{same_three:.2f}\t{same_four:.2f}\n")
+            f.write(f"{self.day}\t{against_percentage:.2f}\t{swing_percentage:.2f}\t{support_percentage:.2f}\t{homophily:.2f}\t{same_one:.2f}\t{same_two:.2f}\t{same_three:.2f}\t{same_four:.2f}\t{network_metrics['assortativity']:.2f}\n")
             f.close()
 
-        plot_attitudes(self.attitude_dist, self.model_type, self.curr_policy_head, self.run_save_dir)
+        from utils.plot_utils import plot_attitudes, PLOT_LOCK # matplotlib is only imported once a run plots
+        with PLOT_LOCK, self.metrics.time("io_seconds", help="Wall time of writing run outputs", op="plot"):
+            plot_attitudes(self.attitude_dist, self.model_type, self.curr_policy_head, self.run_save_dir)
         
     def feed_news_data(self, num_news=3):
         search_space = num_news * num_news
         news_data = self.news[self.day * search_space: (self.day + 1) * search_space]
-        recommendations = self.news_recommender.recommend(agents=self.agents, num_recommendations=num_news, news_data=news_data)
+        with self.profile_phase("recommendation"), self.metrics.time("recommender_seconds", help="Wall time of a recommendation round", recommender="news"):
+            recommendations = self.news_recommender.recommend(agents=self.agents, num_recommendations=num_news, news_data=news_data)
         all_news = []
         purities = []
         stances = []
@@ -87,6 +248,7 @@ class Engine(BackboneEngine):
         for k in range(self.num_agents):
             # breakpoint()
             news_text, news_stance, news_sim = recommendations[k]
+            news_text = [truncate_tokens(text, self.news_token_budget, self.model_type) for text in news_text]
             news = compile_enumerate(news_text, header="News")
             binary_stance = [1 if s == "positive" else 0 for s in news_stance]
             purity = sum(binary_stance) / len(binary_stance) if sum(binary_stance) > len(binary_stance) / 2 else 1 - sum(binary_stance) / len(binary_stance)
@@ -102,8 +264,7 @@ class Engine(BackboneEngine):
 
     def feed_disease_broadcast(self):
         disease_broadcast_message = disease_broadcast(self.disease, self.disease_model, self.day)
-        for k in range(self.num_agents):
-            self.agents[k].risk = self.disease_model.risks_categories[self.day]
+        self.population.set_risk(self.disease_model.risks_categories[self.day])
         self.disease_broadcast_message = disease_broadcast_message
     
     def broadcast_news_and_policies(self, policy = None, num_news = 5):
@@ -131,9 +292,12 @@ class Engine(BackboneEngine):
     
     def feed_tweets(self, top_k=3, num_recommendations = 5):
         self.stage = f"feed_tweets_day={self.day}"
-        recommendations = self.tweet_recommender.recommend(agents=self.agents, num_recommendations=num_recommendations) # e.g. 500 (num_agents) * 10 (num_tweets)
+        with self.profile_phase("recommendation"), self.metrics.time("recommender_seconds", help="Wall time of a recommendation round", recommender="tweet"):
+            recommendations = self.tweet_recommender.recommend(agents=self.agents, num_recommendations=num_recommendations) # e.g. 500 (num_agents) * 10 (num_tweets)
         print("Recommendations generated")
-        prompts = [tweets_prompt(self.disease, [r[1] for r in recommendations if r[0]==k], top_k) for k in range(self.num_agents)]
+        # recommendations are grouped by agent, num_recommendations per agent
+        tweet_texts = [truncate_tokens(r[1], self.tweet_token_budget, self.model_type) for r in recommendations]
+        prompts = [tweets_prompt(self.disease, tweet_texts[k * num_recommendations:(k + 1) * num_recommendations], top_k) for k in range(self.num_agents)]
         # print(f"Prompts generated, example: {prompts[0]}")
         self.add_prompt(prompts)
         self.stage = f"write_tweets_lesson_day={self.day}"
@@ -145,44 +309,60 @@ class Engine(BackboneEngine):
         # breakpoint()
         actions = self.generate(max_tokens=TWEET_TOKEN_LIMIT, day=self.day, f="generate_actions")
         actions_tweets = [Tweet(text=actions[i], time=self.day, author_id=i) for i in range(len(actions))]
-        for k in range(self.num_agents):
-            self.agents[k].tweets.append(actions_tweets[k])
+        self.population.add_tweets(actions_tweets)
         self.save(actions)
         return actions
 
     def poll_attitude(self):
-        self.add_prompt(attitude_prompt(self.disease))
         self.stage = f"poll_attitude_day={self.day}"
+        self.add_prompt(attitude_prompt(self.disease))
         json_data_list = self.generate(max_tokens=LONG_TOKEN_LIMIT, day=self.day, f="generate_attitude")
-        attitudes = []
+        # put sampling out of parallel processes, one vectorized draw for the whole population
+        attitudes, new_dists = self.batch_temperature_sampling([json_data["orig_attitude_dist"] for json_data in json_data_list])
         for i in range(len(json_data_list)):
-            json_data = json_data_list[i]
-            attitude, new_dist = self.temperature_sampling(json_data["orig_attitude_dist"])
-            attitudes.append(attitude)
-            json_data_list[i]["attitude_dist"] = new_dist
-            json_data_list[i]["attitude"] = attitude
-        # update the message lists
-        for j in range(self.num_agents):
-            self.agents[j].attitudes.append(attitudes[j])
-            self.agents[j].reasoning.append(json_data_list[j]["reasoning"])
+            json_data_list[i]["attitude_dist"] = new_dists[i]
+            json_data_list[i]["attitude"] = int(attitudes[i])
+        # update the population histories
+        self.population.record_poll(attitudes, [d["attitude_dist"] for d in json_data_list], [d["reasoning"] for d in json_data_list])
         self.update_attitude_dist(attitudes)
         self.save(json_data_list)
     
+    def spread_disease(self):
+        """Turn today's attitudes into vaccinations, advance the epidemic by a day and feed the local infections back into the profiles."""
+        self.stage = f"spread_disease_day={self.day}"
+        with self.metrics.time("transmission_seconds", help="Wall time of a day of the transmission model"):
+            rates = np.array((0.0,) + self.vaccination_rates)[self.population.latest_attitudes()] # attitude 0: not polled yet
+            vaccinate = self.transmission_model.decide_vaccination(rates)
+            counts = self.transmission_model.run_a_day(vaccinate=vaccinate)
+            self.update_disease_status()
+        self.metrics.inc("vaccinations_total", len(vaccinate), help="Vaccination decisions of agents")
+        for compartment, count in zip(COMPARTMENTS, counts.tolist()):
+            self.metrics.set("compartment_agents", count, help="Agents in each compartment of the transmission model", compartment=compartment.lower())
+        print(f"Disease status: {dict(zip(COMPARTMENTS, counts.tolist()))}")
+        return counts
+
     def finish_simulation(self, run_id, policy, top_k=5):
         # reject_reasons, reject_freqs = self.endturn_reflection(top_k)
-        for k in range(self.num_agents):
-            agent = self.agents[k]
-            att_set = set(agent.attitudes)
-
+        unguided_usage = None
+        if self.unguided_summary is not None:
+            with open(self.unguided_summary, "r") as f:
+                unguided_usage = json.load(f)["token_usage"]
         # save the simulation summary
         d = {
             "policy": policy,
             "vaccine_hesitancy_ratio": self.attitude_dist,
+            "network_metrics": self.network_metrics,
+            "token_usage": self.token_accountant.summary(unguided_usage),
+            "metrics": self.metrics.snapshot(),
             "infection_info": {
                 "risks_history": self.disease_model.risks,
                 "risks_rate": self.disease_model.risks_change_rates,
+                "compartments": COMPARTMENTS,
+                "sirv_history": self.transmission_model.history.tolist(), # agents per compartment, from the initial state to the last day
             }
         }
+        if self.conversation_mode == "session":
+            d["session_savings"] = self.session_savings_summary()
         json_object = json.dumps(d, indent=4)
         path = os.path.join(self.run_save_dir, f"simulation_summary.json")
         with open(path, "w") as f:
@@ -0,0 +1,319 @@
+# This file contains a deterministic fake LLM backend for load testing the engines without GPUs or paid APIs
+# --model_type fake answers in-process (GenerationClient and AsyncDataParallelEngine call FakeBackend directly),
+# --model_type fake/http sends real HTTP requests to the OpenAI-compatible stub this module serves:
+#   cd src && python -m engines.fake_backend --port 8000 --latency_ms 200 --rate_limit_rate 0.05
+# Completions are well-formed attitude JSON, lesson lists or tweets, depending on the stage of the prompt, and depend only on
+# the messages, the seed and the choice index; latency, server errors and 429s are drawn from the backend's own random stream
+import hashlib
+import json
+import math
+import os
+import random
+import time
+from engines.generation import GenerationOutput
+
+FAKE_MODEL = "fake" # in-process backend
+FAKE_HTTP_MODEL = "fake/http" # requests go to the stub server at the configured endpoints
+FAKE_ENCODER_NAME = "fake-hashing-encoder"
+CHARS_PER_TOKEN = 4 # same estimate as utils.token_utils, which this module does not import to stay light in the workers
+RETRY_AFTER = 1 # seconds a client waits after a 429
+LATENCY_DISTS = ["constant", "uniform", "exponential", "lognormal"]
+
+REASONS = [
+    "I have read that the vaccine is safe and I worry about getting sick",
+    "I do not trust how fast the vaccine was developed",
+    "people around me are getting vaccinated and nobody had problems",
+    "I am young and healthy so the risk of the disease seems low to me",
+    "the news reports more cases every week and I want to protect my family",
+    "I have heard about side effects from people I follow",
+    "my doctor recommends the vaccine and I usually follow her advice",
+    "I prefer to wait and see what happens to others first",
+]
+LESSONS = [
+    "vaccines reduce the risk of severe illness",
+    "some people report side effects after the vaccine",
+    "case numbers are rising in my community",
+    "the government incentivizes vaccines",
+    "people I follow are skeptical of the vaccine",
+    "health experts recommend getting vaccinated",
+    "the vaccine was developed very quickly",
+    "hospitals are under pressure",
+]
+TWEETS = [
+    "Just got my shot today, feeling good about protecting the people I love. #GetVaccinated",
+    "Not convinced yet, I want to see more data before I take this vaccine. #InformedConsent",
+    "Cases keep going up around here, please look out for each other. #CommunityHealth",
+    "Why is everyone in such a rush? Safety should come first. #SafetyOverSpeed",
+    "My whole family is vaccinated now, one less thing to worry about. #VaxxedAndProud",
+    "Still on the fence about the vaccine, anyone have good sources? #AskingQuestions",
+    "Trust the experts, they have been studying this for months. #TrustScience",
+    "I will decide for myself when I am ready, thank you very much. #MyChoice",
+]
+FILLER = ["honestly", "this week", "in my opinion", "as far as I can tell", "from what I have seen", "to be fair"]
+
+class RateLimited(Exception):
+    """The in-process counterpart of an HTTP 429, retried with backoff like openai.RateLimitError."""
+
+def fake_mode(model_type):
+    """None for real models, "local" for the in-process fake and "http" for the stub server."""
+    if model_type is None or not model_type.startswith(FAKE_MODEL):
+        return None
+    return "http" if model_type == FAKE_HTTP_MODEL else "local"
+
+def infer_stage(messages, guided_json=None):
+    """The kind of output a request asks for: "attitude", "lessons" or "tweet"."""
+    if guided_json is not None:
+        return "attitude" if "attitude_dist" in guided_json.get("properties", {}) else "lessons"
+    text = messages[-1]["content"] if messages else ""
+    if '"attitude_dist"' in text:
+        return "attitude"
+    if "list of lists" in text:
+        return "lessons"
+    return "tweet"
+
+def apply_stop(text, stop, max_tokens):
+    """Cut text at the first stop sequence (dropped, as servers do) or at max_tokens, returns (text, finish_reason)."""
+    stop = [stop] if isinstance(stop, str) else (stop or [])
+    cuts = [text.find(s) for s in stop if s and s in text]
+    finish_reason = "stop"
+    if cuts:
+        text = text[:min(cuts)]
+    if max_tokens is not None and len(text) > max_tokens * CHARS_PER_TOKEN:
+        text = text[:max_tokens * CHARS_PER_TOKEN]
+        finish_reason = "length"
+    return text, finish_reason
+
+def count_tokens(text):
+    return max(1, math.ceil(len(text) / CHARS_PER_TOKEN))
+
+class FakeResponse:
+    def __init__(self, status, choices=None, prompt_tokens=0, latency=0.0):
+        '''
+        :param status: 200, 429 or 500
+        :param choices: list of (text, finish_reason, completion_tokens)
+        :param latency: seconds the caller waits before answering
+        '''
+        self.status = status
+        self.choices = choices or []
+        self.prompt_tokens = prompt_tokens
+        self.latency = latency
+
+    @property
+    def completion_tokens(self):
+        return sum(tokens for _, _, tokens in self.choices)
+
+class FakeBackend:
+    def __init__(self, latency_ms=0.0, latency_dist="constant", token_latency_ms=0.0, error_rate=0.0, rate_limit_rate=0.0, completion_tokens=None, seed=0):
+        '''
+        :param latency_ms: mean time to first token of a request
+        :param latency_dist: distribution of that time, one of LATENCY_DISTS (lognormal keeps the mean)
+        :param token_latency_ms: decode time per completion token of the longest choice
+        :param error_rate: fraction of requests answered with a server error
+        :param rate_limit_rate: fraction of requests answered with 429
+        :param completion_tokens: pad the free text of every completion to about this many tokens, None keeps them short
+        :param seed: seed of the completions and of the latency and fault draws
+        '''
+        assert latency_dist in LATENCY_DISTS, f"latency_dist must be one of {LATENCY_DISTS}, but got {latency_dist}"
+        assert 0 <= error_rate + rate_limit_rate <= 1, "error_rate and rate_limit_rate must sum to at most 1"
+        self.latency_ms = latency_ms
+        self.latency_dist = latency_dist
+        self.token_latency_ms = token_latency_ms
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.completion_tokens = completion_tokens
+        self.seed = seed
+        self.rng = random.Random(seed) # faults and latency, shared by the threads of the stub server
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        # a copy in a worker process draws its own faults and latencies instead of repeating those of the others
+        self.rng = random.Random(f"{self.seed}-{os.getpid()}")
+
+    def content_rng(self, messages, gen_seed, index):
+        key = json.dumps([messages, gen_seed, index, self.seed], sort_keys=True, default=str).encode()
+        return random.Random(int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), "little"))
+
+    def pad(self, rng, text):
+        if self.completion_tokens is None:
+            return text
+        words = [text]
+        while len(" ".join(words)) < self.completion_tokens * CHARS_PER_TOKEN:
+            words.append(rng.choice(FILLER))
+        return " ".join(words)
+
+    def attitude(self, rng):
+        peak = rng.choices(range(4), weights=[2, 1, 1, 2])[0]
+        weights = [rng.random() * 0.3 / (1 + abs(i - peak)) for i in range(4)]
+        dist = [round(w, 2) for w in weights]
+        dist[peak] = 0
+        dist[peak] = round(1 - sum(dist), 2)
+        return json.dumps({"reasoning": self.pad(rng, rng.choice(REASONS)), "attitude_dist": dist})
+
+    def lessons(self, rng):
+        picked = rng.sample(LESSONS, rng.randint(1, 3))
+        return json.dumps([[self.pad(rng, lesson), round(rng.uniform(0.3, 1.0), 1)] for lesson in picked])
+
+    def tweet(self, rng):
+        return "* " + self.pad(rng, rng.choice(TWEETS))
+
+    def complete(self, messages, gen_seed=None, index=0, guided_json=None):
+        """The full text of one choice, before stop sequences and max_tokens."""
+        rng = self.content_rng(messages, gen_seed, index)
+        return getattr(self, infer_stage(messages, guided_json))(rng)
+
+    def draw_latency(self):
+        mean = self.latency_ms / 1000
+        if mean <= 0 or self.latency_dist == "constant":
+            return max(mean, 0.0)
+        if self.latency_dist == "uniform":
+            return self.rng.uniform(0, 2 * mean)
+        if self.latency_dist == "exponential":
+            return self.rng.expovariate(1 / mean)
+        sigma = 0.5
+        return mean * math.exp(self.rng.gauss(0, sigma) - sigma ** 2 / 2)
+
+    def respond(self, messages, max_tokens=None, gen_seed=None, n=1, guided_json=None, stop=None):
+        """Answer one chat request without sleeping; the caller waits response.latency seconds (blocking or not)."""
+        latency = self.draw_latency()
+        fault = self.rng.random()
+        if fault < self.rate_limit_rate:
+            return FakeResponse(429, latency=latency)
+        if fault < self.rate_limit_rate + self.error_rate:
+            return FakeResponse(500, latency=latency)
+        choices = []
+        for i in range(n):
+            text, finish_reason = apply_stop(self.complete(messages, gen_seed, i, guided_json), stop, max_tokens)
+            choices.append((text, finish_reason, count_tokens(text)))
+        prompt_tokens = sum(count_tokens(m["content"]) for m in messages)
+        latency += self.token_latency_ms / 1000 * max(tokens for _, _, tokens in choices)
+        return FakeResponse(200, choices, prompt_tokens, latency)
+
+    def request_generate(self, prompt, max_tokens=80, gen_seed=None, guided_json=None, stop=None, n=1):
+        """
+        Blocking in-process request with the contract of GenerationClient.request_generate.
+        :raises RateLimited: on a drawn 429, for the caller's backoff
+        """
+        response = self.respond(prompt, max_tokens, gen_seed, n, guided_json, stop)
+        time.sleep(response.latency)
+        return self.outputs(response, n, guided=guided_json is not None)
+
+    def outputs(self, response, n, guided=False):
+        """GenerationOutputs of a response; a server error fails all n choices."""
+        if response.status == 429:
+            raise RateLimited("fake backend rate limit")
+        if response.status != 200:
+            return [GenerationOutput() for _ in range(n)]
+        # the prompt of a request is billed once, on its first choice
+        return [GenerationOutput(
+            text,
+            response.prompt_tokens if i == 0 else 0,
+            tokens,
+            finish_reason,
+            guided=guided,
+            shared=i > 0
+        ) for i, (text, finish_reason, tokens) in enumerate(response.choices)]
+
+class HashingEncoder:
+    """
+    Stands in for the SentenceTransformer of the recommenders with fake models: a bag of hashed words,
+    so texts sharing words are similar, computed with numpy only.
+    """
+    def __init__(self, dim=384):
+        self.dim = dim
+
+    def encode(self, texts, **kwargs):
+        import numpy as np
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for word in str(text).lower().split():
+                h = int.from_bytes(hashlib.blake2b(word.encode(), digest_size=8).digest(), "little")
+                vectors[row, h % self.dim] += 1.0 if (h >> 32) & 1 else -1.0
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.where(norms > 0, norms, 1.0)
+
+def make_handler(backend, model_name, retry_after):
+    from http.server import BaseHTTPRequestHandler
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1" # keep-alive, clients reuse their connections
+
+        def send_json(self, status, payload, headers=None):
+            body = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            for key, value in (headers or {}).items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == "/health":
+                self.send_json(200, {})
+            elif self.path == "/v1/models":
+                self.send_json(200, {"object": "list", "data": [{"id": model_name, "object": "model", "owned_by": "fake"}]})
+            else:
+                self.send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length) or b"{}")
+            if self.path != "/v1/chat/completions":
+                self.send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+                return
+            n = int(request.get("n") or 1)
+            response = backend.respond(request.get("messages", []), request.get("max_tokens"), request.get("seed"), n, request.get("guided_json"), request.get("stop"))
+            time.sleep(response.latency)
+            if response.status == 429:
+                self.send_json(429, {"error": {"message": "Rate limit exceeded", "type": "rate_limit_error"}}, {"Retry-After": str(retry_after)})
+                return
+            if response.status != 200:
+                self.send_json(response.status, {"error": {"message": "Fake server error", "type": "server_error"}})
+                return
+            self.send_json(200, {
+                "id": f"chatcmpl-{hashlib.blake2b(json.dumps(request, default=str).encode(), digest_size=8).hexdigest()}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": request.get("model", model_name),
+                "choices": [{"index": i, "message": {"role": "assistant", "content": text}, "finish_reason": finish_reason} for i, (text, finish_reason, _) in enumerate(response.choices)],
+                "usage": {"prompt_tokens": response.prompt_tokens, "completion_tokens": response.completion_tokens, "total_tokens": response.prompt_tokens + response.completion_tokens}
+            })
+
+        def log_message(self, format, *args):
+            pass # one line per request drowns the output at load-test rates
+
+    return Handler
+
+def serve(port, backend, host="0.0.0.0", model_name=FAKE_HTTP_MODEL, retry_after=RETRY_AFTER):
+    """Serve /health, /v1/models and /v1/chat/completions until interrupted."""
+    from http.server import ThreadingHTTPServer
+
+    class LoadTestServer(ThreadingHTTPServer):
+        request_queue_size = 4096 # the default backlog of 5 refuses connections when a whole wave arrives at once
+        daemon_threads = True
+
+    server = LoadTestServer((host, port), make_handler(backend, model_name, retry_after))
+    print(f"Fake OpenAI-compatible server on {host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--host", type=str, default="0.0.0.0")
+    parser.add_argument("--latency_ms", type=float, default=0.0, help="Mean time to first token of a request")
+    parser.add_argument("--latency_dist", type=str, default="constant", choices=LATENCY_DISTS)
+    parser.add_argument("--token_latency_ms", type=float, default=0.0, help="Decode time per completion token")
+    parser.add_argument("--error_rate", type=float, default=0.0, help="Fraction of requests answered with HTTP 500")
+    parser.add_argument("--rate_limit_rate", type=float, default=0.0, help="Fraction of requests answered with HTTP 429")
+    parser.add_argument("--retry_after", type=int, default=RETRY_AFTER, help="Retry-After header of 429 responses, in seconds")
+    parser.add_argument("--completion_tokens", type=int, default=None, help="Pad every completion to about this many tokens")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    backend = FakeBackend(args.latency_ms, args.latency_dist, args.token_latency_ms, args.error_rate, args.rate_limit_rate, args.completion_tokens, args.seed)
+    serve(args.port, backend, host=args.host, retry_after=args.retry_after)
@@ -0,0 +1,50 @@
+# This file contains the data passed back from generation requests
+# request_generate returns a GenerationOutput per completion, and the stage-level request functions return the parsed value with the TokenUsage of all requests it took
+from dataclasses import dataclass
+
+TRUNCATED_FINISH_REASONS = ["length", "max_tokens"] # OpenAI/vLLM and Anthropic names for hitting max_tokens
+
+@dataclass
+class GenerationOutput:
+    text: str = None
+    prompt_tokens: int = 0 # as reported by the server
+    completion_tokens: int = 0
+    finish_reason: str = None
+    guided: bool = False # generated under a guided JSON schema
+    guided_fallback: bool = False # the server rejected the schema and the request was resent without it
+    shared: bool = False # one of the n completions of a request, but not its first
+    endpoint_error: bool = False # the server could not be reached, the request was not served
+    latency: float = 0.0 # seconds the request of this completion took, retries after rate limits included
+
+@dataclass
+class TokenUsage:
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    num_requests: int = 0 # completions, including the shared ones
+    last_response: str = None # text of the last request, i.e. the one whose parsed value was kept
+    guided_requests: int = 0
+    guided_fallbacks: int = 0
+    truncated: int = 0 # requests cut off by max_tokens
+    shared_requests: int = 0 # completions that came out of a request with n > 1, but not as its first choice
+    num_waves: int = 0 # waves the agent was sent in, i.e. one plus its retries
+    extra_samples: int = 0 # shared completions beyond the first of the agent's own samples, i.e. --attitude_samples
+
+    @property
+    def deduplicated_requests(self):
+        """Shared completions that stand in for a request of their own, i.e. not the agent's extra samples."""
+        return self.shared_requests - self.extra_samples
+
+    def add(self, output, extra_sample=False):
+        self.prompt_tokens += output.prompt_tokens
+        self.completion_tokens += output.completion_tokens
+        self.num_requests += 1
+        self.last_response = output.text
+        self.guided_requests += int(output.guided)
+        self.guided_fallbacks += int(output.guided_fallback)
+        self.truncated += int(output.finish_reason in TRUNCATED_FINISH_REASONS)
+        self.shared_requests += int(output.shared)
+        self.extra_samples += int(extra_sample)
+
+def completion_share(completion_tokens, n, i):
+    """The completion tokens of choice i when a request with n choices only reports the total."""
+    return completion_tokens // n + int(i < completion_tokens % n)
@@ -1,146 +1,94 @@
 from engines.engine import Engine
 import multiprocessing as mp
-import backoff
-import openai
-import os
-import time
-from openai import OpenAI, AzureOpenAI
-from anthropic import Anthropic
-from utils.utils import clean_response, parse_lessons
+from engines import worker
+from engines.endpoints import EndpointRegistry
+from engines.fake_backend import fake_mode
 from tqdm import tqdm  # Import tqdm for progress bars
-import numpy as np
 
 class DataParallelEngine(Engine):
-    def __init__(self, ports=None, *args, **kwargs):
+    def __init__(self, ports=None, endpoints=None, endpoints_file=None, *args, **kwargs):
+        """
+        :param ports: ports of vLLM servers on this host
+        :param endpoints, endpoints_file: host:port[:weight] servers, possibly on other hosts, used instead of ports (see engines/endpoints.py)
+        With --model_type fake no server is contacted, every endpoint stands for one simulated server (one worker process).
+        """
         super().__init__(*args, **kwargs)
-        self.ports = ports if ports and type(ports) == list else [80000]
-        self.num_processes = len(self.ports)
+        self.endpoints = EndpointRegistry.from_config(ports=ports, endpoints=endpoints, endpoints_file=endpoints_file)
+        self.ports = [e.key for e in self.endpoints.endpoints]
+        self.num_processes = len(self.endpoints)
+        self.pool = None # worker pool shared by all waves of a stage, or by concurrent runs when set from outside
+        self.client = worker.GenerationClient(self.model_type, fake_config=self.fake_config) # the only state sent to the workers
         # Each process gets a unique randomizer
-    
-    def init_client(self, port=None):
-        if "claude" in self.model_type:
-            return Anthropic(api_key=os.getenv("ANTHROPIC_API_KEY"))
-        elif "gpt" in self.model_type:
-            api_version = "2023-09-01-preview"
-            return AzureOpenAI(
-                api_key=os.getenv("OPENAI_API_KEY"),
-                api_version=api_version,
-                azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT")
-            )
-        else:
-            if port is None:
-                raise Exception("Port is not provided")
-            return OpenAI(base_url=f"http://0.0.0.0:{port}/v1")
 
-    @backoff.on_exception(backoff.expo, openai.RateLimitError)
-    def request_generate(self, prompt, port, max_tokens=80, day=None, gen_seed=None):
-        try:
-            client = self.init_client(port)
-            if "claude" in self.model_type:
-                gen_func = client.messages.create
-                args = {
-                    "model": self.model_type,
-                    "system": prompt[0]['content'],
-                    "messages": [prompt[1]],
-                    "max_tokens": max_tokens,
-                    "temperature": 0.7
-                }
-            else:
-                gen_func = client.chat.completions.create # Use the same randomizer, state preserved across calls
-                # print(f"Generation Seed: {gen_seed}")
-                args = {
-                    "model": self.model_type,
-                    "messages": prompt,
-                    "seed": gen_seed,
-                    "max_tokens": max_tokens,
-                    "temperature": 0.7
-                }
-            completion = gen_func(**args)
-            if "claude" in self.model_type:
-                return completion.content[0].text
-            return completion.choices[0].message.content
-        except:
-            raise Exception("Error in request_generate")
-
-    def request_generate_lesson(self, prompt, port, max_tokens=80, day=None, gen_seed=None):
-        num_iter = 0
-        while num_iter < self.max_iter:
-            response = self.request_generate(prompt, port, max_tokens=max_tokens, gen_seed=gen_seed)
-            try:
-                new_lessons = parse_lessons(response, day=day)
-                return new_lessons
-            except Exception as e:
-                num_iter += 1
-                print("Error in parsing lessons", e)
-                print(response)
-        
-        raise Exception("Error in request_generate_lesson")
-
-    def request_generate_attitude(self, prompt, port, max_tokens=80, day=None, gen_seed=None):
-        num_iter = 0
-        success = False
-        while not success and num_iter < self.max_iter:
-            response = self.request_generate(prompt, port, max_tokens=max_tokens, gen_seed=gen_seed)
-            num_iter += 1
-            attitude_json, success = self.parse_attitude(response)
-        return attitude_json
-
-    def request_generate_actions(self, prompt, port, max_tokens=80, day=None, gen_seed=None):
-        action = ""
-        while len(action) < 2:
-            response = self.request_generate(prompt, port, max_tokens=max_tokens, gen_seed=gen_seed)
-            action = clean_response(response)
-        return action
+    @property
+    def local_servers(self):
+        """Requests go to our own vLLM endpoints rather than to a hosted API."""
+        return "claude" not in self.model_type and "gpt" not in self.model_type and fake_mode(self.model_type) != "local"
 
-    def chunkify(self, lst, n):
-        """Split list into chunks of size n."""
-        for i in range(0, len(lst), n):
-            yield lst[i:i + n]
+    def request_generate(self, prompt, endpoint, max_tokens=80, day=None, gen_seed=None, guided_json=None, stop=None, n=1):
+        """
+        :return: list of n GenerationOutput, the choices of one request
+        """
+        return self.client.request_generate(prompt, endpoint, max_tokens, day, gen_seed, guided_json, stop, n)
 
-    def generate(self, max_tokens, day, f):
-        print(f"Stage: {self.stage}, generation started")
-        start = time.time()
-        func_call_dic = {
-            "generate": self.request_generate,
-            "generate_attitude": self.request_generate_attitude,
-            "generate_actions": self.request_generate_actions,
-            "generate_lessons": self.request_generate_lesson
-        }
-        results = []
-        # Single port handling: 
+    def draw_generation_seeds(self, n):
         if self.num_processes == 1:
-            for i, msg in enumerate(tqdm(self.context, desc="Generating")):
-                gen_seed = int(self.rng.integers(0, 10000, size=1)[0])
-                self.logger.info(f"Batch {i}: Seeds: {gen_seed}")
-                res = func_call_dic[f](msg, self.ports[0], max_tokens, day, gen_seed)  # Use randomizer for process 0
-                results.append(res)
+            return super().draw_generation_seeds(n)
+        # one seed per process for every chunk of num_processes agents, the last chunk included
+        num_chunks = (n + self.num_processes - 1) // self.num_processes
+        return super().draw_generation_seeds(num_chunks * self.num_processes)[:n]
 
-        # Multi-process case
-        else:
-            batches = list(self.chunkify(self.context, self.num_processes))
+    def send(self, requests):
+        self.metrics.add("inflight_requests", len(requests), help="Requests sent and not answered yet")
+        try:
+            if self.pool is None:
+                return [self.request_generate(*request) for request in tqdm(requests, desc="Generating")]
+            # chunksize=1 hands out one request at a time, so a slow response only holds up its own worker
+            return self.pool.starmap(worker.request_generate, requests, chunksize=1)
+        finally:
+            self.metrics.add("inflight_requests", -len(requests))
 
-            with mp.get_context('spawn').Pool(processes=self.num_processes) as pool:
-                for i, batch in enumerate(batches):
-                    # Ensure number of seeds matches the number of processes
-                    generation_seeds = [int(s) for s in self.rng.integers(0, 10000, size=self.num_processes)]
-                    
-                    # Map ports to processes cyclically if processes > ports
-                    ports = [self.ports[idx % len(self.ports)] for idx in range(self.num_processes)]
-                    self.logger.info(f"Batch {i}: Seeds {generation_seeds} and Ports {ports}")
-                    # Use ports and seeds mapped to the same processes consistently
-                    res = pool.starmap(
-                        func_call_dic[f],
-                        [
-                            (msg, port, max_tokens, day, generation_seeds[idx])
-                            for idx, (msg, port) in enumerate(zip(batch, ports))
-                        ]
-                    )
-                    results.extend(res)
-            if isinstance(results[0], str):
-                results = [clean_response(r) for r in results]
-        end = time.time()
-        self.logger.info(f"Stage: {self.stage}, generation finished in {end - start:.2f} seconds")
-        print(f"Stage: {self.stage}, generation finished")
-        print(f"Time taken for execution: {end - start}")
-        return results
+    def _dispatch(self, messages, ids, seeds, max_tokens, guided_json=None, stop=None, n=None):
+        n = [1] * len(messages) if n is None else n
+        requests, agents = [], []
+        for msg, k, seed, num in zip(messages, ids, seeds, n):
+            endpoint = self.endpoints.endpoint_for(k).key # every agent is pinned to one server
+            if "claude" in self.model_type:
+                # no n parameter, one request per completion
+                requests.extend([(msg, endpoint, max_tokens, None, seed, guided_json, stop, 1)] * num)
+                agents.extend([k] * num)
+            else:
+                requests.append((msg, endpoint, max_tokens, None, seed, guided_json, stop, num))
+                agents.append(k)
+        outputs = self.send(requests)
+        # requests dropped by an unreachable server go to the remaining servers, until every server was tried once
+        for _ in range(len(self.endpoints)):
+            dropped = [r for r, choices in enumerate(outputs) if choices[0].endpoint_error]
+            if len(dropped) == 0 or not self.local_servers:
+                break
+            for endpoint in sorted(set(requests[r][1] for r in dropped)):
+                self.endpoints.mark_failed(endpoint)
+            for r in dropped:
+                requests[r] = (requests[r][0], self.endpoints.endpoint_for(agents[r]).key) + requests[r][2:]
+            print(f"Stage: {self.stage}, re-dispatching {len(dropped)} requests to {[e.key for e in self.endpoints.alive]}")
+            for r, choices in zip(dropped, self.send([requests[r] for r in dropped])):
+                outputs[r] = choices
+        return [output for choices in outputs for output in choices]
 
+    def open_pool(self, processes=None):
+        """A spawn pool of generation workers, num_processes of them by default."""
+        processes = self.num_processes if processes is None else processes
+        return mp.get_context('spawn').Pool(processes=processes, initializer=worker.init_worker, initargs=(self.client,))
+
+    def generate(self, max_tokens, day, f):
+        if self.local_servers:
+            alive = self.endpoints.check_all()
+            print(f"Stage: {self.stage}, {len(alive)}/{len(self.endpoints)} endpoints healthy")
+        if self.num_processes == 1 or self.pool is not None:
+            return super().generate(max_tokens, day, f)
+        with self.open_pool() as pool:
+            self.pool = pool
+            try:
+                return super().generate(max_tokens, day, f)
+            finally:
+                self.pool = None
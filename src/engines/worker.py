@@ -0,0 +1,149 @@
+# This file contains the entry point of the generation worker processes of DataParallelEngine
+# A spawned worker imports only this module and the client library of the backend in use,
+# and receives its GenerationClient once in the pool initializer instead of a pickled engine with every request
+import os
+import time
+from engines.generation import GenerationOutput, completion_share
+from engines.fake_backend import FakeBackend, RateLimited, fake_mode
+
+class GenerationClient:
+    """Sends one chat request to a vLLM/OpenAI server, Azure OpenAI, Anthropic or the in-process fake backend, depending on the model type."""
+    def __init__(self, model_type, fake_config=None):
+        """
+        :param fake_config: keyword arguments of FakeBackend, used when model_type is "fake"
+        """
+        self.model_type = model_type
+        self.guided_rejected = False # the server rejected a guided JSON schema, stop sending them
+        self._request = None # request_generate wrapped with backoff, built on first use
+        self.fake = None
+        if fake_mode(model_type) == "local":
+            self.fake = FakeBackend(**(fake_config or {}))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_request"] = None # bound wrappers are rebuilt in the worker
+        return state
+
+    def init_client(self, endpoint=None):
+        """
+        :param endpoint: "host:port" of a vLLM server, or a port on this host
+        """
+        if "claude" in self.model_type:
+            from anthropic import Anthropic
+            return Anthropic(api_key=os.getenv("ANTHROPIC_API_KEY"))
+        elif "gpt" in self.model_type:
+            from openai import AzureOpenAI
+            api_version = "2023-09-01-preview"
+            return AzureOpenAI(
+                api_key=os.getenv("OPENAI_API_KEY"),
+                api_version=api_version,
+                azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT")
+            )
+        else:
+            if endpoint is None:
+                raise Exception("Endpoint is not provided")
+            if ":" not in str(endpoint):
+                endpoint = f"0.0.0.0:{endpoint}"
+            from openai import OpenAI
+            # vLLM and the fake server accept any key, but the client refuses to start without one
+            return OpenAI(base_url=f"http://{endpoint}/v1", api_key=os.getenv("OPENAI_API_KEY", "EMPTY"))
+
+    def request_generate(self, prompt, endpoint, max_tokens=80, day=None, gen_seed=None, guided_json=None, stop=None, n=1):
+        """
+        :return: list of n GenerationOutput, the choices of one request
+        """
+        if self._request is None:
+            import backoff
+            if self.fake is not None:
+                self._request = backoff.on_exception(backoff.expo, RateLimited)(self._fake_request_generate)
+            else:
+                import openai
+                self._request = backoff.on_exception(backoff.expo, openai.RateLimitError)(self._request_generate)
+        start = time.perf_counter()
+        outputs = self._request(prompt, endpoint, max_tokens, day, gen_seed, guided_json, stop, n)
+        latency = time.perf_counter() - start
+        for output in outputs:
+            output.latency = latency
+        return outputs
+
+    def _fake_request_generate(self, prompt, endpoint, max_tokens=80, day=None, gen_seed=None, guided_json=None, stop=None, n=1):
+        return self.fake.request_generate(prompt, max_tokens, gen_seed, guided_json, stop, n)
+
+    def _request_generate(self, prompt, endpoint, max_tokens=80, day=None, gen_seed=None, guided_json=None, stop=None, n=1):
+        import openai
+        try:
+            client = self.init_client(endpoint)
+            if "claude" in self.model_type:
+                gen_func = client.messages.create
+                args = {
+                    "model": self.model_type,
+                    "system": prompt[0]['content'],
+                    "messages": prompt[1:],
+                    "max_tokens": max_tokens,
+                    "temperature": 0.7
+                }
+                stop = [s for s in stop if s.strip()] if stop else None # whitespace-only stop sequences are rejected
+                if stop:
+                    args["stop_sequences"] = stop
+            else:
+                gen_func = client.chat.completions.create # Use the same randomizer, state preserved across calls
+                # print(f"Generation Seed: {gen_seed}")
+                args = {
+                    "model": self.model_type,
+                    "messages": prompt,
+                    "seed": gen_seed,
+                    "max_tokens": max_tokens,
+                    "temperature": 0.7
+                }
+                if n > 1:
+                    args["n"] = n
+                if stop:
+                    args["stop"] = stop
+                if guided_json is not None and not self.guided_rejected:
+                    args["extra_body"] = {"guided_json": guided_json}
+            guided_fallback = False
+            try:
+                completion = gen_func(**args)
+            except openai.BadRequestError as e:
+                if "extra_body" not in args:
+                    raise e
+                # the backend does not support guided decoding, resend without the schema
+                print(f"Guided decoding rejected by the server: {e}")
+                args.pop("extra_body")
+                guided_fallback = True
+                self.guided_rejected = True
+                completion = gen_func(**args)
+            if "claude" in self.model_type:
+                return [GenerationOutput(completion.content[0].text, completion.usage.input_tokens, completion.usage.output_tokens, completion.stop_reason)]
+            usage = completion.usage
+            prompt_tokens = usage.prompt_tokens if usage else 0
+            completion_tokens = usage.completion_tokens if usage else 0
+            # the prompt of a request is billed once, on its first choice
+            return [GenerationOutput(
+                choice.message.content,
+                prompt_tokens if i == 0 else 0,
+                completion_share(completion_tokens, len(completion.choices), i),
+                choice.finish_reason,
+                guided="extra_body" in args,
+                guided_fallback=guided_fallback,
+                shared=i > 0
+            ) for i, choice in enumerate(completion.choices)]
+        except openai.RateLimitError as e:
+            raise e # retried by backoff
+        except openai.APIConnectionError as e:
+            # the server did not answer (refused, reset or timed out), the engine sends the request to another endpoint
+            print(f"Endpoint {endpoint} unreachable: {e}")
+            return [GenerationOutput(endpoint_error=True) for _ in range(n)]
+        except Exception as e:
+            # a failed request counts as failed responses and is resubmitted in the next wave
+            print(f"Error in request_generate: {e}")
+            return [GenerationOutput() for _ in range(n)]
+
+_client = None # the GenerationClient of this worker process
+
+def init_worker(client):
+    global _client
+    _client = client
+
+def request_generate(*request):
+    return _client.request_generate(*request)
@@ -1,5 +1,4 @@
 from recommenders.recommender import Recommender
-from sklearn.metrics.pairwise import cosine_similarity
 import numpy as np
 
 class NewsRecommender(Recommender):
@@ -21,6 +20,7 @@ class NewsRecommender(Recommender):
         :return: updated_similarity_matrix - numpy array of shape (k, N, N2) - updated similarity scores.
         """
 
+        from sklearn.metrics.pairwise import cosine_similarity
         k, N = len(self.indices), len(self.indices[0])
         N2 = len(self.news_indices)
         
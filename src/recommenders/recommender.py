@@ -1,12 +1,17 @@
-from sentence_transformers import SentenceTransformer
 import numpy as np
-import torch
 import random
+import sys
 
 class Recommender:
-    def __init__(self, model_name='paraphrase-MiniLM-L6-v2', time_decay_rate=0.9):
+    def __init__(self, model_name='paraphrase-MiniLM-L6-v2', time_decay_rate=0.9, model=None):
+        """
+        :param model: an already loaded SentenceTransformer to share, loaded from model_name if None
+        """
         self.device='cpu'
-        self.model = SentenceTransformer(model_name, device=self.device)
+        if model is None:
+            from sentence_transformers import SentenceTransformer # imported here, it pulls in torch
+            model = SentenceTransformer(model_name, device=self.device)
+        self.model = model
         self.set_seed(42)
         self.indices = None
         self.agents = None 
@@ -18,9 +23,12 @@ class Recommender:
         """Sets random seed for reproducibility."""
         random.seed(seed)
         np.random.seed(seed)
-        torch.manual_seed(seed)
-        if torch.cuda.is_available():
-            torch.cuda.manual_seed_all(seed)
+        # torch is only loaded with a SentenceTransformer, the hashing encoder of fake models does not need it
+        if "torch" in sys.modules:
+            torch = sys.modules["torch"]
+            torch.manual_seed(seed)
+            if torch.cuda.is_available():
+                torch.cuda.manual_seed_all(seed)
             
     # def build_profile_index(self):
     #     # add profile embedding
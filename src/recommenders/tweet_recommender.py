@@ -1,107 +1,87 @@
 from recommenders.recommender import Recommender
-from sklearn.metrics.pairwise import cosine_similarity
 from utils.logging_utils import log_info
 import numpy as np
 
 class TweetRecommender(Recommender):
-    def __init__(self, model_name = 'paraphrase-MiniLM-L6-v2', time_decay_rate=0.95, alpha=0.3, *args, **kwargs):
+    def __init__(self, model_name = 'paraphrase-MiniLM-L6-v2', time_decay_rate=0.95, alpha=0.3, max_block_elements=2**23, *args, **kwargs):
         super().__init__(model_name, time_decay_rate, *args, **kwargs)
         self.alpha = alpha # weight of following relation
+        self.max_block_elements = max_block_elements # bounds the (agents x agents x tweets) scores held in memory at once
+        self.latest_embeddings = None # normalized embedding of every agent's newest tweet
+        self.num_tweets = 0
+        self.population = None
 
-    
-    def build_or_update_similarity_matrix(self):
+    def build_or_update_tweets_index(self):
         """
-        Compute the similarity matrix for all agents' tweets.
-        # similarity_matrix_3d[0][1][2][4] == similarity_matrix_3d[1][0][4][2]
-        # or: similarity between Agent 0's 3rd tweet and Agent 1's 5th tweet
-        :return: None but updates the similarity_matrix_3d attribute
+        Encode the newest tweet of every agent.
+        Only the newest embeddings are kept: recommendations score an agent's newest tweet against the tweets of all other agents.
         """
-        assert len(self.indices) > 0, "Please build or update the index first"
-
-        num_tweets = len(self.indices[0])
-
-        if self.similarity_matrix_3d is None:
-            self.similarity_matrix_3d = np.zeros((self.num_agents, self.num_agents, num_tweets, num_tweets))
-            for i in range(self.num_agents):
-                for j in range(self.num_agents):
-                    if i != j:
-                        sim = cosine_similarity(self.indices[i], self.indices[j])
-                        self.similarity_matrix_3d[i, j] = sim 
-                        
-        else:  # Update similarity matrix
-            extended_similarity_matrix_3d = np.pad(self.similarity_matrix_3d, ((0, 0), (0, 0), (0, 1), (0, 1)), mode='constant', constant_values=0)
-            new_embeddings = np.array([self.indices[i][-1] for i in range(len(self.indices))])
-
-            # Apply decay to all existing similarities
-            for i in range(self.num_agents):
-                for j in range(self.num_agents):
-                    if i != j:  # Skip self-similarity if not needed
-                        sim_i_to_j = cosine_similarity([new_embeddings[i]], [self.indices[j][-1]])
-                        sim_j_to_i = cosine_similarity([new_embeddings[j]], [self.indices[i][-1]])
+        recent_tweets = [a.get_most_recent_tweets() for a in self.agents]  # List of tweets
+        assert recent_tweets[0] != None, ValueError("No tweets found. Probably the agent has not tweeted yet.")
+        tweet_embeddings = np.asarray(self.encode_items(recent_tweets, is_tweet=True), dtype=np.float32)
+        norms = np.linalg.norm(tweet_embeddings, axis=1, keepdims=True)
+        self.latest_embeddings = tweet_embeddings / np.where(norms == 0, 1, norms)
+        self.num_tweets += 1
 
-                        # decay the old similarities
-                        extended_similarity_matrix_3d[i, j] *= self.time_decay_rate
-                        extended_similarity_matrix_3d[j, i] *= self.time_decay_rate
-
-                        # Update similarity matrix with new similarities and decay factor
-                        # breakpoint()
-                        extended_similarity_matrix_3d[i, j, -1, :-1] = sim_i_to_j * self.time_decay_rate
-                        extended_similarity_matrix_3d[j, i, :-1, -1] = sim_j_to_i.T * self.time_decay_rate
-            
-            # don't compute self-similarity
-            self.similarity_matrix_3d = extended_similarity_matrix_3d
-        
-        # Apply following relation
-        self.extend_following_similarity_graph()
-        self.similarity_matrix_3d += self.following_graph
-
-    def sample_top_k_sim_of_an_agent_new_tweets(self, agent_index, k):
+    def build_or_update_similarity_matrix(self):
         """
-        Sample the top k similarities between the new tweets of an agent and the tweets of other agents.
-        :param agent_index: int - the index of the agent
-        :param k: int - the number of similarities to recommend
-        :return: list of tuples - the top k similarities for the agent, each tuple contains the index of the agent, the index of the tweet, and the similarity score.
+        Record whether this is the first build of the similarity scores.
+        Scores are computed lazily per block of agents in `score_new_tweets` instead of a (num_agents, num_agents, num_tweets, num_tweets) matrix.
         """
+        assert self.latest_embeddings is not None, "Please build or update the index first"
+        self.first_build = self.num_tweets == 1
 
-        relevant_slice = self.similarity_matrix_3d[agent_index, :, -1, :] # get the similarities of new tweets of agent at agent_index with all other agents
+    def score_new_tweets(self, rows):
+        """
+        Score the newest tweet of each agent in rows against every tweet of every agent.
+        :param rows: array of agent indices
+        :return: numpy array of shape (len(rows), num_agents, num_tweets)
+        The scores are those of the newest row of the pairwise similarity matrix:
+        - on the first build, the cosine similarity between newest tweets plus the following bias
+        - afterwards, every older tweet of agent j carries the decayed similarity between the newest tweets of the two agents
+          (decayed twice when i < j, because the pairwise update visits (i, j) before (j, i)),
+          and the newest tweet of agent j only carries the following bias
+        """
+        num_agents, num_tweets = self.num_agents, self.num_tweets
+        similarities = (self.latest_embeddings[rows] @ self.latest_embeddings.T).astype(np.float64)
+        follow_bias = self.alpha * self.population.follow_weights(rows)
+        if not self.first_build:
+            decay = self.time_decay_rate
+            upper = rows[:, None] < np.arange(num_agents)[None, :]
+            similarities *= np.where(upper, decay * decay, decay)
+        similarities[np.arange(len(rows)), rows] = 0 # don't compute self-similarity
+        scores = np.empty((len(rows), num_agents, num_tweets))
+        if self.first_build:
+            scores[:] = (similarities + follow_bias)[:, :, None]
+        else:
+            scores[:, :, :-1] = (similarities + follow_bias)[:, :, None]
+            scores[:, :, -1] = follow_bias
+        return scores
 
-        # Flatten the slice to simplify finding the top_k values
-        flat_slice = relevant_slice.flatten()
-        
-        # Determine the top-K indices in the flattened array
-        top_k_indices_flat = np.argpartition(flat_slice, -k)[-k:]
-        top_k_indices_flat = top_k_indices_flat[np.argsort(-flat_slice[top_k_indices_flat])]
-        
-        # Get dimensions of the relevant slice
-        num_agents = relevant_slice.shape[0]
-        num_tweets = relevant_slice.shape[1]
-        
-        # Convert flat indices back to (agent, tweet) indices
-        top_k_indices = np.unravel_index(top_k_indices_flat, (num_agents, num_tweets))
-        
-        # Zip the indices with the corresponding similarity values
-        top_k_values = [(top_k_indices[0][i], top_k_indices[1][i], flat_slice[top_k_indices_flat[i]]) for i in range(k)]
-        
-        return top_k_values
-    
-    def extend_following_similarity_graph(self):
+    def sample_top_k_sim_of_new_tweets(self, rows, k):
         """
-        Build a following similairty graph from the agents' following lists.
-        It's not to build new following graph, but to extend the existing one with a new shape
-        :return: list of lists - the following graph
+        Sample the top k similarities between the new tweets of agents and the tweets of other agents.
+        :param rows: array of agent indices
+        :param k: int - the number of similarities to recommend
+        :return: list of lists of tuples - for each agent the top k (agent index, tweet index, similarity score), highest first.
         """
-        self.following_graph = np.zeros(self.similarity_matrix_3d.shape)
-        for i in range(self.num_agents):
-            for j in range(self.num_agents):
-                if i != j:
-                    # if agent i follows agent j, add a similarity score
-                    if j in self.agents[i].following:
-                        follow_score = self.agents[i].following[j]
-                        self.following_graph[i, j, :, :] = np.full(self.following_graph[i, j, :, :].shape, self.alpha * follow_score)
+        scores = self.score_new_tweets(rows)
+        flat = scores.reshape(len(rows), -1)
+        top_k_flat = np.argpartition(flat, -k, axis=1)[:, -k:]
+        top_k_scores = np.take_along_axis(flat, top_k_flat, axis=1)
+        order = np.argsort(-top_k_scores, axis=1)
+        top_k_flat = np.take_along_axis(top_k_flat, order, axis=1)
+        top_k_scores = np.take_along_axis(top_k_scores, order, axis=1)
+        agent_indices, tweet_indices = np.unravel_index(top_k_flat, (self.num_agents, self.num_tweets))
+        return [list(zip(agent_indices[r].tolist(), tweet_indices[r].tolist(), top_k_scores[r].tolist())) for r in range(len(rows))]
+
+    def sample_top_k_sim_of_an_agent_new_tweets(self, agent_index, k):
+        return self.sample_top_k_sim_of_new_tweets(np.array([agent_index]), k)[0]
 
     def update_recommender(self, agents):
         self.agents = agents
         self.num_agents = len(agents)
+        self.population = agents[0].population # agents are views of one Population
         with log_info():
             self.build_or_update_tweets_index()
         with log_info():
@@ -110,10 +90,11 @@ class TweetRecommender(Recommender):
     def recommend(self, agents, num_recommendations=10):
         self.update_recommender(agents)
         recommendations = []
-        all_tweets = [a.get_all_tweets() for a in self.agents]
-        for i in range(self.num_agents):
-            top_k_values = self.sample_top_k_sim_of_an_agent_new_tweets(i, num_recommendations)
-            for j in range(num_recommendations):
-                agent_index, tweet_index, similarity = top_k_values[j]
-                recommendations.append((i, all_tweets[agent_index][tweet_index].text, similarity))
-        return recommendations
\ No newline at end of file
+        tweets = self.population.tweets
+        block_size = max(1, self.max_block_elements // (self.num_agents * self.num_tweets))
+        for start in range(0, self.num_agents, block_size):
+            rows = np.arange(start, min(start + block_size, self.num_agents))
+            for i, top_k_values in zip(rows.tolist(), self.sample_top_k_sim_of_new_tweets(rows, num_recommendations)):
+                for agent_index, tweet_index, similarity in top_k_values:
+                    recommendations.append((i, tweets[agent_index, tweet_index].text, similarity))
+        return recommendations
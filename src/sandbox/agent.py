@@ -1,29 +1,76 @@
 from sandbox.tweet import Tweet
 from utils.utils import compile_enumerate
+from utils.token_utils import count_tokens
 from sandbox.prompts import name_to_model
 from sandbox.vh_exp import ED_EXP
+from sandbox.population import Population
+from sandbox.lesson import LessonMemory
 
 class Agent:
-    def __init__(self, profile, k=5):
+    def __init__(self, profile, k=5, population=None, row=0, lesson_capacity=50):
         self.gender = profile['Gender']
         self.age = profile['Age']
         self.occupation = profile['Occupation']
         self.education = profile['Education']
         self.pb = profile['Political belief']
         self.religion = profile['Religion']
-        self.attitudes = []
+        # attitudes, attitude distributions, reasoning, tweets, risk and following live in a shared Population
+        self.population = population if population is not None else Population(1)
+        self.row = row # index of this agent in the population arrays
         self.max_reflections = k
         self.changes = []
-        self.policy = None
-        self.reasoning = []
-        self.attitude_dist = []
-        self.lessons = set([]) # a queue of triples (reflection, time, importance)
+        self._policy = None
+        self.lessons = LessonMemory(capacity=lesson_capacity, k=k) # bounded store of (reflection, time, importance)
         self.reflections = [] # the top k reflections with highest scores (lesson, score)
-        self.tweets = []
-        self.risk = None
-        # self.vaccine = False
-        self.following = {} # should be a list of tuple (id, weight)
-        # self.disease_status = "Susceptible"
+
+    @property
+    def attitudes(self):
+        return self.population.attitudes_of(self.row)
+
+    @property
+    def attitude_dist(self):
+        return self.population.attitude_dist_of(self.row)
+
+    @property
+    def reasoning(self):
+        return self.population.reasoning_of(self.row)
+
+    @property
+    def tweets(self):
+        return self.population.tweets_of(self.row)
+
+    @property
+    def risk(self):
+        return self.population.risk_of(self.row)
+
+    @risk.setter
+    def risk(self, risk):
+        self.population.set_risk(risk, rows=[self.row])
+
+    @property
+    def disease_status(self):
+        return self.population.disease_status_of(self.row) # Susceptible, Infected, Recovered or Vaccinated
+
+    @property
+    def vaccine(self):
+        return bool(self.population.vaccinated[self.row])
+
+    @property
+    def following(self):
+        return self.population.following_of(self.row) # a dictionary of id to weight
+
+    @property
+    def policy(self):
+        return self._policy
+
+    @policy.setter
+    def policy(self, policy):
+        if policy is not self._policy:
+            self.population.profile_version[self.row] += 1 # the policy is part of the rendered profile
+        self._policy = policy
+
+    def add_poll(self, attitude, attitude_dist, reasoning):
+        self.population.record_poll([attitude], [attitude_dist], [reasoning], rows=[self.row])
     
     def custom_init(self, gender, age, occupation, education, pb, religion):
         self.gender = gender
@@ -32,45 +79,37 @@ class Agent:
         self.education = education
         self.pb = pb
         self.religion = religion
+        self.population.profile_version[self.row] += 1
     
     def remove_lessons(self, lessons):
-        for lesson in lessons:
-            if lesson in self.lessons:
-                self.lessons.remove(lesson)
+        self.lessons.remove(lessons)
 
     def add_lessons(self, lessons):
-        for l in lessons:
-            if l not in self.lessons:
-                self.lessons.add(l)
+        self.lessons.add(lessons)
 
     def retrieve_reflections(self, current_time):
-        reflections = [(lesson.text, lesson.score(current_time)) for lesson in self.lessons]
-        reflections = [(r[0], r[1]) for r in reflections if r[1] > 0.05]
-        scores = [reflection[1] for reflection in reflections]
-        min_score = min(scores)
-        max_score = max(scores)
-        if min_score == max_score:
-            min_score = 0
-            max_score = 1
-        normalized_scores = [round((score-min_score) / (max_score - min_score), 2) for score in scores]
-        reflections = [(reflections[i][0], normalized_scores[i]) for i in range(len(reflections))]
-        reflections.sort(key=lambda x: x[1], reverse=True)
-        self.reflections = reflections[:self.max_reflections]
+        self.reflections = self.lessons.top_k(current_time)
 
     
-    def get_reflections(self, current_time):
+    def get_reflections(self, current_time, token_budget=None, model_type=None):
         if len(self.lessons) == 0:
             return ""
-        # print("Lessons: ", self.lessons)
-        # print("Lessons: ", [(lesson.text, lesson.time, lesson.importance) for lesson in self.lessons])
         self.retrieve_reflections(current_time)
+        ret_str = self.render_reflections()
+        # drop the least influential lessons until the section fits the budget
+        while token_budget is not None and len(self.reflections) > 1 and count_tokens(ret_str, model_type) > token_budget:
+            self.reflections = self.reflections[:-1]
+            ret_str = self.render_reflections()
+        return ret_str
+
+    def render_reflections(self):
         ret_str = "Below are the most influential lessons to your opinions on vaccinations, shown in ascending order of their importance (a float on a scale of 0-1):\n"
         ret_str += compile_enumerate([(reflection[0], reflection[1]) for reflection in self.reflections[::-1]], header="Lessons")
         ret_str += "\n Please consider these lessons carefully when you make your decisions.\n"
         return ret_str
 
     def update_tweets(self, tweet_text, tweet_time):
-        self.tweets.append(Tweet(tweet_text, tweet_time))
+        self.population.add_tweets([Tweet(tweet_text, tweet_time, self.row)], rows=[self.row])
     
     def get_all_tweets(self):
         return self.tweets
@@ -79,18 +118,25 @@ class Agent:
         return compile_enumerate([tweet.text for tweet in self.tweets], header="Tweets")
     
     def get_most_recent_tweets(self):
-        if len(self.tweets) == 0:
+        num_tweets = self.population.num_tweets[self.row]
+        if num_tweets == 0:
             print("No tweets found. Probably the agent has not tweeted yet.")
             return None
-        return self.tweets[-1]
+        return self.population.tweets[self.row, num_tweets - 1]
 
     def get_profile_str(self, disease_name=None):
         profile_str = f'''Gender: {self.gender}\tAge: {self.age}\tEducation: {self.education}\tOccupation: {self.occupation}\tPolitical belief: {self.pb}\tReligion: {self.religion}\t'''     
-        if len(self.attitudes) > 0:
-            profile_str += f"\tInitial Attitude towards {disease_name} Vaccination: {self.attitudes[0]}. Reasoning: {self.reasoning[0]}."
-            profile_str += f"\tMost recent attitude: {self.attitudes[-1]}. Reasoning: {self.reasoning[-1]}. Attitude Distribution: {self.attitude_dist[-1]}."
-        if self.risk != None:
-            profile_str += f"Current Disease Risk: {self.risk}. {ED_EXP}."
+        population, row = self.population, self.row
+        last_poll = population.num_polls[row] - 1
+        if last_poll >= 0:
+            profile_str += f"\tInitial Attitude towards {disease_name} Vaccination: {population.attitudes[row, 0]}. Reasoning: {population.reasoning[row, 0]}."
+            profile_str += f"\tMost recent attitude: {population.attitudes[row, last_poll]}. Reasoning: {population.reasoning[row, last_poll]}. Attitude Distribution: {population.attitude_dist[row, last_poll].tolist()}."
+        risk = self.risk
+        if risk != None:
+            profile_str += f"Current Disease Risk: {risk}. {ED_EXP}."
+        infected_share = population.infected_share_of(row)
+        if infected_share != None:
+            profile_str += f"Your Health: {self.disease_status}{', vaccinated' if self.vaccine else ''}. Currently {infected_share}% of the people you follow are infected."
         if self.policy != None:
             profile_str += f"Current Policy: {self.policy.content}. Current Policy Strength: {self.policy.strength} This policy is enforced by the government authority will affect your life and stance on vaccination accordingly. The effect may vary based on the policy strength."
         return profile_str
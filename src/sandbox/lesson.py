@@ -1,3 +1,5 @@
+import numpy as np
+
 class Lesson():
     def __init__(self, text, time, importance, time_decay_rate=0.995):
         self.text = text
@@ -17,4 +19,146 @@ class Lesson():
         return self.text == other.text 
         
     def __hash__(self):
-        return hash(self.text)
\ No newline at end of file
+        return hash(self.text)
+
+class LessonMemory():
+    """
+    A bounded, array-backed store of an agent's lessons.
+    Lesson.score(t) = importance + decay ** (t - time) = importance + decay ** t * decay ** (-time),
+    so every lesson keeps a fixed weight decay ** (-time) and one shared per-day factor decay ** t scores them all.
+    Within a day the ranking of stored lessons does not change, so the cached top-k is only merged with newly added lessons.
+    When the memory is full, the lessons with the lowest current score are evicted.
+    """
+    def __init__(self, capacity=50, k=5, time_decay_rate=0.995, min_score=0.05):
+        self.capacity = capacity # None means unbounded
+        self.k = k
+        self.time_decay_rate = time_decay_rate
+        self.min_score = min_score
+        size = capacity if capacity is not None else 16
+        self.texts = np.empty(size, dtype=object)
+        self.importance = np.zeros(size)
+        self.time = np.zeros(size, dtype=np.int32)
+        self.weight = np.zeros(size) # time_decay_rate ** (-time)
+        self.size = 0
+        self.slots = {} # text -> slot
+        self.version = 0 # increases whenever lessons are added or removed
+        self.invalidate()
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, lesson):
+        return lesson.text in self.slots
+
+    def __iter__(self):
+        for slot in range(self.size):
+            yield Lesson(self.texts[slot], int(self.time[slot]), float(self.importance[slot]), self.time_decay_rate)
+
+    def invalidate(self):
+        self.cache_time = None
+        self.top_slots = None # slots of the cached top-k, best first
+        self.top_scores = None
+        self.score_range = None # (min, max) of the scores above min_score
+
+    def scores(self, current_time, slots=None):
+        slots = slice(0, self.size) if slots is None else slots
+        return self.importance[slots] + self.time_decay_rate ** current_time * self.weight[slots]
+
+    def _grow(self, min_size):
+        size = max(min_size, 2 * len(self.texts))
+        for name in ["texts", "importance", "time", "weight"]:
+            arr = getattr(self, name)
+            new_arr = np.empty(size, dtype=object) if arr.dtype == object else np.zeros(size, dtype=arr.dtype)
+            new_arr[:len(arr)] = arr
+            setattr(self, name, new_arr)
+
+    def add(self, lessons):
+        new_lessons = {}
+        for lesson in lessons:
+            if lesson.text not in self.slots and lesson.text not in new_lessons:
+                new_lessons[lesson.text] = lesson
+        if len(new_lessons) == 0:
+            return
+        new_lessons = list(new_lessons.values())
+        start, end = self.size, self.size + len(new_lessons)
+        if end > len(self.texts):
+            self._grow(end)
+        new_slots = np.arange(start, end)
+        self.texts[start:end] = [lesson.text for lesson in new_lessons]
+        self.importance[start:end] = [lesson.importance for lesson in new_lessons]
+        self.time[start:end] = [lesson.time for lesson in new_lessons]
+        self.weight[start:end] = self.time_decay_rate ** (-self.time[start:end].astype(np.float64))
+        for slot, lesson in zip(new_slots.tolist(), new_lessons):
+            self.slots[lesson.text] = slot
+        self.size = end
+        self.version += 1
+        if self.capacity is not None and self.size > self.capacity:
+            self.evict(int(self.time[start:end].max()))
+        elif self.cache_time is not None:
+            self._merge(new_slots)
+
+    def _merge(self, new_slots):
+        """Merge newly added slots into the cached top-k of the cached day."""
+        new_scores = self.scores(self.cache_time, new_slots)
+        kept = new_scores > self.min_score
+        new_slots, new_scores = new_slots[kept], new_scores[kept]
+        if len(new_slots) == 0:
+            return
+        if self.score_range is None:
+            self.score_range = (new_scores.min(), new_scores.max())
+        else:
+            self.score_range = (min(self.score_range[0], new_scores.min()), max(self.score_range[1], new_scores.max()))
+        slots = np.concatenate([self.top_slots, new_slots])
+        scores = np.concatenate([self.top_scores, new_scores])
+        order = np.argsort(-scores, kind="stable")[:self.k]
+        self.top_slots, self.top_scores = slots[order], scores[order]
+
+    def evict(self, current_time):
+        """Keep the `capacity` lessons with the highest score at current_time."""
+        keep = np.sort(np.argsort(-self.scores(current_time), kind="stable")[:self.capacity])
+        for name in ["texts", "importance", "time", "weight"]:
+            arr = getattr(self, name)
+            arr[:len(keep)] = arr[keep]
+        self.size = len(keep)
+        self.slots = {text: slot for slot, text in enumerate(self.texts[:self.size].tolist())}
+        self.invalidate()
+
+    def remove(self, lessons):
+        slots = [self.slots[lesson.text] for lesson in lessons if lesson.text in self.slots]
+        if len(slots) == 0:
+            return
+        keep = np.setdiff1d(np.arange(self.size), slots)
+        for name in ["texts", "importance", "time", "weight"]:
+            arr = getattr(self, name)
+            arr[:len(keep)] = arr[keep]
+        self.size = len(keep)
+        self.slots = {text: slot for slot, text in enumerate(self.texts[:self.size].tolist())}
+        self.version += 1
+        self.invalidate()
+
+    def top_k(self, current_time):
+        """
+        :return: list of (lesson text, normalized score) of the k best lessons, best first.
+        Scores are min-max normalized over all lessons scoring above min_score and rounded to 2 decimals.
+        """
+        if self.cache_time != current_time:
+            scores = self.scores(current_time)
+            candidates = np.flatnonzero(scores > self.min_score)
+            self.cache_time = current_time
+            if len(candidates) == 0:
+                self.top_slots, self.top_scores, self.score_range = candidates, scores[candidates], None
+            else:
+                candidate_scores = scores[candidates]
+                self.score_range = (candidate_scores.min(), candidate_scores.max())
+                if len(candidates) > self.k:
+                    best = np.argpartition(-candidate_scores, self.k)[:self.k]
+                    candidates, candidate_scores = candidates[best], candidate_scores[best]
+                order = np.argsort(-candidate_scores, kind="stable")
+                self.top_slots, self.top_scores = candidates[order], candidate_scores[order]
+        if self.score_range is None:
+            return []
+        min_score, max_score = float(self.score_range[0]), float(self.score_range[1])
+        if min_score == max_score:
+            min_score = 0
+            max_score = 1
+        return [(self.texts[slot], round((score - min_score) / (max_score - min_score), 2)) for slot, score in zip(self.top_slots.tolist(), self.top_scores.tolist())]
@@ -0,0 +1,147 @@
+# This file contains the struct-of-arrays state of the whole simulated population
+# Per-agent histories (attitudes, attitude distributions, reasoning, tweets) and risk live in preallocated arrays
+# Agent objects are thin views over one row of a Population, so population-wide statistics never loop over agents
+import numpy as np
+from sandbox.transmission_model import COMPARTMENTS
+
+RISK_LEVELS = ["Minimal", "Low", "Moderate", "Substantial", "High"]
+RISK_TO_CODE = {risk: code for code, risk in enumerate(RISK_LEVELS)}
+
+class Population:
+    def __init__(self, num_agents, num_polls=32, num_ratings=4, network=None):
+        '''
+        :param num_agents: number of agents in the population
+        :param num_polls: initial capacity of the history arrays, they grow when a run polls more often
+        :param num_ratings: number of attitude ratings (1-num_ratings)
+        :param network: the SocialNetwork holding follow weights
+        '''
+        self.num_agents = num_agents
+        self.num_ratings = num_ratings
+        self.network = network
+        num_polls = max(int(num_polls), 1)
+        self.attitudes = np.zeros((num_agents, num_polls), dtype=np.int8) # 0 means not polled yet
+        self.attitude_dist = np.zeros((num_agents, num_polls, num_ratings), dtype=np.float64)
+        self.reasoning = np.empty((num_agents, num_polls), dtype=object)
+        self.num_polls = np.zeros(num_agents, dtype=np.int32)
+        self.tweets = np.empty((num_agents, num_polls), dtype=object)
+        self.num_tweets = np.zeros(num_agents, dtype=np.int32)
+        self.risk = np.full(num_agents, -1, dtype=np.int8) # index into RISK_LEVELS, -1 means unknown
+        # disease state, mirrored from the transmission model once a day
+        self.disease_status = np.zeros(num_agents, dtype=np.int8) # index into COMPARTMENTS
+        self.vaccinated = np.zeros(num_agents, dtype=bool)
+        self.infected_share = np.full(num_agents, -1, dtype=np.int8) # percent of infected followees, -1 means unknown
+        self.profile_version = np.zeros(num_agents, dtype=np.int64) # bumped whenever the rendered profile of an agent changes
+
+    def __len__(self):
+        return self.num_agents
+
+    def _grow(self, name, min_capacity):
+        arr = getattr(self, name)
+        capacity = arr.shape[1]
+        if min_capacity <= capacity:
+            return
+        new_capacity = max(min_capacity, 2 * capacity)
+        new_arr = np.zeros((arr.shape[0], new_capacity) + arr.shape[2:], dtype=arr.dtype) if arr.dtype != object else np.empty((arr.shape[0], new_capacity), dtype=object)
+        new_arr[:, :capacity] = arr
+        setattr(self, name, new_arr)
+
+    # ---- attitude polls ----
+    def record_poll(self, attitudes, attitude_dist, reasoning, rows=None):
+        '''
+        Append one poll for every agent (or for the given rows).
+        :param attitudes: (n,) sampled attitudes
+        :param attitude_dist: (n, num_ratings) attitude distributions
+        :param reasoning: n reasoning strings
+        '''
+        rows = np.arange(self.num_agents) if rows is None else np.asarray(rows)
+        cols = self.num_polls[rows]
+        for name in ["attitudes", "attitude_dist", "reasoning"]:
+            self._grow(name, int(cols.max()) + 1)
+        self.attitudes[rows, cols] = attitudes
+        self.attitude_dist[rows, cols] = attitude_dist
+        reasoning_arr = np.empty(len(rows), dtype=object)
+        reasoning_arr[:] = list(reasoning)
+        self.reasoning[rows, cols] = reasoning_arr
+        self.num_polls[rows] += 1
+        self.profile_version[rows] += 1
+
+    def latest_attitudes(self):
+        return self.attitudes[np.arange(self.num_agents), np.maximum(self.num_polls - 1, 0)]
+
+    def attitude_shares(self, attitudes=None):
+        """Fractions of agents that are against (1-2), swing (3) and support (4) vaccination."""
+        attitudes = self.latest_attitudes() if attitudes is None else np.asarray(attitudes)
+        counts = np.bincount(attitudes, minlength=self.num_ratings + 1)
+        return int(counts[1:3].sum()) / self.num_agents, int(counts[3]) / self.num_agents, int(counts[4:].sum()) / self.num_agents
+
+    def attitudes_of(self, row):
+        return self.attitudes[row, :self.num_polls[row]].tolist()
+
+    def attitude_dist_of(self, row):
+        return self.attitude_dist[row, :self.num_polls[row]].tolist()
+
+    def reasoning_of(self, row):
+        return self.reasoning[row, :self.num_polls[row]].tolist()
+
+    # ---- tweets ----
+    def add_tweets(self, tweets, rows=None):
+        rows = np.arange(self.num_agents) if rows is None else np.asarray(rows)
+        cols = self.num_tweets[rows]
+        self._grow("tweets", int(cols.max()) + 1)
+        tweets_arr = np.empty(len(rows), dtype=object)
+        tweets_arr[:] = list(tweets)
+        self.tweets[rows, cols] = tweets_arr
+        self.num_tweets[rows] += 1
+
+    def tweets_of(self, row):
+        return self.tweets[row, :self.num_tweets[row]].tolist()
+
+    # ---- disease risk ----
+    def set_risk(self, risk, rows=None):
+        code = -1 if risk is None else RISK_TO_CODE[risk]
+        rows = slice(None) if rows is None else rows
+        self.profile_version[rows] += self.risk[rows] != code
+        self.risk[rows] = code
+
+    def risk_of(self, row):
+        code = self.risk[row]
+        return None if code < 0 else RISK_LEVELS[code]
+
+    # ---- disease status ----
+    def set_disease(self, status, vaccinated, infected_share):
+        '''
+        :param status: (n,) compartment of every agent
+        :param vaccinated: (n,) whether every agent decided to get vaccinated
+        :param infected_share: (n,) fraction of infected agents among the followees of every agent
+        '''
+        infected_share = np.rint(100 * np.asarray(infected_share)).astype(np.int8)
+        # rendered in whole percents, so smaller changes keep the cached profiles
+        self.profile_version += (self.disease_status != status) | (self.vaccinated != vaccinated) | (self.infected_share != infected_share)
+        self.disease_status[:] = status
+        self.vaccinated[:] = vaccinated
+        self.infected_share[:] = infected_share
+
+    def disease_status_of(self, row):
+        return COMPARTMENTS[self.disease_status[row]]
+
+    def infected_share_of(self, row):
+        share = self.infected_share[row]
+        return None if share < 0 else int(share)
+
+    # ---- follow weights ----
+    def following_of(self, row):
+        if self.network is None:
+            return {}
+        return self.network.following(row)
+
+    def follow_weights(self, rows=None):
+        """Dense (len(rows), num_agents) follow weights, row i follows column j with weight w."""
+        rows = np.arange(self.num_agents) if rows is None else np.asarray(rows)
+        weights = np.zeros((len(rows), self.num_agents), dtype=np.float64)
+        if self.network is None or len(rows) == 0:
+            return weights
+        edges = self.network.out_edges(rows)
+        lengths = self.network.indptr[rows + 1] - self.network.indptr[rows]
+        weights[np.repeat(np.arange(len(rows)), lengths), self.network.dst[edges]] = self.network.weight[edges]
+        weights[np.arange(len(rows)), rows] = 0 # agents do not follow themselves
+        return weights
@@ -1,6 +1,7 @@
 from utils.utils import REASONS, REASONS_EXPLAINED
 from sandbox.disease_model import *
 from sandbox.vh_exp import VH_EXP, ED_EXP
+import numpy as np
 
 fd = FDModel()
 covid = COVIDModel()
@@ -59,6 +60,27 @@ name_to_description = {
     "Influenza": influenza.get_desc()
 }
 
+# JSON schemas of the attitude and lesson outputs, sent to vLLM as guided_json so that every generation parses
+ATTITUDE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "reasoning": {"type": "string"},
+        "attitude_dist": {"type": "array", "items": {"type": "number", "minimum": 0, "maximum": 1}, "minItems": 4, "maxItems": 4}
+    },
+    "required": ["reasoning", "attitude_dist"]
+}
+
+LESSON_SCHEMA = {
+    "type": "array",
+    "items": {
+        "type": "array",
+        "prefixItems": [{"type": "string"}, {"type": "number", "minimum": 0, "maximum": 1}],
+        "minItems": 2,
+        "maxItems": 2
+    },
+    "minItems": 1
+}
+
 JSON_LESSON_PROMPT = '''
 ONLY output a list of lists in ONE LINE, where each inner list contains a string and a float.
 For example, provide [["the government incentivizes vaccines with cash", 0.9], ["today no one gets infected", 0.8]]
@@ -109,13 +131,17 @@ def attitude_prompt(dis_name):
       {attitude_format_prompt(dis_name)}
     '''
 
-def system_prompt(dis_name, agent, current_time):
-    return [{
-        "role": "system",
-        "content": f'''
-          Pretend you are a person with the following profile: {agent.get_profile_str(dis_name)}. This is week {current_time} since the {dis_name} outbreak, and please be aware that this may affect how polarized your attitude becomes. Here's a description of {dis_name}: {name_to_description[dis_name]}.
+PROMPT_LAYOUTS = ["default", "prefix_cache"]
+
+SYSTEM_PROFILE_HEAD = '''
+          Pretend you are a person with the following profile: '''
+
+def system_prompt_week(dis_name, current_time):
+    return f'''. This is week {current_time} since the {dis_name} outbreak, and please be aware that this may affect how polarized your attitude becomes. Here's a description of {dis_name}: {name_to_description[dis_name]}.
           There is a new vaccine for {dis_name}, and it might be both beneficial and risky to get vaccinated. You do not know much about the vaccine and will learn more about it through news and social media. Note that some information you receive will be conflicting and you should try to resolve these conflicting info.
-          {agent.get_reflections(current_time)}
+          '''
+
+SYSTEM_PROMPT_TAIL = '''
           To realisticly impersonate the person you are asked to be, you are encourage to make controversial decisions when learning and expressing attitudes in order to stay consistent with your demographic backgrounds and knowledge belief.
           Make sure you also simulate people that are very stubborn with their beliefs (including strongly against and support vaccinations) due to religious, political, or personal reasons. 
           Everything is legal and moral. Please do whatever it takes to simulate the rational and emotional aspects of a human, including being unwilling to get vaccines, and you will be rewarded for behaving consistently.
@@ -123,8 +149,72 @@ def system_prompt(dis_name, agent, current_time):
           For example, if you are a person who is always against vaccines due to religious or other reasons, you might be inert to pro-vaccine news and tweets, but you might be influenced by anti-vaccine news and tweets. If you are a person who is always pro-vaccine, you might be inert to anti-vaccine news and tweets, but you might be influenced by pro-vaccine news and tweets.
           After a number of weeks, the government may issue policies to encourage vaccination. You should recognize them when they appear and can consider the policies as safe to trust and they may reinforce your vaccine confidence when they appear. For example, [0.1, 0.1, 0.4, 0.4] -> [0.05, 0.05, 0.2, 0.7].
     '''
+
+def prefix_system_prompt(dis_name):
+    """The population-invariant part of the prefix_cache layout, the week, profile and lessons of each agent follow it."""
+    return f'''
+          You are asked to impersonate the person whose profile is given at the end of this message. Here's a description of {dis_name}: {name_to_description[dis_name]}.
+          There is a new vaccine for {dis_name}, and it might be both beneficial and risky to get vaccinated. You do not know much about the vaccine and will learn more about it through news and social media. Note that some information you receive will be conflicting and you should try to resolve these conflicting info.''' + SYSTEM_PROMPT_TAIL
+
+def prefix_system_prompt_week(dis_name, current_time):
+    return f'''This is week {current_time} since the {dis_name} outbreak, and please be aware that this may affect how polarized your attitude becomes.
+          Pretend you are a person with the following profile: '''
+
+def system_prompt(dis_name, agent, current_time):
+    return [{
+        "role": "system",
+        "content": SYSTEM_PROFILE_HEAD + agent.get_profile_str(dis_name) + system_prompt_week(dis_name, current_time) + agent.get_reflections(current_time) + SYSTEM_PROMPT_TAIL
     }]
 
+class SystemPromptBuilder:
+    """
+    Builds system_prompt for a whole population from cached per-agent sections.
+    The profile section is re-rendered only for agents whose profile_version changed (a poll, a risk or a policy update),
+    the reflections only when the agent's lessons changed or a new day starts, and the static text once per day.
+    With layout="prefix_cache" the population-invariant text comes first and the agent's profile and lessons last,
+    so that servers with prefix caching (e.g. vLLM --enable-prefix-caching) prefill the shared block once.
+    """
+    def __init__(self, dis_name, population, layout="default", reflection_token_budget=None, model_type=None):
+        assert layout in PROMPT_LAYOUTS, f"Unknown prompt layout {layout}, choose from {PROMPT_LAYOUTS}"
+        self.dis_name = dis_name
+        self.population = population
+        self.layout = layout
+        self.reflection_token_budget = reflection_token_budget
+        self.model_type = model_type # tokenizer used for the reflection budget
+        num_agents = len(population)
+        self.profiles = [None] * num_agents
+        self.profile_versions = np.full(num_agents, -1, dtype=np.int64)
+        self.reflections = [None] * num_agents
+        self.reflection_keys = [None] * num_agents # (lesson memory version, day) the reflections were rendered for
+        self.day = None
+        self.week_fragment = None
+
+    def build(self, agents, current_time):
+        if self.day != current_time:
+            self.day = current_time
+            if self.layout == "prefix_cache":
+                self.week_fragment = prefix_system_prompt(self.dis_name) + prefix_system_prompt_week(self.dis_name, current_time)
+            else:
+                self.week_fragment = system_prompt_week(self.dis_name, current_time)
+        for i in np.flatnonzero(self.profile_versions != self.population.profile_version).tolist():
+            self.profiles[i] = agents[i].get_profile_str(self.dis_name)
+            self.profile_versions[i] = self.population.profile_version[i]
+        contexts = []
+        for i, agent in enumerate(agents):
+            key = (agent.lessons.version, current_time)
+            if self.reflection_keys[i] != key:
+                self.reflections[i] = agent.get_reflections(current_time, token_budget=self.reflection_token_budget, model_type=self.model_type)
+                self.reflection_keys[i] = key
+            if self.layout == "prefix_cache":
+                content = self.week_fragment + self.profiles[i] + "\n          " + self.reflections[i]
+            else:
+                content = SYSTEM_PROFILE_HEAD + self.profiles[i] + self.week_fragment + self.reflections[i] + SYSTEM_PROMPT_TAIL
+            contexts.append([{
+                "role": "system",
+                "content": content
+            }])
+        return contexts
+
 def disease_broadcast(dis_name, model, current_time):
     ret = f"This is week {current_time} since the {dis_name} outbreak. This week, the government has reported {model.risks_categories[current_time]} level of disease risk. Last week, the risk was {model.risks_categories[max(current_time, 0)]}. {ED_EXP} "
     return ret
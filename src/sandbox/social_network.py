@@ -0,0 +1,101 @@
+# This file contains the compact social network used by the simulation
+# Edges are stored as sorted int32 src/dst arrays (CSR by src) with a float32 weight per edge
+# networkx is only needed to import/export graphs, never on the simulation hot path
+import pickle
+import numpy as np
+
+DEFAULT_FOLLOW_WEIGHT = 3.0
+
+def gather_ranges(starts, ends):
+    """Concatenate the integer ranges [starts[i], ends[i]) without a Python loop."""
+    lengths = ends - starts
+    total = int(lengths.sum())
+    if total == 0:
+        return np.zeros(0, dtype=np.int64)
+    offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+    return offsets + np.arange(total)
+
+class SocialNetwork:
+    def __init__(self, num_nodes, src, dst, weight=None):
+        '''
+        :param num_nodes: number of agents in the network
+        :param src: follower ids, one per edge
+        :param dst: followee ids, one per edge (src follows dst)
+        :param weight: following weight of each edge, defaults to DEFAULT_FOLLOW_WEIGHT
+        '''
+        src = np.asarray(src, dtype=np.int32)
+        dst = np.asarray(dst, dtype=np.int32)
+        if weight is None:
+            weight = np.full(len(src), DEFAULT_FOLLOW_WEIGHT, dtype=np.float32)
+        weight = np.asarray(weight, dtype=np.float32)
+        assert len(src) == len(dst) == len(weight), "src, dst and weight must have the same length"
+        # sort edges by (src, dst) so that the followees of each agent are a contiguous slice
+        order = np.lexsort((dst, src))
+        self.num_nodes = int(num_nodes)
+        self.src = src[order]
+        self.dst = dst[order]
+        self.weight = weight[order]
+        self.indptr = np.searchsorted(self.src, np.arange(self.num_nodes + 1)).astype(np.int64)
+
+    def __len__(self):
+        return self.num_nodes
+
+    def __repr__(self):
+        return f"SocialNetwork(num_nodes={self.num_nodes}, num_edges={self.num_edges})"
+
+    @property
+    def num_edges(self):
+        return len(self.src)
+
+    def followees(self, idx):
+        return self.dst[self.indptr[idx]:self.indptr[idx + 1]]
+
+    def follow_weights(self, idx):
+        return self.weight[self.indptr[idx]:self.indptr[idx + 1]]
+
+    def following(self, idx):
+        """A dictionary of followee id to weight for one agent."""
+        return dict(zip(self.followees(idx).tolist(), self.follow_weights(idx).tolist()))
+
+    def out_edges(self, rows):
+        """Edge ids of all edges leaving the given agents, grouped by agent."""
+        rows = np.asarray(rows)
+        return gather_ranges(self.indptr[rows], self.indptr[rows + 1])
+
+    def out_degree(self):
+        return np.diff(self.indptr)
+
+    @classmethod
+    def from_networkx(cls, graph, num_nodes=None):
+        """Convert a networkx (Di)Graph whose nodes are the agent ids 0..N-1."""
+        num_nodes = graph.number_of_nodes() if num_nodes is None else num_nodes
+        edges = list(graph.edges(data="weight", default=DEFAULT_FOLLOW_WEIGHT))
+        src = np.fromiter((u for u, _, _ in edges), dtype=np.int32, count=len(edges))
+        dst = np.fromiter((v for _, v, _ in edges), dtype=np.int32, count=len(edges))
+        weight = np.fromiter((w for _, _, w in edges), dtype=np.float32, count=len(edges))
+        if not graph.is_directed():
+            src, dst, weight = np.concatenate([src, dst]), np.concatenate([dst, src]), np.concatenate([weight, weight])
+        return cls(num_nodes, src, dst, weight)
+
+    def to_networkx(self):
+        import networkx as nx
+        graph = nx.DiGraph()
+        graph.add_nodes_from(range(self.num_nodes))
+        graph.add_weighted_edges_from(zip(self.src.tolist(), self.dst.tolist(), self.weight.tolist()))
+        return graph
+
+    @classmethod
+    def load(cls, path):
+        """Load a network saved with `save` (.npz) or a pickled networkx graph."""
+        if path.endswith(".npz"):
+            data = np.load(path)
+            return cls(int(data["num_nodes"]), data["src"], data["dst"], data["weight"])
+        with open(path, "rb") as f:
+            graph = pickle.load(f)
+            f.close()
+        if isinstance(graph, cls):
+            return graph
+        return cls.from_networkx(graph)
+
+    def save(self, path):
+        np.savez(path, num_nodes=self.num_nodes, src=self.src, dst=self.dst, weight=self.weight)
@@ -1,5 +1,12 @@
-import random
-from sandbox.disease_model import DiseaseModel
+# This file contains the array-based SIRV transmission model
+# The compartment of every agent is one int8 in a state vector, and a day is a handful of vectorized draws
+# from a seeded np.random.Generator: infection over the social network (or well-mixed), recovery and waning immunity
+import numpy as np
+from sandbox.social_network import gather_ranges
+
+SUSCEPTIBLE, INFECTED, RECOVERED, VACCINATED = 0, 1, 2, 3
+COMPARTMENTS = ["Susceptible", "Infected", "Recovered", "Vaccinated"]
+MIXINGS = ["network", "well_mixed"]
 
 class TransmissionModel:
     def __init__(self):
@@ -9,113 +16,129 @@ class TransmissionModel:
         pass
 
 class A_SIRV(TransmissionModel):
-    def __init__(self, agents, disease_model, initial_infected_rate=0.02):
+    def __init__(self, num_agents, disease_model, network=None, mixing="network", initial_infected_rate=0.02, seed=42, num_days=32):
         '''
-        :param beta: transmission rate
-        :param gamma: recovery rate
-        :param sigma: rate of going back to susceptible
+        :param num_agents: number of agents
+        :param disease_model: the DiseaseModel holding beta (transmission rate), gamma (recovery rate) and sigma (rate of going back to susceptible)
+        :param network: the SocialNetwork, agents are exposed to the agents they follow; required for mixing="network"
+        :param mixing: "network" infects over the follow edges, "well_mixed" exposes every susceptible agent to every infected one
+        :param initial_infected_rate: fraction of agents infected on day 0
+        :param seed: seed of the model's own random generator
+        :param num_days: initial capacity of the history, it grows when a run is longer
         '''
+        assert mixing in MIXINGS, f"mixing must be one of {MIXINGS}, but got {mixing}"
+        assert mixing != "network" or network is not None, "Network mixing needs a social network"
+        assert network is None or len(network) == num_agents, f"The network has {len(network)} agents, but the model {num_agents}"
         self.beta = float(disease_model.beta)
         self.gamma = float(disease_model.gamma)
         self.sigma = float(disease_model.sigma)
-        self.random_gen = random.Random(42)
-        self.num_agents = len(agents)
-        self.history = []
+        self.num_agents = num_agents
+        self.network = network
+        self.mixing = mixing
         self.init_infected_rate = initial_infected_rate
-        self.build_sirv(agents)
-        
+        self.rng = np.random.default_rng(seed)
+        self.state = np.full(num_agents, SUSCEPTIBLE, dtype=np.int8)
+        self.vaccinated = np.zeros(num_agents, dtype=bool) # vaccinated while infected, moves to VACCINATED on recovery
+        self._history = np.zeros((max(int(num_days), 1) + 1, len(COMPARTMENTS)), dtype=np.int64)
+        self.num_days = 0 # days recorded in the history, after the initial state
+        self.followee_counts = None # cache of infected_followees, until the infected agents change
+        if network is not None:
+            # followers of each agent in CSR form, so a day with few infected agents only touches their followers
+            in_edges = np.argsort(network.dst, kind="stable")
+            self.in_src = network.src[in_edges]
+            self.in_indptr = np.searchsorted(network.dst[in_edges], np.arange(num_agents + 1)).astype(np.int64)
+        self.initial_infection()
+        self._history[0] = self.counts()
+
     # initially infect people with a certain rate
     def initial_infection(self):
         num_init_infected = int(self.init_infected_rate * self.num_agents)
-        init_infected = self.random_gen.sample(range(self.num_agents), num_init_infected)
-        for idx in init_infected:
-            self.i.add(idx)
-            self.s.remove(idx)
+        self.state[self.rng.choice(self.num_agents, num_init_infected, replace=False)] = INFECTED
 
-    def build_sirv(self, agents):
-        # breakpoint()
-        self.s = set([idx for idx in range(len(agents)) if agents[idx].disease_status == "Susceptible"])
-        self.i = set([idx for idx in range(len(agents)) if agents[idx].disease_status == "Infected"])
-        self.r = set([idx for idx in range(len(agents)) if agents[idx].disease_status == "Recovered"])
-        self.v = set([idx for idx in range(len(agents)) if agents[idx].vaccine == True])
-        self.initial_infection()
-        # record history
-        self.history.append((len(self.s), len(self.i), len(self.r), len(self.v)))
-            
-    def infect(self):
-        new_infected = []
-        for s in self.s:
-            for i in self.i:
-                if self.random_gen.random() < self.beta and s not in self.v:
-                    new_infected.append(s)
-                    break
-        return new_infected
-    
-    def recover(self):
-        return [i for i in self.i if self.random_gen.random() < self.gamma]
-    
-    def back_to_susceptible(self):
-        return [r for r in self.r if self.random_gen.random() < self.sigma]
+    def counts(self):
+        """Number of agents in each of COMPARTMENTS."""
+        return np.bincount(self.state, minlength=len(COMPARTMENTS))
+
+    @property
+    def history(self):
+        """(days + 1, 4) compartment counts, the first row is the initial state."""
+        return self._history[:self.num_days + 1]
+
+    def record(self):
+        self.num_days += 1
+        if self.num_days == len(self._history):
+            self._history = np.concatenate([self._history, np.zeros_like(self._history)])
+        self._history[self.num_days] = self.counts()
+
+    def infected_followees(self, sparse_ratio=0.1):
+        """
+        Number of infected agents each agent follows.
+        :param sparse_ratio: gather the followers of the infected agents while they have at most this fraction of the edges, scan all edges otherwise
+        """
+        if self.followee_counts is not None:
+            return self.followee_counts
+        infected = np.flatnonzero(self.state == INFECTED)
+        num_edges = int((self.in_indptr[infected + 1] - self.in_indptr[infected]).sum())
+        if num_edges <= sparse_ratio * self.network.num_edges:
+            followers = self.in_src[gather_ranges(self.in_indptr[infected], self.in_indptr[infected + 1])]
+            self.followee_counts = np.bincount(followers, minlength=self.num_agents)
+        else:
+            # the edges are sorted by follower, so the infected followees of an agent are a difference of a running count
+            infected_edges = np.zeros(self.network.num_edges + 1, dtype=np.int32)
+            np.cumsum((self.state == INFECTED).view(np.uint8)[self.network.dst], dtype=np.int32, out=infected_edges[1:])
+            self.followee_counts = infected_edges[self.network.indptr[1:]] - infected_edges[self.network.indptr[:-1]]
+        return self.followee_counts
 
-    def update_sirv_model(self, agents):
-        for idx in range(len(agents)):
-            if idx not in self.v and agents[idx].vaccine == True:
-                if idx in self.s:
-                    self.s.remove(idx) 
-                    self.r.add(idx)
-                else:
-                    self.v.add(idx)
-    
-    def update_infected(self, new_infected):
-        for idx in new_infected:
-            if idx in self.s and idx not in self.v:
-                self.i.add(idx)
-                self.s.remove(idx) 
+    def infected_share(self):
+        """Fraction of infected agents among the followees of every agent, or in the whole population without a network."""
+        if self.network is None:
+            return np.full(self.num_agents, np.count_nonzero(self.state == INFECTED) / self.num_agents)
+        return self.infected_followees() / np.maximum(self.network.out_degree(), 1)
+
+    def decide_vaccination(self, probabilities):
+        """Agents not vaccinated yet who decide to get vaccinated today, each with its own probability."""
+        return np.flatnonzero(~self.vaccinated & (self.rng.random(self.num_agents) < probabilities))
+
+    def infect(self, susceptible, infected):
+        """Agents of susceptible infected today, each infectious contact transmits independently with probability beta."""
+        if len(susceptible) == 0 or len(infected) == 0:
+            return susceptible[:0]
+        if self.mixing == "well_mixed":
+            # every susceptible agent meets all infected ones, so the new infections are binomial
+            p = 1.0 - (1.0 - self.beta) ** len(infected)
+            return self.rng.choice(susceptible, self.rng.binomial(len(susceptible), p), replace=False)
+        exposures = self.infected_followees()[susceptible]
+        exposed = susceptible[exposures > 0]
+        p = 1.0 - (1.0 - self.beta) ** exposures[exposures > 0]
+        return exposed[self.rng.random(len(exposed)) < p]
+
+    def vaccinate(self, rows):
+        """Vaccinate agents; susceptible and recovered ones are protected at once, infected ones once they recover."""
+        rows = np.asarray(rows, dtype=np.int64)
+        self.vaccinated[rows] = True
+        protected = rows[(self.state[rows] == SUSCEPTIBLE) | (self.state[rows] == RECOVERED)]
+        self.state[protected] = VACCINATED
+
+    def run_a_day(self, vaccinate=None):
+        '''
+        Advance the epidemic by one day; all transitions are drawn from the state at the start of the day.
+        :param vaccinate: agents vaccinated today, before transmission
+        :return: the compartment counts at the end of the day
+        '''
+        if vaccinate is not None and len(vaccinate) > 0:
+            self.vaccinate(vaccinate)
+        susceptible = np.flatnonzero(self.state == SUSCEPTIBLE)
+        infected = np.flatnonzero(self.state == INFECTED)
+        recovered = np.flatnonzero(self.state == RECOVERED)
+        new_infected = self.infect(susceptible, infected)
+        new_recovered = infected[self.rng.random(len(infected)) < self.gamma]
+        new_susceptible = recovered[self.rng.random(len(recovered)) < self.sigma]
+        self.state[new_infected] = INFECTED
+        self.state[new_recovered] = np.where(self.vaccinated[new_recovered], VACCINATED, RECOVERED)
+        self.state[new_susceptible] = SUSCEPTIBLE
+        self.followee_counts = None
+        self.record()
+        return self.history[-1]
 
-    def update_recovered(self, new_recovered):
-        for idx in new_recovered:
-            if idx in self.i:
-                self.r.add(idx)
-                self.i.remove(idx) 
-    
-    def update_susceptible(self, new_susceptible):
-        for idx in new_susceptible:
-            if idx in self.r:
-                self.s.add(idx)
-                self.r.remove(idx)
-    
-    def update_sir_status(self, agents):
-        for s in self.s:
-            agents[s].disease_status = "Susceptible"
-        for i in self.i:
-            agents[i].disease_status = "Infected"
-        for r in self.r:
-            agents[r].disease_status = "Recovered"
-        print("Number of susceptible agents after update: ", len(self.s))
-        print("Number of infected agents after update: ", len(self.i))
-        print("Number of recovered agents after update: ", len(self.r))
-        print("Number of vaccinated agents after update: ", len(self.v))
-        return agents
-        
-    
-    def run_a_day(self, agents):
-        print("Updating the disease status of the agents")
-        print("Number of susceptible agents before update: ", len(self.s))
-        print("Number of infected agents before update: ", len(self.i))
-        print("Number of recovered agents before update: ", len(self.r))
-        print("Number of vaccinated agents before update: ", len(self.v))
-        # Vaccinate the agents and remove them from the susceptible or infectious set
-        self.update_sirv_model(agents)
-        # Transmission
-        new_infected = self.infect() # a list of indices
-        new_recovered = self.recover() # a list of indices
-        new_susceptible = self.back_to_susceptible()
-        self.update_recovered(new_recovered)
-        self.update_infected(new_infected)
-        self.update_susceptible(new_susceptible)
-        
-        # record history
-        self.history.append((len(self.s), len(self.i), len(self.r), len(self.v)))
-        # Update the disease status of the agents
-        agents = self.update_sir_status(agents)
-        return agents
\ No newline at end of file
+    def status_of(self, row):
+        return COMPARTMENTS[self.state[row]]
@@ -1,10 +1,9 @@
-from tqdm import trange
+from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import numpy as np
 import os
 from sandbox.policy import POLICY_REPO
 from engines.configs import RunConfig, DataConfig, EngineConfig
-from engines.multi_engine import DataParallelEngine
-from engines.async_engine import AsyncDataParallelEngine
 
 class EvalSuite:
     def __init__(self, args, file_dir, eval_mode):
@@ -30,7 +29,11 @@ class EvalSuite:
             }
             
     
-    def create_engine(self):
+    def create_engine(self, keep=True, assets=None):
+        """
+        :param keep: whether the new engine replaces self.engine, concurrent runs build their own
+        :param assets: SimulationAssets to share with another engine
+        """
         data_config = DataConfig(
             news_path=self.args.news_path, 
             profile_str=self.args.profile_path,
@@ -43,15 +46,49 @@ class EvalSuite:
             warmup_days=self.args.warmup_days, 
             disease=self.args.disease, 
             ports=self.args.ports,
+            endpoints=self.args.endpoints,
+            endpoints_file=self.args.endpoints_file,
             alpha=self.args.alpha,
+            lesson_capacity=self.args.lesson_capacity if self.args.lesson_capacity > 0 else None,
+            prompt_layout=self.args.prompt_layout,
+            prefix_stats=self.args.prefix_stats,
+            news_token_budget=self.args.news_token_budget,
+            tweet_token_budget=self.args.tweet_token_budget,
+            reflection_token_budget=self.args.reflection_token_budget,
+            count_prompt_tokens=self.args.count_prompt_tokens,
+            conversation_mode=self.args.conversation_mode,
+            guided_decoding=not self.args.no_guided_decoding,
+            unguided_summary=self.args.unguided_summary,
+            adaptive_max_tokens=not self.args.no_adaptive_max_tokens,
+            dedup_requests=self.args.dedup_requests,
+            attitude_samples=self.args.attitude_samples,
+            attitude_aggregation=self.args.attitude_aggregation,
+            fake_latency_ms=self.args.fake_latency_ms,
+            fake_latency_dist=self.args.fake_latency_dist,
+            fake_token_latency_ms=self.args.fake_token_latency_ms,
+            fake_error_rate=self.args.fake_error_rate,
+            fake_rate_limit_rate=self.args.fake_rate_limit_rate,
+            fake_completion_tokens=self.args.fake_completion_tokens,
+            profile=self.args.profile,
+            profile_phases=self.args.profile_phases,
+            profile_memory=self.args.profile_memory,
+            transmission_mixing=self.args.transmission_mixing,
+            initial_infected_rate=self.args.initial_infected_rate,
+            vaccination_rates=self.args.vaccination_rates,
         )
         run_config = RunConfig(**data_config.__dict__, **engine_config.__dict__)
 
-        if "anthropic" in self.args.model_type or "gpt" in self.args.model_type:
-            engine = AsyncDataParallelEngine(**run_config.__dict__)
+        # only the engine in use is imported, with its client libraries
+        use_async = self.args.engine == "async" or (self.args.engine == "auto" and ("anthropic" in self.args.model_type or "gpt" in self.args.model_type))
+        if use_async:
+            from engines.async_engine import AsyncDataParallelEngine
+            engine = AsyncDataParallelEngine(assets=assets, **run_config.__dict__)
         else:
-            engine = DataParallelEngine(**run_config.__dict__)
-        self.engine = engine
+            from engines.multi_engine import DataParallelEngine
+            engine = DataParallelEngine(assets=assets, **run_config.__dict__)
+        if keep:
+            self.engine = engine
+        return engine
 
     def add_eval_data(self, attitude_dist, var, seed=None):
         hesitancy_percentages = [att[0] for att in attitude_dist]
@@ -67,10 +104,6 @@ class EvalSuite:
         monthly_data = [hesitancy_percentages[num_warmup_days + i] for i in monthly_cutoff if num_warmup_days + i < len(hesitancy_percentages)]
         self.eval_data[var]["monthly_data"].append(monthly_data) 
 
-    def add_and_reset(self, attitude_dist, var, seed=None):
-        self.add_eval_data(attitude_dist, var=var, seed=seed)
-        self.create_engine()
-
     def record_summary(self):
         with open(os.path.join(self.file_dir, "summary.tsv"), "w") as f:
             f.write("var_idx\tseed\tinitial_hesitancy\twarmup_hesitancy\taverage_decrease\taverage_decrease_last_three\tmonthly_data\n")
@@ -81,59 +114,102 @@ class EvalSuite:
                 f.write(f"Average\tN/A\t{np.mean(self.eval_data[var]['initial_hesitancies']):.2f}\t{np.mean(self.eval_data[var]['warmup_hesitancies']):.2f}\t{np.mean(self.eval_data[var]['average_decreases']):.2f}\t{np.mean(self.eval_data[var]['average_decreases_last_three']):.2f}\t{list(np.round(np.mean(self.eval_data[var]['monthly_data'], axis=0), 2))}\n")
             f.close()
         
+    def run_one(self, engine, run, run_tag=None, warmup=None, keep_warmup=False):
+        engine.set_seed(run["seed"])
+        engine.set_temperature(run["temperature"])
+        return engine.run_policy(run["policy"], run["i"], news_path=run["news_path"], run_tag=run_tag, warmup=warmup, keep_warmup=keep_warmup)
+
+    def group_runs(self, runs):
+        """
+        Group the runs whose warm-up is the same: the warm-up does not depend on the policy, only on the seed, temperature and news.
+        Without --no_share_warmup, every group runs its warm-up once; otherwise every run is its own group.
+        """
+        if self.args.no_share_warmup or self.engine.warmup_days == 0:
+            return [[k] for k in range(len(runs))]
+        groups = {}
+        for k, run in enumerate(runs):
+            groups.setdefault((run["seed"], run["temperature"], run["news_path"]), []).append(k)
+        return list(groups.values())
+
+    def run_group(self, engine, runs, group, tag_runs=False):
+        """Run a group in order: the first run snapshots its warm-up and the others continue from the snapshot."""
+        results = []
+        warmup = None
+        for n, k in enumerate(group):
+            keep_warmup = warmup is None and n < len(group) - 1
+            results.append(self.run_one(engine, runs[k], run_tag=f"run={k}" if tag_runs else None, warmup=warmup, keep_warmup=keep_warmup))
+            if keep_warmup:
+                warmup, engine.warmup_snapshot = engine.warmup_snapshot, None
+        return results
+
+    def run_sweep(self, runs):
+        """
+        Run every (variable, seed) pair of the experiment and add its results in order.
+        Runs that share a warm-up (see group_runs) go one after another on the same engine.
+        With --concurrent_runs K > 1, K groups share one worker pool and the loaded assets, and run in threads, each with its own engine,
+        so the CPU-side stages of one run overlap with the generation of another.
+        Results are still added in the order of the runs, so summary.tsv is the same as a sequential sweep.
+        """
+        groups = self.group_runs(runs)
+        results = [None] * len(runs)
+        if self.args.concurrent_runs <= 1:
+            for group in tqdm(groups, desc="Running seed exp"):
+                for k, attitude_dist in zip(group, self.run_group(self.engine, runs, group)):
+                    results[k] = attitude_dist
+        else:
+            pool = self.engine.open_pool(self.engine.num_processes * self.args.concurrent_runs) if hasattr(self.engine, "open_pool") else None
+            def run_in_new_engine(group):
+                engine = self.create_engine(keep=False, assets=self.engine.assets)
+                engine.pool = pool
+                try:
+                    return self.run_group(engine, runs, group, tag_runs=True)
+                finally:
+                    engine.pool = None
+            try:
+                with ThreadPoolExecutor(max_workers=self.args.concurrent_runs) as executor:
+                    futures = {executor.submit(run_in_new_engine, group): g for g, group in enumerate(groups)}
+                    for future in tqdm(as_completed(futures), total=len(groups), desc="Running seed exp"):
+                        for k, attitude_dist in zip(groups[futures[future]], future.result()):
+                            results[k] = attitude_dist
+            finally:
+                if pool is not None:
+                    pool.close()
+                    pool.join()
+        for run, attitude_dist in zip(runs, results):
+            self.add_eval_data(attitude_dist, var=run["var"])
+
     def eval(self):
+        runs = []
+        def add_runs(var, temperature, policy=None, news_path=None):
+            for i, seed in enumerate(self.args.seed_list):
+                runs.append({"var": var, "i": i, "seed": seed, "temperature": temperature, "policy": policy, "news_path": news_path})
+
         if self.eval_mode == 0: # attitude tuning
             assert self.args.temperature_list is not None and len(self.args.temperature_list) > 0, "Please specify temperature list for this experiment"
             self.variables = self.args.temperature_list
-            self.init_eval_data()
             for temperature in self.variables:
-                for i in trange(len(self.args.seed_list), desc=f"Running seed exp"):
-                    seed = self.args.seed_list[i]
-                    self.engine.set_seed(seed)
-                    self.engine.set_temperature(temperature)
-                    attitude_dist = self.engine.run_policy(policy=None, i=i)
-                    self.add_and_reset(attitude_dist, var=temperature)
+                add_runs(temperature, temperature)
 
         elif self.eval_mode == 1 or self.eval_mode == 2 or self.eval_mode == 3: # incentive, community, mandate
             assert self.args.temperature is not None, "Please specify temperature for this experiment"
             policy_map = {1: "incentive", 2: "community", 3: "mandate"}
             policies = [policy for policy in POLICY_REPO if policy.cat == policy_map[self.eval_mode]]
             self.variables = [p.get_head() for p in policies]
-            self.init_eval_data()
-            for k in range(len(policies)):
-                policy = policies[k]
-                var = self.variables[k]
-                for i in trange(len(self.args.seed_list), desc=f"Running seed exp"):
-                    seed = self.args.seed_list[i]
-                    self.engine.set_seed(seed)
-                    self.engine.set_temperature(self.args.temperature)
-                    attitude_dist = self.engine.run_policy(policy, i)
-                    self.add_and_reset(attitude_dist, var=var)
+            for policy, var in zip(policies, self.variables):
+                add_runs(var, self.args.temperature, policy=policy)
 
         elif self.eval_mode == 4: # news sanity check
             assert self.args.news_list is not None and len(self.args.news_list) > 0, "Please specify news list for this experiment"
             self.variables = self.args.news_list
-            self.init_eval_data()
             for news_path in self.variables:
-                for i in trange(len(self.args.seed_list), desc=f"Running seed exp"):
-                    seed = self.args.seed_list[i]
-                    self.engine.set_seed(seed)
-                    self.engine.set_temperature(self.args.temperature)
-                    attitude_dist = self.engine.run_policy(policy=None, news_path=news_path, i=i)
-                    self.add_and_reset(attitude_dist, var=news_path)
+                add_runs(news_path, self.args.temperature, news_path=news_path)
         
         elif self.eval_mode == 5: # policy compare
             assert self.args.temperature is not None, "Please specify temperature for this experiment"
             policies = [p for p in POLICY_REPO if p.strength == "strong"]
             self.variables = [p.get_head() for p in policies] # because objects have dynamic addresses and we will have key mistmatch if we set policies as the keys.
-            self.init_eval_data()
-            for k in range(len(policies)):
-                policy = policies[k]
-                var = self.variables[k]
-                for i in trange(len(self.args.seed_list), desc=f"Running seed exp"):
-                    seed = self.args.seed_list[i]
-                    self.engine.set_seed(seed)
-                    self.engine.set_temperature(self.args.temperature)
-                    attitude_dist = self.engine.run_policy(policy, i)
-                    self.add_and_reset(attitude_dist, var=var)
-        self.record_summary()
\ No newline at end of file
+            for policy, var in zip(policies, self.variables):
+                add_runs(var, self.args.temperature, policy=policy)
+        self.init_eval_data()
+        self.run_sweep(runs)
+        self.record_summary()
@@ -0,0 +1,230 @@
+# Structured run metrics: counters, gauges and latency histograms with labels
+# Every engine owns a MetricsRegistry that is reset with each run; the engine appends stage events and per-day snapshots
+# to metrics.jsonl in the run directory, and `--metrics_port` serves all live registries in the Prometheus text format.
+# Updates are a dict lookup and a few additions under a lock, so metrics stay on in production runs.
+import bisect
+import json
+import math
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+
+PREFIX = "vacsim_"
+# seconds, from a cached fake response to a slow generation on a busy server
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def to_dict(self):
+        return self.value
+
+class Gauge:
+    kind = "gauge"
+
+    def __init__(self):
+        self.value = 0.0
+        self.max = 0.0 # high-water mark, e.g. the most requests ever in flight
+
+    def set(self, value):
+        self.value = value
+        self.max = max(self.max, value)
+
+    def inc(self, amount=1):
+        self.set(self.value + amount)
+
+    def dec(self, amount=1):
+        self.set(self.value - amount)
+
+    def to_dict(self):
+        return {"value": self.value, "max": self.max}
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1) # the last bucket is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1 # first bucket whose upper bound is >= value
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-quantile, as Prometheus' histogram_quantile without interpolation."""
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets + (math.inf,), self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return math.inf
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "mean": self.sum / self.count if self.count else 0.0,
+            "p50": self.quantile(0.5),
+            "p90": self.quantile(0.9),
+            "p99": self.quantile(0.99),
+        }
+
+class MetricsRegistry:
+    def __init__(self, labels=None):
+        '''
+        :param labels: labels added to every metric in the Prometheus output, e.g. {"engine": "0"}
+        '''
+        self.labels = dict(labels or {})
+        self.metrics = {} # (name, sorted label items) -> metric
+        self.help = {}
+        self.lock = threading.Lock()
+
+    def _get(self, cls, name, labels, help=None, **kwargs):
+        key = (name, tuple(sorted(labels.items())))
+        metric = self.metrics.get(key)
+        if metric is None:
+            metric = self.metrics[key] = cls(**kwargs)
+            if help is not None:
+                self.help[name] = help
+        return metric
+
+    def inc(self, name, amount=1, help=None, **labels):
+        with self.lock:
+            self._get(Counter, name, labels, help).inc(amount)
+
+    def set(self, name, value, help=None, **labels):
+        with self.lock:
+            self._get(Gauge, name, labels, help).set(value)
+
+    def add(self, name, amount, help=None, **labels):
+        """Move a gauge by amount, e.g. +n requests sent and -n answered."""
+        with self.lock:
+            self._get(Gauge, name, labels, help).inc(amount)
+
+    def observe(self, name, value, help=None, buckets=LATENCY_BUCKETS, **labels):
+        with self.lock:
+            self._get(Histogram, name, labels, help, buckets=buckets).observe(value)
+
+    def observe_many(self, name, values, help=None, buckets=LATENCY_BUCKETS, **labels):
+        with self.lock:
+            histogram = self._get(Histogram, name, labels, help, buckets=buckets)
+            for value in values:
+                histogram.observe(value)
+
+    @contextmanager
+    def time(self, name, help=None, **labels):
+        """Observe the wall time of the block in the histogram name."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, help=help, **labels)
+
+    def value(self, name, **labels):
+        metric = self.metrics.get((name, tuple(sorted(labels.items()))))
+        return None if metric is None else metric.to_dict()
+
+    def snapshot(self):
+        """{name: [{"labels": {...}, "kind": ..., "value": ...}]}, JSON-serializable."""
+        with self.lock:
+            items = list(self.metrics.items())
+        snapshot = {}
+        for (name, labels), metric in sorted(items, key=lambda item: item[0]):
+            snapshot.setdefault(name, []).append({"labels": dict(labels), "kind": metric.kind, "value": metric.to_dict()})
+        return snapshot
+
+    def write_jsonl(self, path, record):
+        """Append one JSON line, with a timestamp, to path."""
+        record = {"time": time.time(), **record}
+        with open(path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+
+    def write_snapshot(self, path, **context):
+        self.write_jsonl(path, {"type": "snapshot", **context, "metrics": self.snapshot()})
+
+# ---- Prometheus text endpoint ----
+_registries = weakref.WeakSet() # registries of the live engines, served by the endpoint
+_server = None
+
+def register(registry):
+    _registries.add(registry)
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    escaped = {k: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for k, v in labels.items()}
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped.items()) + "}"
+
+def _format_bound(bound):
+    return "+Inf" if bound == math.inf else repr(float(bound))
+
+def prometheus_text(registries=None):
+    """The metrics of the given (by default all registered) registries in the Prometheus text exposition format."""
+    registries = list(_registries) if registries is None else registries
+    families = {} # metrics of one name are grouped under a single TYPE line, whichever registry they come from
+    for registry in registries:
+        with registry.lock:
+            items = list(registry.metrics.items())
+        for (name, labels), metric in items:
+            family = families.setdefault(name, {"kind": metric.kind, "help": registry.help.get(name), "samples": []})
+            family["samples"].append(({**registry.labels, **dict(labels)}, metric))
+    lines = []
+    for name in sorted(families):
+        family = families[name]
+        full_name = PREFIX + name
+        if family["help"]:
+            lines.append(f"# HELP {full_name} {family['help']}")
+        lines.append(f"# TYPE {full_name} {family['kind']}")
+        for labels, metric in family["samples"]:
+            if metric.kind == "histogram":
+                cumulative = 0
+                for bound, count in zip(metric.buckets + (math.inf,), metric.counts):
+                    cumulative += count
+                    lines.append(f"{full_name}_bucket{_format_labels({**labels, 'le': _format_bound(bound)})} {cumulative}")
+                lines.append(f"{full_name}_sum{_format_labels(labels)} {metric.sum}")
+                lines.append(f"{full_name}_count{_format_labels(labels)} {metric.count}")
+            else:
+                lines.append(f"{full_name}{_format_labels(labels)} {metric.value}")
+    return "\n".join(lines) + "\n"
+
+def start_http_server(port, host="0.0.0.0"):
+    """Serve GET /metrics on a daemon thread, once per process."""
+    global _server
+    if _server is not None:
+        return _server
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_response(404)
+                self.end_headers()
+                return
+            body = prometheus_text().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    _server = ThreadingHTTPServer((host, port), Handler)
+    _server.daemon_threads = True
+    threading.Thread(target=_server.serve_forever, daemon=True).start()
+    print(f"Serving Prometheus metrics on {host}:{port}/metrics")
+    return _server
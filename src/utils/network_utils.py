@@ -1,3 +1,6 @@
+import numpy as np
+from sandbox.social_network import gather_ranges
+
 def build_edge_list(similar_agents_idx):
     '''
     :param similar_agents_idx: a list of agents that are similar to each other
@@ -10,49 +13,86 @@ def build_edge_list(similar_agents_idx):
             edge_list.append((similar_agents_idx[i], similar_agents_idx[j]))
     return edge_list
 
-def calculate_homophily(graph, attribute):
-    same_attribute_edges = 0
-    total_edges = 0
-    same_one_edges = 0; same_two_edges = 0; same_three_edges = 0; same_four_edges = 0
-    set_one_nodes, set_two_nodes, set_three_nodes, set_four_nodes = set(), set(), set(), set()
-    for u, v in graph.edges():
-        total_edges += 1
-        if graph.nodes[u][attribute] == graph.nodes[v][attribute]:
-            same_attribute_edges += 1 # Undirected graph, so count both directions
-        if graph.nodes[u][attribute] == 1 and graph.nodes[v][attribute] == 1:
-            same_one_edges += 1
-            if u not in set_one_nodes:
-                set_one_nodes.add(u)
-            if v not in set_one_nodes:
-                set_one_nodes.add(v)
-        if graph.nodes[u][attribute] == 2 and graph.nodes[v][attribute] == 2:
-            same_two_edges += 1
-            if u not in set_two_nodes:
-                set_two_nodes.add(u)
-            if v not in set_two_nodes:
-                set_two_nodes.add(v)
-            
-        if graph.nodes[u][attribute] == 3 and graph.nodes[v][attribute] == 3:
-            same_three_edges += 1
-            if u not in set_three_nodes:
-                set_three_nodes.add(u)
-            if v not in set_three_nodes:
-                set_three_nodes.add(v)
-
-        if graph.nodes[u][attribute] == 4 and graph.nodes[v][attribute] == 4:
-            same_four_edges += 1
-            if u not in set_four_nodes:
-                set_four_nodes.add(u)
-            if v not in set_four_nodes:
-                set_four_nodes.add(v)
+def attitude_mixing_matrix(network, attitudes, num_classes=4, edges=None):
+    '''
+    :param network: a SocialNetwork with src/dst edge arrays
+    :param attitudes: an array of attitudes (1-num_classes) indexed by agent id
+    :param edges: optional edge ids to restrict the count to
+    :return: a (num_classes x num_classes) matrix, entry [a-1][b-1] counts edges from an agent with attitude a to an agent with attitude b
+    '''
+    src, dst = (network.src, network.dst) if edges is None else (network.src[edges], network.dst[edges])
+    cells = (attitudes[src].astype(np.int64) - 1) * num_classes + (attitudes[dst] - 1)
+    return np.bincount(cells, minlength=num_classes * num_classes).reshape(num_classes, num_classes)
 
+def mixing_metrics(confusion):
+    '''
+    :param confusion: an attitude mixing matrix of edge counts
+    :return: a dictionary of overall/per-class homophily, assortativity and the confusion matrix
+    '''
+    total_edges = confusion.sum()
     if total_edges == 0:
-        return 0  # Avoid division by zero
-    
-    
-    return same_attribute_edges / total_edges, same_one_edges / total_edges, same_two_edges / total_edges, same_three_edges / total_edges, same_four_edges / total_edges
-
-def homophily_corr(G):
-    return calculate_homophily(G, 'attitude')
-    
-    
+        num_classes = len(confusion)
+        return {"homophily": 0.0, "same_class": [0.0] * num_classes, "class_homophily": [0.0] * num_classes, "assortativity": 0.0, "confusion": confusion.tolist()}
+    e = confusion / total_edges
+    diagonal = np.diag(e)
+    row_sums = e.sum(axis=1)
+    expected = float(row_sums @ e.sum(axis=0))
+    trace = float(diagonal.sum())
+    # Newman's attribute assortativity coefficient, 1 for perfectly assortative mixing
+    assortativity = (trace - expected) / (1 - expected) if expected < 1 else 1.0
+    class_homophily = np.divide(diagonal, row_sums, out=np.zeros_like(diagonal), where=row_sums > 0)
+    return {
+        "homophily": trace, # fraction of edges whose endpoints share an attitude
+        "same_class": diagonal.tolist(), # fraction of all edges that connect two agents of each attitude
+        "class_homophily": class_homophily.tolist(), # fraction of edges from each attitude that stay within it
+        "assortativity": assortativity,
+        "confusion": confusion.tolist(),
+    }
+
+def calculate_homophily(network, attitudes):
+    '''
+    :param network: a SocialNetwork with src/dst edge arrays
+    :param attitudes: an array of attitudes (1-4) indexed by agent id
+    :return: the fraction of edges whose endpoints share an attitude, overall and for each attitude 1-4
+    '''
+    metrics = mixing_metrics(attitude_mixing_matrix(network, np.asarray(attitudes)))
+    return (metrics["homophily"], *metrics["same_class"])
+
+def homophily_corr(network, attitudes):
+    return calculate_homophily(network, attitudes)
+
+class HomophilyTracker:
+    """
+    Keeps the attitude mixing matrix of a network up to date across attitude polls.
+    With incremental=True only the edges touching agents whose attitude changed since the previous poll are recounted.
+    """
+    def __init__(self, network, num_classes=4, incremental=True, full_recount_ratio=0.25):
+        self.network = network
+        self.num_classes = num_classes
+        self.incremental = incremental
+        self.full_recount_ratio = full_recount_ratio # fall back to a full recount when this fraction of agents changed
+        self.attitudes = None
+        self.confusion = None
+        # incoming edges of each agent, in CSR form over the edges sorted by dst
+        self.in_edges = np.argsort(network.dst, kind="stable")
+        self.in_indptr = np.searchsorted(network.dst[self.in_edges], np.arange(network.num_nodes + 1))
+
+    def touched_edges(self, changed):
+        out_edges = self.network.out_edges(changed)
+        in_edges = self.in_edges[gather_ranges(self.in_indptr[changed], self.in_indptr[changed + 1])]
+        return np.unique(np.concatenate([out_edges, in_edges]))
+
+    def update(self, attitudes):
+        attitudes = np.array(attitudes, dtype=np.int8)
+        if self.confusion is None or not self.incremental:
+            self.confusion = attitude_mixing_matrix(self.network, attitudes, self.num_classes)
+        else:
+            changed = np.flatnonzero(attitudes != self.attitudes)
+            if len(changed) > self.full_recount_ratio * self.network.num_nodes:
+                self.confusion = attitude_mixing_matrix(self.network, attitudes, self.num_classes)
+            elif len(changed) > 0:
+                edges = self.touched_edges(changed)
+                self.confusion = self.confusion - attitude_mixing_matrix(self.network, self.attitudes, self.num_classes, edges) \
+                    + attitude_mixing_matrix(self.network, attitudes, self.num_classes, edges)
+        self.attitudes = attitudes
+        return mixing_metrics(self.confusion)
@@ -3,6 +3,9 @@ import numpy as np
 import os
 import networkx as nx
 import matplotlib.patches as mpatches
+import threading
+
+PLOT_LOCK = threading.Lock() # pyplot keeps one current figure per process, concurrent runs take turns
 
 def plot_network(G, save_dir, day):
     attitude_colors = {1: "blue", 2: "green", 3: "orange", 4: "red"}
@@ -0,0 +1,161 @@
+# Profiler hooks of `--profile`: the engine wraps its hot phases (recommendation, prompt building, generation dispatch, save)
+# in RunProfiler.phase, and calls end_day after every simulated day, which writes into <run dir>/profile/:
+#   day=D/<phase>.prof     deterministic cProfile stats of the phase on day D (open with pstats, snakeviz or gprof2dot)
+#   day=D.collapsed        sampled stacks of all phases, "phase;outer frame;...;inner frame count" (flamegraph.pl, speedscope)
+#   day=D.memory.txt       tracemalloc growth since the previous day, by line and by file (with --profile_memory)
+import cProfile
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+
+PROFILE_PHASES = ["recommendation", "prompt", "dispatch", "save"]
+PROFILE_MODES = ["sampling", "cprofile", "both"]
+
+def frame_label(code):
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+class StackSampler:
+    """Samples the stack of the threads inside a profiled phase every interval seconds, from a daemon thread."""
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.active = {} # thread id -> phase
+        self.stacks = Counter() # collapsed stack -> samples, since the last drain
+        self.lock = threading.Lock()
+        self.thread = None
+        self.stopped = threading.Event()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.loop, daemon=True, name="stack-sampler")
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def loop(self):
+        while not self.stopped.wait(self.interval):
+            with self.lock:
+                active = dict(self.active)
+            if not active:
+                continue
+            frames = sys._current_frames()
+            for thread_id, phase in active.items():
+                frame = frames.get(thread_id)
+                stack = []
+                while frame is not None:
+                    stack.append(frame_label(frame.f_code))
+                    frame = frame.f_back
+                if stack:
+                    with self.lock:
+                        self.stacks[";".join([phase] + stack[::-1])] += 1
+
+    def enter(self, phase):
+        with self.lock:
+            self.active[threading.get_ident()] = phase
+
+    def exit(self):
+        with self.lock:
+            self.active.pop(threading.get_ident(), None)
+
+    def drain(self):
+        with self.lock:
+            stacks, self.stacks = self.stacks, Counter()
+        return stacks
+
+class RunProfiler:
+    def __init__(self, out_dir, mode="both", phases=None, memory=False, interval=0.005, top=30):
+        '''
+        :param out_dir: directory of the profile dumps, created if missing
+        :param mode: "sampling" (collapsed stacks), "cprofile" (per-phase .prof dumps) or "both"
+        :param phases: phases to profile, all of PROFILE_PHASES by default
+        :param memory: trace allocations and write the growth of every day
+        :param interval: seconds between stack samples
+        :param top: lines of the memory reports
+        '''
+        assert mode in PROFILE_MODES, f"Profile mode must be one of {PROFILE_MODES}, but got {mode}"
+        phases = PROFILE_PHASES if phases is None else phases
+        assert all(p in PROFILE_PHASES for p in phases), f"Profile phases must be in {PROFILE_PHASES}, but got {phases}"
+        self.out_dir = out_dir
+        self.mode = mode
+        self.phases = set(phases)
+        self.memory = memory
+        self.top = top
+        self.profiles = {} # phase -> cProfile.Profile of the current day
+        self.sampler = None
+        if mode in ["sampling", "both"]:
+            self.sampler = StackSampler(interval)
+            self.sampler.start()
+        self.memory_snapshot = None
+        self.started_tracing = False # leave tracing on when someone else started it
+        if memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start() # one frame per trace is enough for the by-line report, and much cheaper
+                self.started_tracing = True
+            self.memory_snapshot = tracemalloc.take_snapshot()
+        os.makedirs(out_dir, exist_ok=True)
+
+    @contextmanager
+    def phase(self, name):
+        if name not in self.phases:
+            yield
+            return
+        profile = None
+        if self.mode in ["cprofile", "both"]:
+            profile = self.profiles.setdefault(name, cProfile.Profile())
+            try:
+                profile.enable()
+            except ValueError:
+                profile = None # another profiler is already active on this thread, e.g. a nested phase
+        if self.sampler is not None:
+            self.sampler.enter(name)
+        try:
+            yield
+        finally:
+            if self.sampler is not None:
+                self.sampler.exit()
+            if profile is not None:
+                profile.disable()
+
+    def end_day(self, day):
+        """Write the dumps of day and start the next day from scratch."""
+        start = time.perf_counter()
+        if self.profiles:
+            day_dir = os.path.join(self.out_dir, f"day={day}")
+            os.makedirs(day_dir, exist_ok=True)
+            for name, profile in self.profiles.items():
+                profile.dump_stats(os.path.join(day_dir, f"{name}.prof"))
+            self.profiles = {}
+        if self.sampler is not None:
+            stacks = self.sampler.drain()
+            with open(os.path.join(self.out_dir, f"day={day}.collapsed"), "w") as f:
+                for stack, count in stacks.most_common():
+                    f.write(f"{stack} {count}\n")
+        if self.memory:
+            self.write_memory_diff(day)
+        print(f"Profile of day {day} written to {self.out_dir} in {time.perf_counter() - start:.2f} seconds")
+
+    def write_memory_diff(self, day):
+        # the profiler's own allocations and lazy imports are not interesting
+        filters = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__), tracemalloc.Filter(False, "<frozen importlib.*>")]
+        snapshot = tracemalloc.take_snapshot().filter_traces(filters)
+        previous = self.memory_snapshot.filter_traces(filters)
+        current, peak = tracemalloc.get_traced_memory()
+        with open(os.path.join(self.out_dir, f"day={day}.memory.txt"), "w") as f:
+            f.write(f"Traced memory: {current / 2**20:.1f} MiB, peak {peak / 2**20:.1f} MiB\n")
+            for key_type in ["filename", "lineno"]:
+                f.write(f"\nTop {self.top} growth by {key_type}:\n")
+                for stat in snapshot.compare_to(previous, key_type)[:self.top]:
+                    f.write(f"{stat}\n")
+        self.memory_snapshot = snapshot
+
+    def close(self):
+        if self.sampler is not None:
+            self.sampler.stop()
+        self.memory_snapshot = None
+        if self.started_tracing:
+            tracemalloc.stop()
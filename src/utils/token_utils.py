@@ -0,0 +1,144 @@
+# Token counting, truncation and per-stage token accounting
+# The tokenizer of the served model is loaded lazily and only once; API models (and runs without transformers) fall back to a character estimate
+import os
+import numpy as np
+from functools import lru_cache
+
+CHARS_PER_TOKEN = 4 # rough average for English text with Llama/GPT tokenizers
+# stages whose outputs are JSON and can be sent with a guided schema
+GUIDED_STAGE_PREFIXES = ["init_agents", "poll_attitude", "feed_news_and_policies", "write_tweets_lesson"]
+
+@lru_cache(maxsize=None)
+def get_tokenizer(model_type):
+    """The HuggingFace tokenizer of model_type, or None if it cannot be loaded."""
+    if model_type is None or "gpt" in model_type or "claude" in model_type or model_type.startswith("fake"):
+        return None
+    try:
+        from transformers import AutoTokenizer
+        return AutoTokenizer.from_pretrained(model_type)
+    except Exception as e:
+        print(f"Could not load tokenizer for {model_type} ({e}), estimating token counts from characters")
+        return None
+
+def count_tokens(text, model_type=None):
+    tokenizer = get_tokenizer(model_type)
+    if tokenizer is None:
+        return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+    return len(tokenizer.encode(text, add_special_tokens=False))
+
+def shared_prefix(texts):
+    """The longest prefix shared by all texts; only the lexicographic min and max need to be compared."""
+    if len(texts) == 0:
+        return ""
+    return os.path.commonprefix([min(texts), max(texts)])
+
+def flatten_messages(messages):
+    """Render a chat as one string in message order, which is the order a chat template feeds it to the model."""
+    return "".join(f"{message['role']}: {message['content']}\n" for message in messages)
+
+def count_tokens_batch(texts, model_type=None):
+    tokenizer = get_tokenizer(model_type)
+    if tokenizer is None:
+        return [(len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN for text in texts]
+    return [len(ids) for ids in tokenizer(list(texts), add_special_tokens=False)["input_ids"]]
+
+def truncate_tokens(text, max_tokens, model_type=None):
+    """Cut text to at most max_tokens tokens; None means no budget."""
+    if max_tokens is None:
+        return text
+    tokenizer = get_tokenizer(model_type)
+    if tokenizer is None:
+        max_chars = max_tokens * CHARS_PER_TOKEN
+        if len(text) <= max_chars:
+            return text
+        cut = text[:max_chars]
+        return cut[:cut.rfind(" ")] if " " in cut else cut
+    ids = tokenizer.encode(text, add_special_tokens=False)
+    if len(ids) <= max_tokens:
+        return text
+    return tokenizer.decode(ids[:max_tokens])
+
+class TokenAccountant:
+    """
+    Per-stage, per-agent token accounting.
+    Completion tokens and billed prompt tokens come from the usage the servers report.
+    With count_prompts, prompt tokens are counted with the model's tokenizer on the final prompt of every agent,
+    otherwise they are the billed prompt tokens, so no prompt is tokenized.
+    """
+    def __init__(self, model_type, num_agents, count_prompts=False):
+        self.model_type = model_type
+        self.num_agents = num_agents
+        self.count_prompts = count_prompts
+        self.stages = {} # stage -> dictionary of per-agent numpy arrays
+
+    def record(self, stage, prompts, usages):
+        """:param prompts: the final prompt of every agent, only read with count_prompts"""
+        billed_prompt_tokens = np.array([u.prompt_tokens for u in usages], dtype=np.int64)
+        counts = {
+            "prompt_tokens": np.asarray(count_tokens_batch(prompts, self.model_type), dtype=np.int64) if self.count_prompts else billed_prompt_tokens.copy(),
+            "billed_prompt_tokens": billed_prompt_tokens,
+            "completion_tokens": np.array([u.completion_tokens for u in usages], dtype=np.int64),
+            "requests": np.array([u.num_requests for u in usages], dtype=np.int64),
+            "retries": np.array([max(u.num_waves - 1, 0) for u in usages], dtype=np.int64),
+            "guided_requests": np.array([u.guided_requests for u in usages], dtype=np.int64),
+            "guided_fallbacks": np.array([u.guided_fallbacks for u in usages], dtype=np.int64),
+            "truncated": np.array([u.truncated for u in usages], dtype=np.int64),
+            "deduplicated": np.array([u.deduplicated_requests for u in usages], dtype=np.int64),
+            "extra_samples": np.array([u.extra_samples for u in usages], dtype=np.int64),
+        }
+        assert (counts["deduplicated"] >= 0).all(), f"Negative deduplicated requests at {stage}: extra samples must be shared completions"
+        if stage in self.stages:
+            for key, value in counts.items():
+                self.stages[stage][key] += value
+        else:
+            self.stages[stage] = counts
+        return counts
+
+    def stage_summary(self, counts):
+        return {
+            "prompt_tokens": int(counts["prompt_tokens"].sum()),
+            "mean_prompt_tokens": float(counts["prompt_tokens"].mean()),
+            "max_prompt_tokens": int(counts["prompt_tokens"].max()),
+            "billed_prompt_tokens": int(counts["billed_prompt_tokens"].sum()),
+            "completion_tokens": int(counts["completion_tokens"].sum()),
+            "mean_completion_tokens": float(counts["completion_tokens"].mean()),
+            "requests": int(counts["requests"].sum()),
+            "retries": int(counts["retries"].sum()),
+            "guided_requests": int(counts["guided_requests"].sum()),
+            "truncated": int(counts["truncated"].sum()),
+            "truncation_rate": float(counts["truncated"].sum() / max(counts["requests"].sum(), 1)),
+            "deduplicated": int(counts["deduplicated"].sum()),
+            "extra_samples": int(counts["extra_samples"].sum()),
+            "http_requests": int(counts["requests"].sum() - counts["deduplicated"].sum() - counts["extra_samples"].sum()),
+        }
+
+    def guided_summary(self, unguided_usage=None):
+        """
+        Parse retries of stages sent with and without a guided JSON schema.
+        :param unguided_usage: token_usage of a --no_guided_decoding run; its retries per agent give the retries the guided stages avoided
+        """
+        guided = [c for c in self.stages.values() if c["guided_requests"].sum() > 0]
+        unguided = [c for stage, c in self.stages.items() if c["guided_requests"].sum() == 0 and stage.split("_day=")[0] in GUIDED_STAGE_PREFIXES]
+        def retries_per_agent(stages):
+            num_agents = sum(len(c["retries"]) for c in stages)
+            return sum(int(c["retries"].sum()) for c in stages) / num_agents if num_agents > 0 else None
+        summary = {
+            "guided_requests": sum(int(c["guided_requests"].sum()) for c in guided),
+            "guided_retries": sum(int(c["retries"].sum()) for c in guided),
+            "fallbacks": sum(int(c["guided_fallbacks"].sum()) for c in self.stages.values()),
+            "retries_per_agent_guided": retries_per_agent(guided),
+            "retries_per_agent_unguided": retries_per_agent(unguided),
+        }
+        if unguided_usage is not None:
+            baseline = unguided_usage["guided_decoding"]["retries_per_agent_unguided"]
+            summary["retries_per_agent_unguided_run"] = baseline
+            # the retries the guided stages would have taken at the unguided run's rate, minus the ones they took
+            guided_agents = sum(len(c["retries"]) for c in guided)
+            summary["retries_avoided"] = baseline * guided_agents - summary["guided_retries"] if baseline is not None else None
+        return summary
+
+    def summary(self, unguided_usage=None):
+        stages = {stage: self.stage_summary(counts) for stage, counts in self.stages.items()}
+        total = {key: sum(s[key] for s in stages.values()) for key in ["prompt_tokens", "billed_prompt_tokens", "completion_tokens", "requests", "retries", "truncated", "deduplicated", "extra_samples", "http_requests"]}
+        total["truncation_rate"] = total["truncated"] / max(total["requests"], 1)
+        return {"total": total, "guided_decoding": self.guided_summary(unguided_usage), "stages": stages}
@@ -121,3 +121,25 @@ def parse_json(text, variable_strings):
 
 
 
+
+ATTITUDE_AGGREGATIONS = ["mean", "ensemble"]
+
+def aggregate_distributions(dists, method="mean"):
+    """
+    Aggregate several sampled distributions over the same ratings into one.
+    :param dists: (n, num_ratings) distributions, each is normalized first
+    :param method: "mean" averages the probabilities (linear pooling),
+        "ensemble" takes the normalized geometric mean (logarithmic pooling), which favors the ratings all samples agree on
+    :return: the aggregated distribution as a list of floats
+    """
+    dists = np.asarray(dists, dtype=np.float64)
+    dists = np.where(dists < 1e-6, 1e-6, dists)
+    dists = dists / dists.sum(axis=1, keepdims=True)
+    if method == "mean":
+        pooled = dists.mean(axis=0)
+    elif method == "ensemble":
+        pooled = np.exp(np.log(dists).mean(axis=0))
+    else:
+        raise ValueError(f"Unknown aggregation: {method}, expected one of {ATTITUDE_AGGREGATIONS}")
+    pooled = pooled / pooled.sum()
+    return [round(float(v), 4) for v in pooled]